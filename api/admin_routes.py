@@ -0,0 +1,77 @@
+# api/admin_routes.py
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException, status
+from models.users import User
+from auth.jwt_auth import get_current_user
+from utils.user_locks import user_locks
+from utils.chatroom_manager import get_chatroom_manager
+from utils.turn_queue import turn_queue
+from utils.intent_classifier import get_intent_classifier
+from utils.llm_clients import get_llm_clients
+from utils.retry_logic import retry_metrics
+from utils.circuit_breaker import model_breakers
+from utils.hedging import hedge_metrics, ttft_tracker
+from utils.model_router import TASK_MODELS, model_scoreboard
+from utils.admission import llm_admission
+from utils.response_cache import response_cache
+from utils.semantic_cache import financial_chat_cache
+from utils.file_operations import cache_stats
+from api.responses import CodecJSONResponse
+
+router = APIRouter(prefix="/admin")
+
+async def get_admin_user(current_user: User = Depends(get_current_user)) -> User:
+    """管理者ユーザーのみ許可する"""
+    if not current_user.is_admin:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="管理者権限が必要です")
+    return current_user
+
+@router.get("/metrics")
+async def get_metrics(current_user: User = Depends(get_admin_user)):
+    """ワーカー内の運用メトリクスを取得するエンドポイント"""
+    classifier = get_intent_classifier()
+    return CodecJSONResponse(content={
+        "user_locks": user_locks.get_metrics(),
+        "chat_storage": get_chatroom_manager().get_metrics(),
+        "json_cache": cache_stats(),
+        "turn_queue": turn_queue.get_metrics(),
+        "intent_classifier": classifier.get_metrics() if classifier is not None else None,
+        "llm_clients": get_llm_clients().get_metrics(),
+        "stream_retries": retry_metrics.to_dict(),
+        "hedging": {**hedge_metrics.to_dict(), "ttft": ttft_tracker.snapshot()},
+        "admission": llm_admission.snapshot(),
+        "response_cache": response_cache.snapshot(),
+        "semantic_cache": financial_chat_cache.snapshot()
+    })
+
+@router.get("/circuit-breakers")
+async def get_circuit_breakers(current_user: User = Depends(get_admin_user)):
+    """モデルごとのサーキットブレーカーの状態を取得するエンドポイント（ワーカー内）"""
+    return CodecJSONResponse(content=model_breakers.snapshot())
+
+@router.post("/circuit-breakers/reset")
+async def reset_circuit_breakers(model: Optional[str] = None, current_user: User = Depends(get_admin_user)):
+    """サーキットをclosedに戻すエンドポイント（modelを省略した場合はすべて）"""
+    if not model_breakers.reset(model):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"サーキットブレーカーが見つかりません: {model}")
+    return CodecJSONResponse(content=model_breakers.snapshot())
+
+@router.get("/model-routing")
+async def get_model_routing(current_user: User = Depends(get_admin_user)):
+    """タスクごとのモデルのスコアボード（TTFT・生成速度・エラー率のEWMA）を取得するエンドポイント"""
+    return CodecJSONResponse(content=model_scoreboard.snapshot())
+
+@router.post("/model-routing/pin")
+async def pin_model(task: str, model: Optional[str] = None, current_user: User = Depends(get_admin_user)):
+    """タスクのモデルを固定するエンドポイント（modelを省略した場合は固定を解除）"""
+    if task not in TASK_MODELS:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"タスクが見つかりません: {task}")
+    model_scoreboard.pin(task, model)
+    return CodecJSONResponse(content=model_scoreboard.snapshot())
+
+@router.post("/response-cache/clear")
+async def clear_response_cache(current_user: User = Depends(get_admin_user)):
+    """LLMのレスポンスのキャッシュ（メモリ・SQLite、財務チャットのセマンティックキャッシュ）を削除するエンドポイント"""
+    await response_cache.clear()
+    financial_chat_cache.clear()
+    return CodecJSONResponse(content=response_cache.snapshot())
@@ -1,20 +1,27 @@
 # api/chat_router.py
 from fastapi import APIRouter, Request, Depends, BackgroundTasks
-from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
+from fastapi.responses import HTMLResponse, StreamingResponse
 from models.users import User
 from auth.jwt_auth import get_current_user
-from utils.chatroom_manager import ChatroomManager
+from utils.chatroom_manager import get_chatroom_manager
 from utils.openrouter_stream import AIOpenRouterStreamClient as OpenRouterStreamClient
 from utils.file_operations import load_json, to_pretty_json
+from api.responses import CodecJSONResponse
+from utils.sse import SSEEncoder
+from utils.retry_logic import StreamRestart
+from utils.stream_coalescer import coalesce_text
+from utils.disconnect import DisconnectWatcher, partial_answer_saver
+from utils.turn_pipeline import ANNOTATION_PIPELINE, UserTurn
+from utils.admission import set_admission_user
 from sqlalchemy.ext.asyncio import AsyncSession
 from database import get_db
-from tasks import generate_summary_task
-import json, uuid, traceback
+from tasks import summarize_after_flush
+import uuid, traceback
 from datetime import datetime
 DATA_DIR = "data"
 MAX_RALLIES = 6
 
-chatroom_manager = ChatroomManager(data_dir=DATA_DIR, max_rallies=MAX_RALLIES)
+chatroom_manager = get_chatroom_manager(data_dir=DATA_DIR, max_rallies=MAX_RALLIES)
 openrouter_stream_client = OpenRouterStreamClient()
 
 router = APIRouter()
@@ -25,16 +32,15 @@ async def conversation_history(
     current_user: User = Depends(get_current_user)
 ):
     user_id = current_user.id
-    chatroom = await chatroom_manager.get_or_create_chatroom(user_id)
-    history = await load_json(chatroom["files"]["chat_log"], [])
-    return JSONResponse(content=history)
+    history = await chatroom_manager.get_chat_log(user_id)
+    return CodecJSONResponse(content=history)
 
 @router.post("/clear")
 async def clear_chat_data(current_user: User = Depends(get_current_user)):
     """チャット履歴をクリアするエンドポイント"""
     user_id = current_user.id
     await chatroom_manager.clear_chat_data(user_id)
-    return JSONResponse(content={"status": "success", "message": "Clear chat history"})
+    return CodecJSONResponse(content={"status": "success", "message": "Clear chat history"})
 
 @router.post("/message_chat")
 async def message_chat(
@@ -45,6 +51,7 @@ async def message_chat(
 ):
     try:
         user_id = current_user.id
+        set_admission_user(user_id)
         
         # チャットデータの取得
         history, summary, user_history, thread_history = await chatroom_manager.get_chat_data(user_id)
@@ -60,29 +67,17 @@ async def message_chat(
         data = await request.json()
         user_input = data.get("message", "")
         print(f"User input: {user_input[:50]}...")
-        try:
-            user_type_response = await openrouter_stream_client.type_response(
-                user_input,
-                threads,
-                model="openai/gpt-4.1",
-                max_tokens=4000
-            )
-        except Exception as e:
-            print(f"Error: {e}")
-            return JSONResponse(content={"error": str(e)}, status_code=500)
-        try:
-            user_content_response = await openrouter_stream_client.content_response(
-                user_input,
-                threads,
-                model="openai/gpt-4.1",
-                max_tokens=4000
-            )
-        except Exception as e:
-            print(f"Error: {e}")
-            return JSONResponse(content={"error": str(e)}, status_code=500)
-        
-        print("Type response:", user_type_response)
-        print("Content response:", user_content_response)
+        # ユーザー発話の分類・要約（パイプラインモードではストリーミングと並行して実行）
+        user_turn = UserTurn(
+            chatroom_manager, user_id, user_input,
+            openrouter_stream_client, threads
+        )
+        if not ANNOTATION_PIPELINE:
+            try:
+                await user_turn
+            except Exception as e:
+                print(f"Error: {e}")
+                return CodecJSONResponse(content={"error": str(e)}, status_code=500)
         # ユーザーメッセージの追加
         user_message = {
             "role": "user", 
@@ -90,16 +85,8 @@ async def message_chat(
             "user_id": user_id,
             "timestamp": datetime.now().isoformat()
         }
-        user_thread = {
-            "role": "user", 
-            "type": user_type_response,
-            "content": user_content_response, 
-            "user_id": user_id,
-            "timestamp": datetime.now().isoformat()
-        }
 
         await chatroom_manager.add_message(user_id, user_message)
-        await chatroom_manager.add_thread(user_id, user_thread)
         
         base_prompt = """
         The assistant is Claude, created by Anthropic.
@@ -216,16 +203,27 @@ async def message_chat(
         print(system_prompt)
         async def generate():
             """ストリーミングレスポンスを生成する非同期ジェネレータ"""
+            sse = SSEEncoder()
+            disconnect = DisconnectWatcher(request, partial_answer_saver(chatroom_manager, user_id))
             resp = ""
             try:
-                # AIからのストリーミングレスポンスを取得
-                async for text in openrouter_stream_client.stream_response(user_input, system_prompt):
+                # AIからのストリーミングレスポンスを取得（クライアントが切断したら上流のストリームも閉じる）
+                async for text in disconnect.watch(coalesce_text(openrouter_stream_client.stream_response(user_input, system_prompt))):
                     if isinstance(text, dict) and "error" in text:
-                        yield f"data: {json.dumps(text)}\n\n"
+                        yield sse.error(text["error"])
                         return
+                    if isinstance(text, StreamRestart):
+                        # 途中で失敗して最初から生成し直す場合は、送信済みの回答を破棄させる
+                        resp = ""
+                        yield sse.restart()
+                        continue
                     resp += text
-                    yield f"data: {json.dumps({'text': text})}\n\n"
+                    yield sse.text(text)
                 
+                if disconnect.disconnected:
+                    # 切断後は分類・保存のためのLLM呼び出しを行わない
+                    return
+
                 # アシスタントの応答を保存
                 assistant_text = resp
                 assistant_message = {
@@ -235,61 +233,33 @@ async def message_chat(
                     "id": str(uuid.uuid4()),
                     "timestamp": datetime.now().isoformat()
                 }
-                try:
-                    assistant_type_response = await openrouter_stream_client.type_response(
-                        assistant_text,
-                        threads,
-                        model="openai/gpt-4.1",
-                        max_tokens=4000
-                    )
-                except Exception as e:
-                    print(f"Error: {e}")
-                    yield f"data: {json.dumps({'error': str(e)})}\n\n"
-                try:
-                    assistant_content_response = await openrouter_stream_client.content_response(
-                        assistant_text,
-                        threads,
-                        model="openai/gpt-4.1",
-                        max_tokens=4000
-                    )
-                except Exception as e:
-                    print(f"Error: {e}")
-                    yield f"data: {json.dumps({'error': str(e)})}\n\n"
-                assistant_thread = {
-                    "role": "assistant", 
-                    "type": assistant_type_response,
-                    "content": assistant_content_response, 
-                    "user_id": user_id,
-                    "id": str(uuid.uuid4()),
-                    "timestamp": datetime.now().isoformat()
-                }
                 await chatroom_manager.add_message(user_id, assistant_message)
-                await chatroom_manager.add_thread(user_id, assistant_thread)
-                
-                message_pair = {
-                    "user": user_thread,
-                    "assistant": assistant_thread,
-                    "timestamp": datetime.now().isoformat()
-                }
-                await chatroom_manager.update_user_messages(user_id, message_pair)
+                chatroom_manager.end_turn(user_id)
+                # 分類・要約とスレッドへの記録はレスポンスを閉じた後にキューで実行する
+                await user_turn.finish(assistant_message)
+                yield sse.done()
                 
                 # 定期的にバックグラウンドでサマリーを更新
                 if len(history) % 7 == 0:
                     background_tasks.add_task(
-                        generate_summary_task, 
+                        summarize_after_flush,
+                        chatroom_manager,
                         await to_pretty_json(history),
                         user_id
                     )
             except Exception as e:
-                yield f"data: {json.dumps({'error': str(e)})}\n\n"
+                yield sse.error(str(e))
                 error_details = traceback.format_exc()
                 print(f"Error in chat: {str(e)}\n{error_details}")
+            finally:
+                # 切断・エラーで回答が揃わなかった場合もユーザー発話は分類して記録する
+                user_turn.release()
         
         return StreamingResponse(generate(), media_type="text/event-stream")
     except Exception as e:
         error_details = traceback.format_exc()
         print(f"Error in chat: {str(e)}\n{error_details}")
-        return JSONResponse(
+        return CodecJSONResponse(
             content={"error": str(e), "details": error_details},
             status_code=500
         )
@@ -1,27 +1,27 @@
 # api/financial_routes.py
 from  fastapi import APIRouter, HTTPException, Depends, Request, Form, Body
-from fastapi.responses import JSONResponse
 from typing import Dict, List, Any, Optional
-import json
 import os
 from datetime import datetime
 from auth.jwt_auth import get_current_user
 from models.users import User
-from openai import AsyncOpenAI
 
-from utils.file_operations import load_json, save_json, to_pretty_json, clear_cache
+from utils.file_operations import load_json_snapshot, save_json, to_pretty_json, clear_cache
+from utils.snapshot import thaw
+from utils import json_codec
+from utils.llm_clients import LLMClients, get_llm_clients
+from utils.model_router import TASK_FUNCTION, routed_completion
+from utils.response_cache import response_cache
+from utils.semantic_cache import context_scope, financial_chat_cache
+from utils.admission import BATCH, INTERACTIVE, PROVIDER_OPENROUTER, llm_admission, set_admission_user
+from api.responses import CodecJSONResponse
 
 CRM_DATA_PATH = "crm_dummy_data"
+# 同じ内容の財務フォームに対する戦略（create_financial_strategy）をキャッシュする秒数
+FINANCIAL_STRATEGY_CACHE_TTL = float(os.getenv("FINANCIAL_STRATEGY_CACHE_TTL", 86400))
 
 router = APIRouter(prefix="/financial")
 
-openrouter_api_key = os.getenv("OPENROUTER_API_KEY")
-
-openrouter_client = AsyncOpenAI(
-    base_url="https://openrouter.ai/api/v1",
-    api_key=openrouter_api_key
-)
-
 # 必要な構造化データの定義（TypeScript風のコメント）
 """
 interface FinancialIssue {
@@ -77,16 +77,16 @@ async def get_crm_data(
                 status_code=404,
                 detail="CRMデータが見つかりません"
             )
-        crm_data = await load_json(crm_file_path, {})
+        crm_data = await load_json_snapshot(crm_file_path, {})
         if cif_id not in crm_data:
-            return JSONResponse(
+            return CodecJSONResponse(
                 content={
                     "success": False,
                     "message": f"指定されたCIF IDのデータが見つかりません: {cif_id}"
                 },
                 status_code=404
             )
-        return JSONResponse(
+        return CodecJSONResponse(
             content={
                 "success": True,
                 "data": crm_data[cif_id]
@@ -107,10 +107,13 @@ async def get_crm_data(
 async def submit_financial_data(
     request: Request,
     financial_data: Dict[str, Any] = Body(...),
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_user),
+    llm: LLMClients = Depends(get_llm_clients)
 ):
     """財務情報フォームの送信を処理するエンドポイント（シンプル版）"""
     try:
+        # LLMの呼び出しをユーザーごとの公平キューイングで数える（utils.admission）
+        set_admission_user(current_user.id)
         # 受け取ったデータをログに出力
         print("=== 財務フォーム送信データ ===")
         print(f"ユーザーID: {current_user.id}")
@@ -282,8 +285,9 @@ async def submit_financial_data(
         }
 
         # Function callingでLLMに送信
-        response = await openrouter_client.chat.completions.create(
-            model="openai/gpt-4o",  # gpt-4oの方がfunction callingに対応している
+        # モデルはスコアボードでFunction callingが速い順に試す（utils.model_router）
+        response = await routed_completion(
+            llm.openrouter, TASK_FUNCTION,
                 messages=[
                 {
                     "role": "system", 
@@ -300,6 +304,9 @@ async def submit_financial_data(
             }],
             tool_choice={"type": "function", "function": {"name": "create_financial_strategy"}},
                 max_tokens=4000,
+            # 同じフォームが再送信された場合はLLMを呼ばずに前回の戦略を返す
+            cache=response_cache,
+            cache_ttl=FINANCIAL_STRATEGY_CACHE_TTL,
             )
         
         print("=== LLM生成結果 ===")
@@ -317,8 +324,7 @@ async def submit_financial_data(
                 print("=== Function Arguments ===")
                 print(function_args)
                 
-                import json
-                parsed_strategy = json.loads(function_args)
+                parsed_strategy = json_codec.loads(function_args)
                 
                 # 構造化データとして設定
                 strategy_data = {
@@ -351,11 +357,12 @@ async def submit_financial_data(
 """
             
             try:
-                fallback_response = await openrouter_client.chat.completions.create(
-                    model="openai/gpt-4o-mini",
-                    messages=[{"role": "user", "content": fallback_prompt}],
-                    max_tokens=2000,
-                )
+                async with llm_admission.slot(PROVIDER_OPENROUTER, BATCH):
+                    fallback_response = await llm.openrouter.chat.completions.create(
+                        model="openai/gpt-4o-mini",
+                        messages=[{"role": "user", "content": fallback_prompt}],
+                        max_tokens=2000,
+                    )
                 fallback_content = fallback_response.choices[0].message.content
             except Exception as fallback_error:
                 print(f"フォールバックプロンプトも失敗: {fallback_error}")
@@ -405,11 +412,11 @@ async def submit_financial_data(
             }
         
         # キャッシュに保存
-        cache_data = await load_json(f"data/strategy_{current_user.id}.json", {})
-        cache_data[datetime.now().isoformat()] = strategy_data
-        await save_json(f"data/strategy_{current_user.id}.json", cache_data)
+        # 過去の戦略はコピーせずスナップショットのまま引き継ぐ
+        cache_data = await load_json_snapshot(f"data/strategy_{current_user.id}.json", {})
+        await save_json(f"data/strategy_{current_user.id}.json", {**cache_data, datetime.now().isoformat(): strategy_data})
         
-        return JSONResponse(
+        return CodecJSONResponse(
             content={
                 "success": True,
                 "message": "財務戦略が正常に生成されました",
@@ -491,9 +498,9 @@ async def get_strategy(
     current_user: User = Depends(get_current_user)
 ):
     try:
-        strategy_data = await load_json(f"data/strategy_{current_user.id}.json", {})
+        strategy_data = await load_json_snapshot(f"data/strategy_{current_user.id}.json", {})
         if not strategy_data:
-            return JSONResponse(
+            return CodecJSONResponse(
                 content={
                     "success": False,
                     "message": "Not found strategy data, please submit financial data first"
@@ -501,7 +508,7 @@ async def get_strategy(
                 status_code=404
             )
         
-        return JSONResponse(
+        return CodecJSONResponse(
             content={
                 "success": True,
                 "strategy_data": strategy_data
@@ -519,10 +526,13 @@ async def get_strategy(
 async def generate_lifeplan_simulation(
     request: Request,
     financial_data: Dict[str, Any] = Body(...),
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_user),
+    llm: LLMClients = Depends(get_llm_clients)
 ):
     """詳細なライフプランシミュレーションデータを生成（プロンプト対応版）"""
     try:
+        # LLMの呼び出しをユーザーごとの公平キューイングで数える（utils.admission）
+        set_admission_user(current_user.id)
         print(f"受信したデータ: {financial_data}")
         
         basic_info = financial_data.get('basicInfo', {})
@@ -1096,8 +1106,8 @@ async def generate_lifeplan_simulation(
                     }
                 }
                 
-                response = await openrouter_client.chat.completions.create(
-            model="openai/gpt-4.1",
+                response = await routed_completion(
+                    llm.openrouter, TASK_FUNCTION,
                     messages=[
                         {"role": "system", "content": "あなたは専門的なファイナンシャルプランナーです。顧客の65年間のライフプランを詳細に分析し、実用的なアドバイスを提供します。"},
                         {"role": "user", "content": prompt}
@@ -1108,16 +1118,15 @@ async def generate_lifeplan_simulation(
                 )
                 
                 # Function callingの結果を取得
-                import json
                 message = response.choices[0].message
                 if message.tool_calls and len(message.tool_calls) > 0:
                     tool_call = message.tool_calls[0]
                     if tool_call.function.name == "analyze_lifeplan":
                         try:
-                            analysis_json = json.loads(tool_call.function.arguments)
+                            analysis_json = json_codec.loads(tool_call.function.arguments)
                             print(f"✅ 分析Function calling成功")
                             return analysis_json
-                        except json.JSONDecodeError as je:
+                        except json_codec.JSONDecodeError as je:
                             print(f"❌ 分析Function calling JSON解析失敗: {je}")
                         except Exception as e:
                             print(f"❌ 分析Function calling処理エラー: {e}")
@@ -1305,8 +1314,8 @@ function callingで確実に65年分の構造化データを生成してくだ
                     }
                 }
                 
-                response = await openrouter_client.chat.completions.create(
-            model="openai/gpt-4.1",
+                response = await routed_completion(
+                    llm.openrouter, TASK_FUNCTION,
                     messages=[
                         {"role": "system", "content": f"あなたは「{selected_prompt['title'] if selected_prompt else 'バランス型'}」ファイナンシャルアドバイザーです。顧客の実際の数値に基づいて、完全カスタマイズされたライフプランを65年分作成してください。"},
                         {"role": "user", "content": prompt}
@@ -1317,15 +1326,13 @@ function callingで確実に65年分の構造化データを生成してくだ
                 )
                 
                 # Function callingの結果を取得
-                import json
-                
                 message = response.choices[0].message
                 if message.tool_calls and len(message.tool_calls) > 0:
                     tool_call = message.tool_calls[0]
                     if tool_call.function.name == "create_personalized_lifeplan":
                         try:
                             # Function callingで返されたJSONデータを解析
-                            llm_data = json.loads(tool_call.function.arguments)
+                            llm_data = json_codec.loads(tool_call.function.arguments)
                             print(f"✅ Function calling成功")
                             
                             # データの妥当性チェック
@@ -1342,7 +1349,7 @@ function callingで確実に65年分の構造化データを生成してくだ
                             else:
                                 print("⚠️ yearly_projectionsが見つかりません")
                                 
-                        except json.JSONDecodeError as je:
+                        except json_codec.JSONDecodeError as je:
                             print(f"❌ Function calling JSON解析失敗: {je}")
                         except Exception as e:
                             print(f"❌ Function calling処理エラー: {e}")
@@ -1627,11 +1634,10 @@ function callingで確実に65年分の構造化データを生成してくだ
             }
         }
         
-        cache_data = await load_json(f"data/lifeplan_{current_user.id}.json", {})
-        cache_data[datetime.now().isoformat()] = lifeplan_data
-        await save_json(f"data/lifeplan_{current_user.id}.json", cache_data)
+        cache_data = await load_json_snapshot(f"data/lifeplan_{current_user.id}.json", {})
+        await save_json(f"data/lifeplan_{current_user.id}.json", {**cache_data, datetime.now().isoformat(): lifeplan_data})
         
-        return JSONResponse(
+        return CodecJSONResponse(
             content={
                 "success": True,
                 "message": "ライフプランシミュレーションが生成されました",
@@ -1655,9 +1661,9 @@ async def get_lifeplan(
     current_user: User = Depends(get_current_user)
 ):
     try:
-        lifeplan_data = await load_json(f"data/lifeplan_{current_user.id}.json", {})
+        lifeplan_data = await load_json_snapshot(f"data/lifeplan_{current_user.id}.json", {})
         if not lifeplan_data:
-            return JSONResponse(
+            return CodecJSONResponse(
                 content={
                     "success": False,
                     "message": "ライフプランデータが見つかりません。まず財務情報を送信してください"
@@ -1665,7 +1671,7 @@ async def get_lifeplan(
                 status_code=404
             )
         
-        return JSONResponse(
+        return CodecJSONResponse(
             content={
                 "success": True,
                 "lifeplan_data": lifeplan_data
@@ -1682,10 +1688,13 @@ async def get_lifeplan(
 @router.post("/financial-chat")
 async def financial_chat(
     request: Request,
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_user),
+    llm: LLMClients = Depends(get_llm_clients)
 ):
     """財務データをコンテキストとした専用チャット機能"""
     try:
+        # LLMの呼び出しをユーザーごとの公平キューイングで数える（utils.admission）
+        set_admission_user(current_user.id)
         body = await request.json()
         user_message = body.get('message', '')
         
@@ -1701,11 +1710,11 @@ async def financial_chat(
         # 既存の財務戦略データを取得
         strategy_data = None
         try:
-            strategy_cache = await load_json(f"data/strategy_{current_user.id}.json", {})
+            strategy_cache = await load_json_snapshot(f"data/strategy_{current_user.id}.json", {})
             if strategy_cache:
                 # 最新のデータを取得
                 latest_key = max(strategy_cache.keys())
-                strategy_data = strategy_cache[latest_key]
+                strategy_data = thaw(strategy_cache[latest_key])
                 print(f"✅ 戦略データ取得成功")
         except Exception as e:
             print(f"⚠️ 戦略データ取得失敗: {e}")
@@ -1713,11 +1722,11 @@ async def financial_chat(
         # 既存のライフプランデータを取得
         lifeplan_data = None
         try:
-            lifeplan_cache = await load_json(f"data/lifeplan_{current_user.id}.json", {})
+            lifeplan_cache = await load_json_snapshot(f"data/lifeplan_{current_user.id}.json", {})
             if lifeplan_cache:
                 # 最新のデータを取得
                 latest_key = max(lifeplan_cache.keys())
-                lifeplan_data = lifeplan_cache[latest_key]
+                lifeplan_data = thaw(lifeplan_cache[latest_key])
                 print(f"✅ ライフプランデータ取得成功")
         except Exception as e:
             print(f"⚠️ ライフプランデータ取得失敗: {e}")
@@ -1837,18 +1846,29 @@ async def financial_chat(
 
         # LLMに送信
         try:
-            response = await openrouter_client.chat.completions.create(
-                model="openai/gpt-4o",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                max_tokens=1500,
-                temperature=0.7
-            )
-            
-            ai_response = response.choices[0].message.content
-            print(f"✅ LLM応答生成成功")
+            # 同じ戦略・ライフプランに対して言い換えただけの質問には、前回の回答をすぐに返す
+            cache_scope = context_scope(current_user.id, financial_context)
+            cached = financial_chat_cache.lookup(cache_scope, user_message)
+            if cached is not None:
+                ai_response = cached.answer
+                print(f"✅ キャッシュから応答 (類似度: {cached.similarity:.2f}, 元の質問: {cached.question})")
+            else:
+                # 画面で回答を待っているため、ライフプランの生成などのバッチ処理より優先する
+                async with llm_admission.slot(PROVIDER_OPENROUTER, INTERACTIVE):
+                    response = await llm.openrouter.chat.completions.create(
+                        model="openai/gpt-4o",
+                        messages=[
+                            {"role": "system", "content": system_prompt},
+                            {"role": "user", "content": user_prompt}
+                        ],
+                        max_tokens=1500,
+                        temperature=0.7
+                    )
+                
+                ai_response = response.choices[0].message.content
+                print(f"✅ LLM応答生成成功")
+                if ai_response:
+                    financial_chat_cache.store(cache_scope, user_message, ai_response)
             
             # チャット履歴を保存（オプション）
             chat_data = {
@@ -1863,8 +1883,8 @@ async def financial_chat(
             
             # 簡易的なチャット履歴保存
             try:
-                chat_cache = await load_json(f"data/financial_chat_{current_user.id}.json", [])
-                chat_cache.append(chat_data)
+                chat_cache = await load_json_snapshot(f"data/financial_chat_{current_user.id}.json", [])
+                chat_cache = list(chat_cache) + [chat_data]
                 # 最新20件のみ保持
                 if len(chat_cache) > 20:
                     chat_cache = chat_cache[-20:]
@@ -1872,11 +1892,12 @@ async def financial_chat(
             except Exception as e:
                 print(f"⚠️ チャット履歴保存失敗: {e}")
             
-            return JSONResponse(
+            return CodecJSONResponse(
                 content={
                     "success": True,
                     "chat_response": ai_response,
                     "has_context": strategy_data is not None or lifeplan_data is not None,
+                    "cached": cached is not None,
                     "context_info": {
                         "strategy_available": strategy_data is not None,
                         "lifeplan_available": lifeplan_data is not None,
@@ -1900,7 +1921,7 @@ async def financial_chat(
 
 詳細な分析については、システム管理者にお問い合わせいただくか、しばらく経ってから再度お試しください。"""
 
-            return JSONResponse(
+            return CodecJSONResponse(
                 content={
                     "success": True,
                     "chat_response": fallback_response,
@@ -1930,7 +1951,7 @@ async def get_financial_chat_history(
 ):
     """財務チャットの履歴を取得"""
     try:
-        chat_history = await load_json(f"data/financial_chat_{current_user.id}.json", [])
+        chat_history = await load_json_snapshot(f"data/financial_chat_{current_user.id}.json", [])
         
         # 最新10件のみ取得
         recent_history = chat_history[-10:] if len(chat_history) > 10 else chat_history
@@ -1948,7 +1969,7 @@ async def get_financial_chat_history(
             }
             formatted_history.append(formatted_msg)
         
-        return JSONResponse(
+        return CodecJSONResponse(
             content={
                 "success": True,
                 "history": formatted_history,
@@ -2000,7 +2021,7 @@ async def clear_financial_data(
         print(f"🗑️ 財務データクリア完了 - ユーザー: {current_user.username}")
         print(f"📁 クリア済みファイル: {len(cleared_files)}件")
         
-        return JSONResponse(
+        return CodecJSONResponse(
             content={
                 "success": True,
                 "message": "財務データがクリアされました",
@@ -1,6 +1,6 @@
 # api/promopt_router.py
 from fastapi import APIRouter, Request, HTTPException, Depends, Response, BackgroundTasks, status, Form 
-from fastapi.responses import JSONResponse, HTMLResponse, StreamingResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, StreamingResponse, RedirectResponse
 from fastapi.templating import Jinja2Templates
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
@@ -8,6 +8,7 @@ from sqlalchemy.future import select
 # モジュールとクラスのインポート
 from database import get_db, engine 
 from models.prompts import Prompt 
+from api.responses import CodecJSONResponse
 
 templates = Jinja2Templates(directory="templates")
 router = APIRouter()
@@ -92,7 +93,7 @@ async def get_prompts_api(db: AsyncSession = Depends(get_db)):
         result = await db.execute(select(Prompt))
         prompts = result.scalars().all()
         
-        return JSONResponse(content={
+        return CodecJSONResponse(content={
             "success": True,
             "prompts": [
                 {
@@ -105,7 +106,7 @@ async def get_prompts_api(db: AsyncSession = Depends(get_db)):
             ]
         })
     except Exception as e:
-        return JSONResponse(
+        return CodecJSONResponse(
             content={"success": False, "error": f"プロンプト取得エラー: {str(e)}"},
             status_code=500
         )
@@ -116,12 +117,12 @@ async def get_prompt_api(prompt_id: int, db: AsyncSession = Depends(get_db)):
     prompt = result.scalar_one_or_none()
 
     if not prompt:
-        return JSONResponse(
+        return CodecJSONResponse(
             content={"error": "プロンプトが見つかりません"},
             status_code=404
         )
     
-    return JSONResponse(content={
+    return CodecJSONResponse(content={
         "id": prompt.id,
         "name": prompt.name,
         "description": prompt.description,
@@ -153,7 +154,7 @@ async def select_prompt_api(request: Request, response: Response, db: AsyncSessi
         request.session["selected_prompt_id"] = str(prompt_id)
         request.session["selected_prompt_name"] = prompt.name
         
-        return JSONResponse(content={
+        return CodecJSONResponse(content={
             "success": True,
             "prompt_id": prompt_id,
             "prompt_name": prompt.name 
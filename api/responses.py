@@ -0,0 +1,18 @@
+# api/responses.py
+"""
+Webレイヤーのレスポンスクラス
+
+保存用のutils.json_codecがWebフレームワークに依存しないよう、レスポンスはここで定義する。
+"""
+from typing import Any
+
+from starlette.responses import JSONResponse
+
+from utils.json_codec import dumps_bytes
+
+
+class CodecJSONResponse(JSONResponse):
+    """utils.json_codecのエンコーダーでシリアライズするJSONResponse"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps_bytes(content)
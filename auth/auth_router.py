@@ -13,7 +13,7 @@ from auth.jwt_auth import (
   get_current_user,
   ACCESS_TOKEN_EXPIRE_MINUTES
 )
-from utils.chatroom_manager import ChatroomManager
+from utils.chatroom_manager import get_chatroom_manager
 import os
 
 DATA_DIR = "data"
@@ -21,7 +21,7 @@ MAX_RALLIES = 6
 
 os.makedirs(DATA_DIR, exist_ok=True)
 
-chatroom_manager = ChatroomManager(data_dir=DATA_DIR, max_rallies=MAX_RALLIES)
+chatroom_manager = get_chatroom_manager(data_dir=DATA_DIR, max_rallies=MAX_RALLIES)
 router = APIRouter()
 
 class RefreshTokenRequest(BaseModel):
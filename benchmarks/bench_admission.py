@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+LLMの呼び出しの流量制御（utils.admission）のベンチマーク
+プロバイダーは同時に CAPACITY 件までしか受け付けず、それを超えると429を返す疑似APIで置き換え、
+/financial/generate-lifeplan のバースト（BATCH_USERS 人がそれぞれ大きなFunction callingを2回）の最中に
+届いたチャット（interactive）の待ち時間と、429の回数を流量制御なし / ありで比較します
+
+流量制御なしの場合、429を受けた呼び出しは full jitter のバックオフでリトライします。
+時間は実際の値を TIME_SCALE 倍に縮めて実行し、表示では元の秒数に戻します。
+
+使用例: python -m benchmarks.bench_admission
+"""
+
+import asyncio
+import random
+import time
+
+from utils.admission import BATCH, INTERACTIVE, AdmissionController, set_admission_user
+
+TIME_SCALE = 0.01  # 1秒を10ミリ秒として実行する
+CAPACITY = 16  # プロバイダーが同時に受け付ける呼び出し
+BATCH_USERS = 20
+BATCH_SECONDS = 20.0  # ライフプランのFunction calling 1回の時間
+CHATS = 60
+CHAT_INTERVAL = 1.0  # チャットが届く間隔（秒）
+CHAT_SECONDS = 3.0  # チャットのストリーミングの時間
+MAX_RETRIES = 8
+
+
+class RateLimited(Exception):
+    pass
+
+
+class FakeProvider:
+    def __init__(self):
+        self.in_flight = 0
+        self.rate_limited = 0
+
+    async def call(self, seconds: float):
+        if self.in_flight >= CAPACITY:
+            self.rate_limited += 1
+            await asyncio.sleep(0.05 * TIME_SCALE)
+            raise RateLimited()
+        self.in_flight += 1
+        try:
+            await asyncio.sleep(seconds * TIME_SCALE)
+        finally:
+            self.in_flight -= 1
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+async def run(admission: bool, seed: int = 0):
+    rng = random.Random(seed)
+    provider = FakeProvider()
+    controller = AdmissionController(
+        enabled=admission, max_in_flight=CAPACITY, max_in_flight_per_user=4, timeout=600 * TIME_SCALE,
+        rates={"openrouter": (0, 0)}
+    )
+    chat_waits = []
+    failed = 0
+
+    async def call(user: str, task_class: str, seconds: float):
+        nonlocal failed
+        set_admission_user(user)
+        start = time.perf_counter()
+        for attempt in range(MAX_RETRIES):
+            try:
+                async with controller.slot("openrouter", task_class):
+                    waited = time.perf_counter() - start
+                    await provider.call(seconds)
+                if task_class == INTERACTIVE:
+                    chat_waits.append(waited / TIME_SCALE)
+                return
+            except RateLimited:
+                await asyncio.sleep(rng.uniform(0, min(30.0, 2 ** attempt)) * TIME_SCALE)
+        failed += 1
+
+    async def chats():
+        tasks = []
+        for i in range(CHATS):
+            tasks.append(asyncio.create_task(call(f"chat{i}", INTERACTIVE, CHAT_SECONDS)))
+            await asyncio.sleep(CHAT_INTERVAL * TIME_SCALE)
+        await asyncio.gather(*tasks)
+
+    batch = [call(f"plan{i}", BATCH, BATCH_SECONDS) for i in range(BATCH_USERS) for _ in range(2)]
+    await asyncio.gather(chats(), *batch)
+    return chat_waits, provider.rate_limited, failed, controller
+
+
+async def main():
+    print(f"{BATCH_USERS * 2} lifeplan calls + {CHATS} chats, provider capacity {CAPACITY}\n")
+    print(f"{'mode':<13} | {'chat wait p50':>13} | {'chat wait p95':>13} | {'429s':>5} | {'failed':>6}")
+    print("-" * 64)
+    for name, admission in (("no admission", False), ("admission", True)):
+        waits, rate_limited, failed, _ = await run(admission)
+        print(f"{name:<13} | {percentile(waits, 0.5):>11.2f} s | {percentile(waits, 0.95):>11.2f} s | {rate_limited:>5} | {failed:>6}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Anthropicのストリーミング（AIStreamClient._stream_anthropic）が他のリクエストを止めないかのベンチマーク
+別スレッドでAnthropic互換の疑似サーバー（/v1/messages、SSEでゆっくりトークンを返す）を立て、
+遅いストリームを流している間に同じイベントループで処理される短いリクエストのレイテンシを比較します
+
+- sync client: 以前の実装（同期の anthropic.Anthropic を async ジェネレータ内で読む）
+- async client: AsyncAnthropic（現在の実装）
+
+短いリクエストは5ミリ秒で終わる処理を模したもので、イベントループが止まるとその分だけ遅れます。
+
+使用例: python -m benchmarks.bench_anthropic_stream
+"""
+
+import asyncio
+import contextlib
+import io
+import threading
+import time
+
+import anthropic
+
+from utils import json_codec
+from utils.ai_stream_client import AIStreamClient
+
+SLOW_STREAMS = 2
+STREAM_TOKENS = 40
+TOKEN_INTERVAL = 0.05  # 遅いストリームのトークンの間隔（秒）
+PROBE_WORK = 0.005  # 短いリクエスト1件の処理時間（秒）
+
+
+def _event(name: str, data: dict) -> bytes:
+    return f"event: {name}\ndata: ".encode() + json_codec.dumps_bytes(data) + b"\n\n"
+
+
+class MockAnthropicServer:
+    """別スレッドのイベントループで動く、ストリーミング専用のAnthropic互換サーバー"""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.ready = threading.Event()
+        self.base_url = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self) -> str:
+        self.thread.start()
+        self.ready.wait()
+        return self.base_url
+
+    def stop(self) -> None:
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    def _run(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        server = self.loop.run_until_complete(asyncio.start_server(self._handle, "127.0.0.1", 0))
+        self.base_url = f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}"
+        self.ready.set()
+        self.loop.run_forever()
+        server.close()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+            for line in head.split(b"\r\n"):
+                if line.lower().startswith(b"content-length:"):
+                    await reader.readexactly(int(line.split(b":", 1)[1]))
+            writer.write(b"HTTP/1.1 200 OK\r\ncontent-type: text/event-stream\r\nconnection: close\r\n\r\n")
+            writer.write(_event("message_start", {"type": "message_start", "message": {
+                "id": "msg_bench", "type": "message", "role": "assistant", "content": [], "model": "bench",
+                "stop_reason": None, "stop_sequence": None, "usage": {"input_tokens": 10, "output_tokens": 1}}}))
+            writer.write(_event("content_block_start", {"type": "content_block_start", "index": 0,
+                                                        "content_block": {"type": "text", "text": ""}}))
+            for _ in range(STREAM_TOKENS):
+                await asyncio.sleep(TOKEN_INTERVAL)
+                writer.write(_event("content_block_delta", {"type": "content_block_delta", "index": 0,
+                                                            "delta": {"type": "text_delta", "text": "あ"}}))
+                await writer.drain()
+            writer.write(_event("content_block_stop", {"type": "content_block_stop", "index": 0}))
+            writer.write(_event("message_delta", {"type": "message_delta", "delta": {"stop_reason": "end_turn",
+                         "stop_sequence": None}, "usage": {"output_tokens": STREAM_TOKENS}}))
+            writer.write(_event("message_stop", {"type": "message_stop"}))
+            await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+async def legacy_stream(client: anthropic.Anthropic, user_input: str, system_prompt: str):
+    """以前の _stream_anthropic（同期クライアントの messages.stream を async ジェネレータ内で読む）"""
+    with client.messages.stream(
+        model="bench",
+        max_tokens=4000,
+        system=system_prompt,
+        messages=[{"role": "user", "content": user_input}]
+    ) as stream:
+        for text in stream.text_stream:
+            yield text
+
+
+async def consume(texts) -> int:
+    count = 0
+    async for _ in texts:
+        count += 1
+    return count
+
+
+async def probe(stop: asyncio.Event, latencies: list) -> None:
+    """短いリクエストを繰り返し、それぞれの処理にかかった時間を記録する"""
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(PROBE_WORK)
+        latencies.append(time.perf_counter() - start)
+
+
+async def run(make_stream):
+    latencies = []
+    stop = asyncio.Event()
+    probe_task = asyncio.create_task(probe(stop, latencies))
+    start = time.perf_counter()
+    counts = await asyncio.gather(*(consume(make_stream()) for _ in range(SLOW_STREAMS)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await probe_task
+    return latencies, elapsed, sum(counts)
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+async def main():
+    server = MockAnthropicServer()
+    base_url = server.start()
+    sync_client = anthropic.Anthropic(api_key="bench", base_url=base_url, max_retries=0)
+    async_client = anthropic.AsyncAnthropic(api_key="bench", base_url=base_url, max_retries=0)
+    stream_client = AIStreamClient(anthropic_client=async_client)
+    modes = {
+        "sync client": lambda: legacy_stream(sync_client, "こんにちは", "bench"),
+        "async client": lambda: stream_client.stream_response("こんにちは", "bench", provider="anthropic", model="bench"),
+    }
+
+    print(f"{SLOW_STREAMS} slow streams x {STREAM_TOKENS} tokens every {TOKEN_INTERVAL * 1000:.0f} ms, "
+          f"probe requests take {PROBE_WORK * 1000:.0f} ms\n")
+    print(f"{'mode':<13} | {'streams':>8} | {'probes':>6} | {'probe p50':>10} | {'probe p95':>10} | {'probe max':>10}")
+    print("-" * 74)
+    for name, make_stream in modes.items():
+        # _stream_anthropic はトークンを標準出力に表示するため、計測中は捨てる
+        with contextlib.redirect_stdout(io.StringIO()):
+            latencies, elapsed, tokens = await run(make_stream)
+        print(f"{name:<13} | {elapsed:>6.2f} s | {len(latencies):>6} | {percentile(latencies, 0.5) * 1000:>7.1f} ms "
+              f"| {percentile(latencies, 0.95) * 1000:>7.1f} ms | {max(latencies) * 1000:>7.1f} ms")
+    await async_client.close()
+    sync_client.close()
+    server.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
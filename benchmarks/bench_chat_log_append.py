@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+チャットログ追記のベンチマーク
+従来のJSON配列（全体書き換え）とJSONL（追記専用）で1ターンあたりのレイテンシを比較します
+write-behind列はレスポンス経路で待つ時間（フラッシュはバックグラウンド）です
+
+使用例: python -m benchmarks.bench_chat_log_append
+"""
+
+import asyncio
+import os
+import tempfile
+import time
+from datetime import datetime
+
+from utils.chatroom_manager import ChatroomManager
+from utils.file_operations import clear_cache
+from utils.jsonl_log import append_jsonl
+from utils.file_operations import save_json
+
+HISTORY_SIZES = [10, 1_000, 50_000]
+TURNS = 20
+
+
+def make_message(i: int) -> dict:
+    return {
+        "role": "user" if i % 2 == 0 else "assistant",
+        "content": "老後資金の準備について、iDeCoと新NISAのどちらを優先すべきか教えてください。" * 2,
+        "user_id": "bench-user",
+        "timestamp": datetime.now().isoformat()
+    }
+
+
+async def seed(manager: ChatroomManager, user_id: str, size: int) -> None:
+    """指定件数の履歴を事前に作成"""
+    files = await manager.get_user_files(user_id)
+    history = [make_message(i) for i in range(size)]
+    if manager.append_only:
+        await append_jsonl(files["chat_log"], history)
+        await append_jsonl(files["thread_history"], history)
+    else:
+        await save_json(files["chat_log"], history)
+        await save_json(files["thread_history"], history)
+
+
+async def bench_turn(manager: ChatroomManager, user_id: str) -> float:
+    """1ターン分の書き込み（add_message / add_thread ×2）の平均時間（ミリ秒）"""
+    start = time.perf_counter()
+    for i in range(TURNS):
+        await manager.add_message(user_id, make_message(i))
+        await manager.add_thread(user_id, make_message(i))
+        await manager.add_message(user_id, make_message(i + 1))
+        await manager.add_thread(user_id, make_message(i + 1))
+        manager.end_turn(user_id)
+    elapsed = time.perf_counter() - start
+    await manager.flush_all()
+    return elapsed / TURNS * 1000
+
+
+async def main():
+    print(f"{'messages':>10} | {'json (ms/turn)':>15} | {'jsonl (ms/turn)':>15} | {'write-behind (ms/turn)':>22}")
+    print("-" * 72)
+    variants = {
+        "json": ("json", False),
+        "jsonl": ("jsonl", False),
+        "write-behind": ("jsonl", True)
+    }
+    for size in HISTORY_SIZES:
+        results = {}
+        for name, (mode, write_behind) in variants.items():
+            with tempfile.TemporaryDirectory() as data_dir:
+                clear_cache()
+                manager = ChatroomManager(data_dir=data_dir, storage_mode=mode, write_behind=write_behind)
+                user_id = f"bench-{name}-{size}"
+                await seed(manager, user_id, size)
+                await manager.get_or_create_chatroom(user_id)
+                results[name] = await bench_turn(manager, user_id)
+        print(f"{size:>10} | {results['json']:>15.2f} | {results['jsonl']:>15.2f} | {results['write-behind']:>22.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
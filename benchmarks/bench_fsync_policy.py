@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+fsyncポリシーごとの書き込みスループットのベンチマーク
+save_json（アトミック書き込み）とappend_jsonl（追記）を none / batch / always で比較します
+
+使用例: python -m benchmarks.bench_fsync_policy
+"""
+
+import asyncio
+import os
+import tempfile
+import time
+
+from utils import file_operations
+from utils.file_operations import save_json
+from utils.jsonl_log import append_jsonl
+
+WRITES = 200
+
+USER_HISTORY = {
+    "bench-user": {
+        "created_at": "2025-04-22T01:15:20.015746",
+        "messages": [
+            [
+                {"role": "user", "type": "質問", "content": "教育資金の準備方法について相談したい"},
+                {"role": "assistant", "type": "提案", "content": "学資保険と投資信託の組み合わせを提案"}
+            ]
+        ] * 6
+    }
+}
+
+MESSAGE = {"role": "assistant", "content": "新NISAのつみたて投資枠を活用し、毎月3万円の積立をご提案します。" * 4}
+
+
+async def bench(policy: str, data_dir: str) -> dict:
+    file_operations.FSYNC_POLICY = policy
+    json_path = os.path.join(data_dir, f"user_history_{policy}.json")
+    jsonl_path = os.path.join(data_dir, f"chat_log_{policy}.jsonl")
+
+    start = time.perf_counter()
+    for _ in range(WRITES):
+        await save_json(json_path, USER_HISTORY)
+    json_rate = WRITES / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for _ in range(WRITES):
+        await append_jsonl(jsonl_path, [MESSAGE])
+    jsonl_rate = WRITES / (time.perf_counter() - start)
+    return {"save_json": json_rate, "append_jsonl": jsonl_rate}
+
+
+async def main():
+    print(f"{'policy':>8} | {'save_json (writes/s)':>21} | {'append_jsonl (writes/s)':>24}")
+    print("-" * 60)
+    for policy in ("none", "batch", "always"):
+        with tempfile.TemporaryDirectory() as data_dir:
+            result = await bench(policy, data_dir)
+        print(f"{policy:>8} | {result['save_json']:>21.0f} | {result['append_jsonl']:>24.0f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+最初のトークンが遅いストリームのヘッジ（utils.hedging）のベンチマーク
+上流は疑似ストリームで置き換え、主モデルはときどき止まる（STALL_RATE の割合で最初のトークンまで
+STALL_SECONDS 秒）ものとして、ヘッジなしとヘッジあり（期限はTTFTのパーセンタイル）の
+TTFTのp50 / p95 / p99、ヘッジした割合・勝った回数・余分に送ったプロンプトの量を比較します
+
+時間は実際の値を TIME_SCALE 倍に縮めて実行し、表示では元の秒数に戻します。
+
+使用例: python -m benchmarks.bench_hedging
+"""
+
+import asyncio
+import random
+import time
+
+from utils.hedging import HedgeMetrics, TTFTTracker, hedged_stream
+
+REQUESTS = 400
+CONCURRENCY = 20
+TIME_SCALE = 0.01  # 1秒を10ミリ秒として実行する
+PRIMARY_TTFT = (0.5, 1.2)  # 主モデルの通常のTTFT（秒、一様分布）
+STALL_RATE = 0.03
+STALL_SECONDS = 12.0
+BACKUP_TTFT = (0.8, 1.6)  # フォールバック先のモデルのTTFT（秒）
+TOKENS = 5
+PROMPT_CHARS = 3000
+
+
+async def fake_stream(ttft: float, tracker: TTFTTracker = None):
+    await asyncio.sleep(ttft * TIME_SCALE)
+    if tracker is not None:
+        # 実装（FirstTokenTimer）と同じく、最初のトークンを返したときだけTTFTを記録する
+        tracker.record("primary", ttft * TIME_SCALE)
+    for _ in range(TOKENS):
+        yield "あ"
+        await asyncio.sleep(0.02 * TIME_SCALE)
+
+
+def primary_ttft(rng: random.Random) -> float:
+    if rng.random() < STALL_RATE:
+        return STALL_SECONDS
+    return rng.uniform(*PRIMARY_TTFT)
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+async def run(hedge: bool, seed: int = 0):
+    rng = random.Random(seed)
+    tracker = TTFTTracker()
+    metrics = HedgeMetrics()
+    ttfts = []
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    async def one():
+        async with semaphore:
+            primary, backup = primary_ttft(rng), rng.uniform(*BACKUP_TTFT)
+            start = time.perf_counter()
+            if hedge:
+                # 期限は主モデルのTTFTの記録から決める
+                stream = hedged_stream(
+                    lambda: fake_stream(primary, tracker),
+                    lambda: fake_stream(backup),
+                    tracker.deadline("primary", min_delay=1.0 * TIME_SCALE, max_delay=8.0 * TIME_SCALE,
+                                     default_delay=3.0 * TIME_SCALE),
+                    hedge_cost=PROMPT_CHARS,
+                    metrics=metrics
+                )
+            else:
+                stream = fake_stream(primary, tracker)
+            first = None
+            async for _ in stream:
+                if first is None:
+                    first = time.perf_counter() - start
+            ttfts.append(first / TIME_SCALE)
+
+    await asyncio.gather(*(one() for _ in range(REQUESTS)))
+    return ttfts, metrics
+
+
+async def main():
+    print(f"{REQUESTS} requests, primary stalls {STALL_RATE * 100:.0f}% of the time for {STALL_SECONDS:.0f}s\n")
+    print(f"{'mode':<10} | {'TTFT p50':>9} | {'TTFT p95':>9} | {'TTFT p99':>9} | {'hedged':>7} | {'hedge wins':>10} | {'extra prompt':>12}")
+    print("-" * 88)
+    for name, hedge in (("no hedge", False), ("hedge p95", True)):
+        ttfts, metrics = await run(hedge)
+        stats = metrics.to_dict()
+        print(f"{name:<10} | {percentile(ttfts, 0.5):>7.2f} s | {percentile(ttfts, 0.95):>7.2f} s | {percentile(ttfts, 0.99):>7.2f} s "
+              f"| {stats['hedge_rate'] * 100:>6.1f}% | {stats['hedge_wins']:>10} | {stats['extra_prompt_chars'] / (REQUESTS * PROMPT_CHARS) * 100:>11.1f}%")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
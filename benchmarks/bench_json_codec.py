@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+JSONコーデックのベンチマーク
+65年分のライフプラン（years_data）と長いチャットログを、以前の実装（標準json・indent=2）と
+utils.json_codec（orjsonがあればorjson、コンパクト出力）でエンコード・デコードして比較します
+
+使用例: python -m benchmarks.bench_json_codec
+"""
+
+import json
+import time
+
+from utils import json_codec
+from utils.snapshot import freeze, json_default
+
+ITERATIONS = 50
+CHAT_MESSAGES = 5000
+
+
+def build_years_data(years: int = 65) -> dict:
+    """financial_routesのライフプラン計算と同じ形のデータ"""
+    years_data = []
+    cash_balance = 3_000_000
+    for i in range(years):
+        total_income = 6_500_000 if i < 25 else 2_400_000
+        total_expense = 5_200_000 - i * 10_000
+        cash_balance += total_income - total_expense
+        years_data.append({
+            "year": 2025 + i,
+            "primary_age": 35 + i,
+            "spouse_age": 33 + i,
+            "child1_age": 3 + i if i < 20 else None,
+            "child2_age": 1 + i if i < 22 else None,
+            "total_income": total_income,
+            "primary_income": total_income - 1_500_000 if i < 25 else 0,
+            "primary_pension": 0 if i < 30 else 1_800_000,
+            "spouse_income": 1_500_000 if i < 25 else 600_000,
+            "home_loan_deduction": 200_000 if i < 13 else 0,
+            "total_expense": total_expense,
+            "living_expenses": 3_000_000,
+            "housing_expenses": 300_000,
+            "loan_repayment": 1_200_000 if i < 35 else 0,
+            "insurance_total": 360_000,
+            "life_insurance": 120_000,
+            "endowment_insurance": 120_000,
+            "ideco_contribution": 120_000,
+            "vehicle_expenses": 400_000,
+            "hobby_lessons": 0,
+            "tax_expenses": 1_950_000,
+            "child_education": 800_000 if i < 22 else None,
+            "home_renovation": 2_000_000 if i % 15 == 14 else None,
+            "travel_expenses": 300_000,
+            "annual_balance": total_income - total_expense,
+            "cash_balance": cash_balance
+        })
+    return {
+        "customer_id": "C001",
+        "advisor_type": "lifeplan",
+        "analysis": "老後資金は65歳時点で約2,400万円の見込みです。教育費のピークに備えて現金比率を高めることをお勧めします。",
+        "years_data": years_data
+    }
+
+
+def build_chat_log(messages: int = CHAT_MESSAGES) -> list:
+    log = []
+    for i in range(messages):
+        log.append({"role": "user", "content": f"質問{i}: 新NISAと iDeCo はどちらを優先すべきですか？"})
+        log.append({"role": "assistant", "content": "まずはiDeCoで所得控除を受け、残りを新NISAのつみたて投資枠に回すのがおすすめです。" * 3})
+    return log
+
+
+def stdlib_dumps(data):
+    """以前の保存形式（indent=2）"""
+    return json.dumps(data, indent=2, ensure_ascii=False, default=json_default)
+
+
+def timeit(func, *args) -> float:
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        func(*args)
+    return (time.perf_counter() - start) / ITERATIONS * 1000
+
+
+def bench(name: str, data) -> None:
+    frozen = freeze(data)
+    old_text = stdlib_dumps(data)
+    new_bytes = json_codec.dumps_bytes(data)
+    rows = [
+        ("dumps (dict/list)", timeit(stdlib_dumps, data), timeit(json_codec.dumps_bytes, data)),
+        ("dumps (snapshot)", timeit(stdlib_dumps, frozen), timeit(json_codec.dumps_bytes, frozen)),
+        ("loads", timeit(json.loads, old_text), timeit(json_codec.loads, new_bytes)),
+    ]
+    print(f"\n{name}: {len(old_text.encode('utf-8')):,} bytes -> {len(new_bytes):,} bytes")
+    for label, old_ms, new_ms in rows:
+        print(f"  {label:<18} | json(indent=2) {old_ms:8.3f} ms | {json_codec.BACKEND:<6} {new_ms:8.3f} ms | x{old_ms / new_ms:5.1f}")
+
+
+def main():
+    print(f"backend: {json_codec.BACKEND}")
+    bench("years_data (65 years)", build_years_data())
+    bench(f"chat log ({CHAT_MESSAGES * 2} messages)", build_chat_log())
+
+
+if __name__ == "__main__":
+    main()
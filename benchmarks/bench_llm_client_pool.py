@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+LLMクライアントの共有コネクションプール（utils.llm_clients）のベンチマーク
+ローカルにOpenAI互換の疑似サーバー（/chat/completions）を立て、以前の実装のように
+リクエストごとに新しいクライアント（＝新しい接続）を使う場合と、共有のプールを使い回す場合の
+レイテンシ（p50 / p95）と新規接続数を比較します
+
+- 疑似サーバーはopensslコマンドがあれば自己署名証明書でTLSを張ります（なければHTTP）
+- ネットワークの往復時間は --rtt-ms で模擬します（新しい接続にはTCP + TLSの2往復分を上乗せ）
+
+使用例: python -m benchmarks.bench_llm_client_pool [--rtt-ms 20] [--requests 200] [--concurrency 10]
+"""
+
+import asyncio
+import os
+import shutil
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from utils import json_codec
+from utils.llm_clients import LLMClients
+
+RTT_MS = 20.0
+REQUESTS = 200
+CONCURRENCY = 10
+
+COMPLETION = json_codec.dumps_bytes({
+    "id": "chatcmpl-bench",
+    "object": "chat.completion",
+    "created": 0,
+    "model": "bench/mock",
+    "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "こんにちは"}}],
+    "usage": {"prompt_tokens": 10, "completion_tokens": 2, "total_tokens": 12}
+})
+
+
+def make_ssl_contexts(workdir: str):
+    """自己署名証明書を作成してサーバー用・クライアント用のSSLContextを返す（opensslがなければNone）"""
+    if shutil.which("openssl") is None:
+        return None, None
+    cert, key = os.path.join(workdir, "cert.pem"), os.path.join(workdir, "key.pem")
+    result = subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+         "-subj", "/CN=127.0.0.1", "-addext", "subjectAltName=IP:127.0.0.1",
+         "-keyout", key, "-out", cert],
+        capture_output=True
+    )
+    if result.returncode != 0:
+        return None, None
+    server_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    server_context.load_cert_chain(cert, key)
+    client_context = ssl.create_default_context(cafile=cert)
+    return server_context, client_context
+
+
+class MockServer:
+    """Keep-Aliveに対応した最小限のOpenAI互換サーバー"""
+
+    def __init__(self, rtt: float, ssl_context=None):
+        self.rtt = rtt
+        self.ssl_context = ssl_context
+        self.connections = 0
+        self.server = None
+
+    async def start(self) -> str:
+        self.server = await asyncio.start_server(self._handle, "127.0.0.1", 0, ssl=self.ssl_context)
+        port = self.server.sockets[0].getsockname()[1]
+        return f"{'https' if self.ssl_context else 'http'}://127.0.0.1:{port}/v1"
+
+    async def close(self) -> None:
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.connections += 1
+        # 新しい接続: TCPの3ウェイハンドシェイクとTLSハンドシェイクの往復分
+        await asyncio.sleep(self.rtt * 2)
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                length = 0
+                for line in head.split(b"\r\n"):
+                    if line.lower().startswith(b"content-length:"):
+                        length = int(line.split(b":", 1)[1])
+                if length:
+                    await reader.readexactly(length)
+                # リクエストとレスポンスの往復分
+                await asyncio.sleep(self.rtt)
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\ncontent-type: application/json\r\n"
+                    b"content-length: " + str(len(COMPLETION)).encode() + b"\r\n\r\n" + COMPLETION
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+async def run(mode: str, base_url: str, client_ssl, requests: int, concurrency: int):
+    """modeごとにリクエストを送り、(レイテンシのリスト, 新規接続数) を返す"""
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    shared = None
+    if mode == "shared":
+        shared = LLMClients(openrouter_api_key="bench", openrouter_base_url=base_url, http2=False, limits=limits,
+                            verify=client_ssl or True)
+    latencies, connects = [], 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        nonlocal connects
+        async with semaphore:
+            start = time.perf_counter()
+            if shared is not None:
+                clients = shared
+            else:
+                # 以前の実装: モジュール・インスタンスごとにクライアントがあり、接続を使い回せない
+                clients = LLMClients(openrouter_api_key="bench", openrouter_base_url=base_url, http2=False, limits=limits,
+                                     verify=client_ssl or True)
+            try:
+                await clients.openrouter.chat.completions.create(
+                    model="bench/mock", messages=[{"role": "user", "content": "こんにちは"}]
+                )
+            finally:
+                if shared is None:
+                    connects += clients.metrics.connects
+                    await clients.aclose()
+            latencies.append(time.perf_counter() - start)
+
+    if shared is not None:
+        # lifespanのウォームアップと同じく、あらかじめ接続を張っておく
+        await shared.warm_up(base_url)
+    await asyncio.gather(*(one() for _ in range(requests)))
+    if shared is not None:
+        connects = shared.metrics.connects
+        await shared.aclose()
+    return latencies, connects
+
+
+async def main(rtt_ms: float, requests: int, concurrency: int):
+    with tempfile.TemporaryDirectory() as workdir:
+        server_ssl, client_ssl = make_ssl_contexts(workdir)
+        server = MockServer(rtt_ms / 1000, server_ssl)
+        base_url = await server.start()
+        print(f"mock server {base_url} (rtt {rtt_ms:.0f} ms, {requests} requests, concurrency {concurrency})\n")
+        print(f"{'mode':<18} | {'p50':>9} | {'p95':>9} | {'total':>8} | {'new connections':>15}")
+        print("-" * 72)
+        for mode, name in (("cold", "client per request"), ("shared", "shared pool")):
+            start = time.perf_counter()
+            latencies, connects = await run(mode, base_url, client_ssl, requests, concurrency)
+            total = time.perf_counter() - start
+            print(f"{name:<18} | {percentile(latencies, 0.5) * 1000:>6.1f} ms | {percentile(latencies, 0.95) * 1000:>6.1f} ms "
+                  f"| {total:>6.2f} s | {connects:>15}")
+        await server.close()
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    options = {"--rtt-ms": RTT_MS, "--requests": REQUESTS, "--concurrency": CONCURRENCY}
+    for i, arg in enumerate(args):
+        if arg in options and i + 1 < len(args):
+            options[arg] = type(options[arg])(args[i + 1])
+    asyncio.run(main(options["--rtt-ms"], options["--requests"], options["--concurrency"]))
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+財務チャットのセマンティックキャッシュ（utils.semantic_cache）のベンチマーク
+テンプレートから作った質問を ENTRIES 件登録し、言い換えた質問（ヒットするはず）と
+新しい質問（ヒットしないはず）の検索時間の p50 / p95 / p99 とヒット率を表示します
+
+- 多数のユーザー: USERS 人に均等に登録（実際の使われ方に近い）
+- 1つのスコープ: 全件を1人のユーザー・1つの文脈に登録（索引の最悪の場合）
+  比較として、文字n-gramの転置索引（SEMANTIC_CACHE_MATCH_TERMS=false）と、
+  スコープ内の全件と類似度を計算する線形探索の時間も表示します
+
+使用例: python -m benchmarks.bench_semantic_cache [件数]
+"""
+
+import random
+import sys
+import time
+
+from utils.semantic_cache import SemanticCache, cosine, vectorize
+
+ENTRIES = 100_000
+USERS = 1000
+QUERIES = 2000
+SLOW_QUERIES = 100  # 文字n-gramの転置索引・線形探索の場合のクエリ数
+
+TOPICS = [
+    "老後資金", "教育費", "住宅ローン", "NISA", "iDeCo", "生命保険", "医療保険", "年金", "退職金", "相続税",
+    "贈与税", "株式投資", "投資信託", "外貨預金", "不動産投資", "自動車ローン", "生活費", "貯蓄", "緊急資金", "ふるさと納税",
+]
+SUBJECTS = ["夫婦", "子供", "両親", "自分", "妻", "夫", "家族", "孫"]
+ASKS = [
+    ("{subject}の{topic}は{amount}万円で足りますか", "{subject}の{topic}って{amount}万円で足りる？"),
+    ("{topic}を{amount}万円増やすべきですか", "{topic}は{amount}万円増やすべき？"),
+    ("{age}歳から{topic}を始めるべきですか", "{age}歳で{topic}を始めるべき？"),
+    ("{subject}のために{topic}をどう準備すれば良いですか", "{subject}のための{topic}はどう準備すれば良い？"),
+    ("{topic}の見直しは{age}歳までに必要ですか", "{age}歳までに{topic}の見直しは必要？"),
+]
+
+
+def make_question(rng: random.Random):
+    template = rng.choice(ASKS)
+    params = dict(
+        topic=rng.choice(TOPICS), subject=rng.choice(SUBJECTS),
+        amount=rng.randrange(10, 5000, 10), age=rng.randrange(25, 70)
+    )
+    return template[0].format(**params), template[1].format(**params)
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+def run(name: str, entries: int, users: int, rng: random.Random, match_terms: bool = True, queries: int = QUERIES):
+    cache = SemanticCache(max_entries=entries, match_terms=match_terms)
+    stored = []
+    start = time.perf_counter()
+    for i in range(entries):
+        scope = f"user{i % users}:v1"
+        question, paraphrase = make_question(rng)
+        cache.store(scope, question, f"answer {i}")
+        stored.append((scope, paraphrase, f"answer {i}"))
+    build = time.perf_counter() - start
+
+    hit_times, miss_times = [], []
+    served = 0
+    for _ in range(queries):
+        scope, paraphrase, _ = rng.choice(stored)
+        start = time.perf_counter()
+        hit = cache.lookup(scope, paraphrase)
+        hit_times.append(time.perf_counter() - start)
+        if hit is not None:
+            served += 1
+    false_hits = 0
+    for _ in range(queries):
+        scope = f"user{rng.randrange(users)}:v1"
+        # 登録していない話題の質問
+        question = f"{rng.choice(SUBJECTS)}の{rng.choice(['海外旅行', '結婚式', '留学'])}の費用は{rng.randrange(10, 999)}万円で大丈夫ですか"
+        start = time.perf_counter()
+        if cache.lookup(scope, question) is not None:
+            false_hits += 1
+        miss_times.append(time.perf_counter() - start)
+
+    print(f"\n[{name}{'' if match_terms else ', n-gram index'}] {entries:,} entries in {users:,} scopes (build {build:.1f} s)")
+    print(f"{'query':<12} | {'p50':>9} | {'p95':>9} | {'p99':>9} | result")
+    print("-" * 64)
+    print(f"{'paraphrase':<12} | {percentile(hit_times, 0.5) * 1000:>6.3f} ms | {percentile(hit_times, 0.95) * 1000:>6.3f} ms "
+          f"| {percentile(hit_times, 0.99) * 1000:>6.3f} ms | {served / queries * 100:.1f}% served from cache")
+    print(f"{'new topic':<12} | {percentile(miss_times, 0.5) * 1000:>6.3f} ms | {percentile(miss_times, 0.95) * 1000:>6.3f} ms "
+          f"| {percentile(miss_times, 0.99) * 1000:>6.3f} ms | {false_hits} false hits")
+    print(f"avg candidates per lookup: {cache.snapshot()['avg_candidates']}")
+    return cache, stored
+
+
+def brute_force(cache: SemanticCache, stored, rng: random.Random):
+    """スコープ内の全件と類似度を計算した場合の時間"""
+    vectors = [entry.vector for entry in cache._entries.values()]
+    times = []
+    for _ in range(SLOW_QUERIES):
+        _, paraphrase, _ = rng.choice(stored)
+        start = time.perf_counter()
+        query = vectorize(paraphrase)
+        max(cosine(query, vector) for vector in vectors)
+        times.append(time.perf_counter() - start)
+    print(f"{'linear scan':<12} | {percentile(times, 0.5) * 1000:>6.1f} ms | {percentile(times, 0.95) * 1000:>6.1f} ms |")
+
+
+def main():
+    entries = int(sys.argv[1]) if len(sys.argv) > 1 else ENTRIES
+    rng = random.Random(0)
+    run("many users", entries, USERS, rng)
+    run("single scope", entries, 1, rng)
+    # 内容を表す語で分けない場合（文字n-gramの転置索引）と、全件との線形探索
+    cache, stored = run("single scope", entries, 1, rng, match_terms=False, queries=SLOW_QUERIES)
+    brute_force(cache, stored, rng)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+SSEの差分まとめ（coalesce_text）のベンチマーク
+500本の同時ストリームをStarletteのStreamingResponseに流し、差分ごとに送る場合と
+まとめて送る場合でフレーム数・フレーム/秒・ストリームあたりのCPU時間・TTFTを比較します
+
+上流は1〜3文字の差分を一定間隔で返す疑似ストリーム（OpenRouterの代わり）です。
+レスポンスはuvicornと同じくチャンク形式でソケット（socketpair）に書き込みます。
+CPU時間には疑似上流のタイマー処理も含まれます（どのモードでも同じ）。
+
+使用例: python -m benchmarks.bench_sse_coalescing
+"""
+
+import asyncio
+import random
+import socket
+import time
+
+from starlette.responses import StreamingResponse
+
+from utils.sse import SSEEncoder
+from utils.stream_coalescer import coalesce_text
+
+STREAMS = 500
+DELTAS_PER_STREAM = 200
+DELTA_INTERVAL = 0.02  # 上流の差分の間隔（秒）
+ANSWER_CHARS = "新NISAのつみたて投資枠を活用し、毎月3万円の積立をご提案します。教育資金と老後資金を分けて考えましょう。"
+
+
+async def fake_upstream(seed: int):
+    rng = random.Random(seed)
+    await asyncio.sleep(rng.uniform(0, DELTA_INTERVAL))
+    for _ in range(DELTAS_PER_STREAM):
+        await asyncio.sleep(DELTA_INTERVAL)
+        start = rng.randrange(len(ANSWER_CHARS) - 3)
+        yield ANSWER_CHARS[start:start + rng.randint(1, 3)]
+
+
+async def run_stream(seed: int, interval_ms: float, stats: dict) -> None:
+
+    async def generate():
+        sse = SSEEncoder()
+        async for text in coalesce_text(fake_upstream(seed), interval_ms=interval_ms):
+            yield sse.text(text)
+        yield sse.done()
+
+    first_body = True
+    server_sock, client_sock = socket.socketpair()
+    # クライアント側は読まないので、1回答分が収まる送受信バッファにしておく
+    client_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+    _, writer = await asyncio.open_connection(sock=server_sock)
+
+    async def send(message):
+        nonlocal first_body
+        if message["type"] == "http.response.body" and message.get("body"):
+            body = message["body"]
+            writer.write(b"".join((b"%x\r\n" % len(body), body, b"\r\n")))
+            await writer.drain()
+            stats["frames"] += 1
+            stats["bytes"] += len(body)
+            if first_body:
+                first_body = False
+                stats["ttft"].append(time.perf_counter() - started)
+
+    disconnect = asyncio.Event()
+
+    async def receive():
+        await disconnect.wait()
+        return {"type": "http.disconnect"}
+
+    started = time.perf_counter()
+    scope = {"type": "http", "asgi": {"version": "3.0", "spec_version": "2.4"}, "method": "GET", "headers": []}
+    response = StreamingResponse(generate(), media_type="text/event-stream")
+    try:
+        await response(scope, receive, send)
+    finally:
+        writer.close()
+        client_sock.close()
+
+
+async def bench(interval_ms: float) -> dict:
+    stats = {"frames": 0, "bytes": 0, "ttft": []}
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    await asyncio.gather(*(run_stream(seed, interval_ms, stats) for seed in range(STREAMS)))
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    return {
+        "frames": stats["frames"],
+        "frames_per_sec": stats["frames"] / wall,
+        "cpu_ms_per_stream": cpu / STREAMS * 1000,
+        "ttft_ms": sum(stats["ttft"]) / len(stats["ttft"]) * 1000,
+        "wall": wall
+    }
+
+
+async def main():
+    print(f"{STREAMS} streams x {DELTAS_PER_STREAM} deltas ({DELTA_INTERVAL * 1000:.0f} ms apart)\n")
+    print(f"{'mode':<18} | {'frames':>8} | {'frames/s':>9} | {'CPU/stream':>10} | {'avg TTFT':>9} | {'wall':>6}")
+    print("-" * 78)
+    for label, interval_ms in (("per delta", 0), ("coalesce 20 ms", 20), ("coalesce 40 ms", 40), ("coalesce 100 ms", 100)):
+        result = await bench(interval_ms)
+        print(
+            f"{label:<18} | {result['frames']:>8,} | {result['frames_per_sec']:>9,.0f} | "
+            f"{result['cpu_ms_per_stream']:>7.1f} ms | {result['ttft_ms']:>6.1f} ms | {result['wall']:>5.1f}s"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
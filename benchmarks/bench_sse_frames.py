@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+SSEフレームのバイト数・エンコード時間のベンチマーク
+典型的な日本語の金融アドバイスを1〜3文字ずつの差分に分け、以前の形式
+（json.dumps + ensure_ascii=True）とSSEEncoderの各設定で比較します
+
+使用例: python -m benchmarks.bench_sse_frames
+"""
+
+import json
+import random
+import time
+
+from utils.sse import SSEEncoder
+
+ITERATIONS = 200
+
+ANSWER = """## ご提案の概要
+
+お客様（35歳・会社員、配偶者と子ども2人）の家計を拝見すると、毎月の貯蓄額は約8万円で、現在の預貯金は300万円です。
+教育費のピークは15年後に訪れるため、それまでに**教育資金として約1,200万円**を準備することをお勧めします。
+
+### 1. 新NISAの活用
+- つみたて投資枠（年120万円）で全世界株式のインデックスファンドを毎月3万円積み立てます。
+- 想定利回り年4%で運用した場合、15年後の評価額は約738万円となります。
+
+### 2. iDeCoによる老後資金の準備
+- 毎月2.3万円の掛金は全額所得控除となり、年間約5.5万円の節税効果があります。
+
+### 3. 保険の見直し
+現在の終身保険は保障が重複しているため、収入保障保険への切り替えで月1.2万円の削減が見込めます。
+
+ご不明な点があれば、お気軽にご相談ください。"""
+
+
+def split_deltas(text: str, seed: int = 0) -> list:
+    """OpenRouterの差分と同じように1〜3文字ずつに分ける"""
+    rng = random.Random(seed)
+    deltas, i = [], 0
+    while i < len(text):
+        size = rng.randint(1, 3)
+        deltas.append(text[i:i + size])
+        i += size
+    return deltas
+
+
+def legacy_frames(deltas: list) -> list:
+    """以前の実装: f"data: {json.dumps({'text': text})}\\n\\n" """
+    return [f"data: {json.dumps({'text': text})}\n\n".encode("utf-8") for text in deltas]
+
+
+def encoder_frames(deltas: list, **options) -> list:
+    sse = SSEEncoder(**options)
+    frames = [sse.text(text) for text in deltas]
+    frames.append(sse.done())
+    return frames
+
+
+def measure(func, deltas: list, **options):
+    frames = func(deltas, **options)
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        func(deltas, **options)
+    elapsed_us = (time.perf_counter() - start) / ITERATIONS / len(deltas) * 1_000_000
+    return sum(len(frame) for frame in frames), elapsed_us
+
+
+def main():
+    deltas = split_deltas(ANSWER)
+    print(f"answer: {len(ANSWER)} chars, {len(ANSWER.encode('utf-8')):,} bytes (UTF-8), {len(deltas)} deltas\n")
+
+    variants = [
+        ("legacy (ensure_ascii)", legacy_frames, {}),
+        ("SSEEncoder (default)", encoder_frames, {"event_ids": False, "named_text_events": False}),
+        ("SSEEncoder (ids)", encoder_frames, {"event_ids": True, "named_text_events": False}),
+        ("SSEEncoder (ids + event: text)", encoder_frames, {"event_ids": True, "named_text_events": True}),
+    ]
+    baseline = None
+    print(f"{'variant':<32} | {'bytes on wire':>13} | {'vs legacy':>9} | {'encode/frame':>12}")
+    print("-" * 78)
+    for name, func, options in variants:
+        total, per_frame = measure(func, deltas, **options)
+        baseline = baseline or total
+        print(f"{name:<32} | {total:>13,} | {total / baseline * 100:>8.1f}% | {per_frame:>9.2f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+ユーザー発話の分類・要約とストリーミングを並行させた場合のTTFTのベンチマーク
+上流（OpenRouter）は固定のレイテンシを返す疑似クライアントで置き換え、
+ルートハンドラと同じ手順でTTFT（ハンドラ開始から最初のトークンまで）、
+完了（done）を送ってレスポンスを閉じるまでの時間、分類・要約がすべて記録されるまでの時間、
+分類・要約のLLM呼び出し回数を比較します
+
+- serial: 分類・要約をレスポンスの経路で待つ実装（annotate_turn → ストリーミング → 回答の annotate_turn を待ってから完了）
+- gather: ANNOTATION_PIPELINE=false（ユーザー発話を annotate_turns で分類してからストリーミング、回答はturn_queueで1回）
+- pipeline: ANNOTATION_PIPELINE=true（ストリーミング後にユーザー発話と回答をturn_queueで annotate_turns 1回で分類）
+
+使用例: python -m benchmarks.bench_turn_pipeline
+"""
+
+import asyncio
+import os
+import tempfile
+import time
+import uuid
+
+from utils.chatroom_manager import ChatroomManager
+from utils.turn_pipeline import UserTurn, register_turn_finisher
+from utils.turn_queue import JobQueue
+
+ANNOTATION_LATENCY = 0.8  # 分類・要約1回あたりのレイテンシ（秒）
+STREAM_TTFT = 0.4  # 回答の最初のトークンまでの時間（秒）
+STREAM_TOKENS = 50
+TOKEN_INTERVAL = 0.02
+TURNS = 5
+
+
+class MockOpenRouterClient:
+    """AIOpenRouterStreamClientと同じインターフェースの疑似クライアント"""
+
+    def __init__(self):
+        self.annotation_calls = 0
+
+    async def annotate_turns(self, utterances, threads, model="openai/gpt-4.1", labels=None):
+        # 出力トークンが減るため、レイテンシは2つの発話でも1回分とみなす
+        self.annotation_calls += 1
+        await asyncio.sleep(ANNOTATION_LATENCY)
+        return [{"type": "質問", "summary": "教育資金の準備方法についての質問"} for _ in utterances]
+
+    async def annotate_turn(self, utterance, threads, model="openai/gpt-4.1", label=None):
+        return (await self.annotate_turns([utterance], threads, model=model, labels=[label]))[0]
+
+    async def stream_response(self, user_input, system_prompt):
+        await asyncio.sleep(STREAM_TTFT)
+        for _ in range(STREAM_TOKENS):
+            yield "あ"
+            await asyncio.sleep(TOKEN_INTERVAL)
+
+
+async def run_turn(mode: str, client: MockOpenRouterClient, manager: ChatroomManager, queue: JobQueue, user_id: str):
+    user_input = "教育資金はどう準備すればいいですか？"
+    threads = []
+    start = time.perf_counter()
+    if mode == "serial":
+        annotation = await client.annotate_turn({"role": "user", "content": user_input}, threads)
+        await manager.add_thread(user_id, {"role": "user", "type": annotation["type"], "content": annotation["summary"]})
+    else:
+        user_turn = UserTurn(manager, user_id, user_input, client, threads, strict=(mode == "gather"), queue=queue)
+        if mode == "gather":
+            await user_turn
+
+    ttft = None
+    resp = ""
+    async for text in client.stream_response(user_input, "system"):
+        if ttft is None:
+            ttft = time.perf_counter() - start
+        resp += text
+    if mode == "serial":
+        annotation = await client.annotate_turn({"role": "assistant", "content": resp}, threads)
+        await manager.add_thread(user_id, {"role": "assistant", "type": annotation["type"], "content": annotation["summary"]})
+    else:
+        assistant_message = {"role": "assistant", "content": resp, "id": str(uuid.uuid4()), "timestamp": "bench"}
+        await manager.add_message(user_id, assistant_message)
+        await user_turn.finish(assistant_message)
+    closed = time.perf_counter() - start
+    await queue.join()
+    recorded = time.perf_counter() - start
+    return ttft, closed, recorded
+
+
+async def main():
+    print(f"annotation {ANNOTATION_LATENCY * 1000:.0f} ms per call, stream TTFT {STREAM_TTFT * 1000:.0f} ms, "
+          f"{STREAM_TOKENS} tokens x {TOKEN_INTERVAL * 1000:.0f} ms\n")
+    print(f"{'mode':<10} | {'TTFT':>9} | {'closed':>9} | {'recorded':>9} | {'calls/turn':>10}")
+    print("-" * 61)
+    with tempfile.TemporaryDirectory() as data_dir:
+        manager = ChatroomManager(data_dir=data_dir)
+        for mode in ("serial", "gather", "pipeline"):
+            client = MockOpenRouterClient()
+            queue = JobQueue(journal_dir=os.path.join(data_dir, f".turn_queue-{mode}"))
+            register_turn_finisher(manager, client, queue=queue)
+            await queue.start()
+            results = [await run_turn(mode, client, manager, queue, f"bench-{mode}") for _ in range(TURNS)]
+            await queue.shutdown()
+            ttft, closed, recorded = (sum(r[i] for r in results) / TURNS * 1000 for i in range(3))
+            print(f"{mode:<10} | {ttft:>6.0f} ms | {closed:>6.0f} ms | {recorded:>6.0f} ms | {client.annotation_calls / TURNS:>10.0f}")
+        await manager.flush_all()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
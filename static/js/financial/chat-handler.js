@@ -367,6 +367,12 @@ function processEventStream(response) {
           try {
             const eventData = JSON.parse(line.substring(6));
 
+            if (eventData.restart) {
+              // サーバーが回答を最初から生成し直すため、表示中の回答を消す
+              assistant_text = '';
+              contentInner.innerHTML = '';
+            }
+
             if (eventData.text) {
               // 最初のテキストチャンクが来たら、タイピングインジケータを削除しメッセージ要素を追加
               if (!assistant_text) {
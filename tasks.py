@@ -1,52 +1,45 @@
 # tasks.py
 from celery import shared_task
-import json
 import os
 import logging
+import time
 from datetime import datetime
 from anthropic import Anthropic
-from openai import OpenAI
-import aiofiles
 import asyncio
 import config
+# Webワーカーと同じアトミック書き込みを使い、キャッシュのシグネチャ照合で更新が検出されるようにする
+from utils.file_operations import load_json_snapshot, save_json, to_pretty_json
+from utils.chatroom_manager import CHAT_STORAGE_MODE
+from utils.jsonl_log import read_jsonl_tail, truncate_jsonl
+from utils import json_codec
+from utils.llm_clients import get_sync_openrouter_client
+from utils.model_router import TASK_SUMMARY, model_scoreboard
 
 client = Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
-openrouter_client = OpenAI(
-  base_url="https://openrouter.ai/api/v1",
-  api_key=os.getenv("OPENROUTER_API_KEY")
-)
-
-
-async def load_json(filepath, default):
-  try:
-    async with aiofiles.open(filepath, "r", encoding='utf-8') as f:
-      content = await f.read()
-      return json.loads(content)
-  except (FileNotFoundError, json.JSONDecodeError):
-    return default
-
-async def save_json(filepath, data):
-  async with aiofiles.open(filepath, "w", encoding='utf-8') as f:
-    await f.write(json.dumps(data, indent=2, ensure_ascii=False))
-
-async def to_pretty_json(data):
-  return json.dumps(data, ensure_ascii=False, indent=2)
+# 接続数・タイムアウトはWebワーカーの共有クライアントと同じ設定（utils.llm_clients）
+openrouter_client = get_sync_openrouter_client()
 
 CHATROOM_FILE = "data/chatroom.json"
 
 async def get_user_files(user_id):
+  log_ext = "jsonl" if CHAT_STORAGE_MODE == "jsonl" else "json"
   return {
-    "chat_log": f"data/chat_log_{user_id}.json",
+    "chat_log": f"data/chat_log_{user_id}.{log_ext}",
     "summary": f"data/summary_{user_id}.json",
     "user_history": f"data/user_history_{user_id}.json"
   }
 
 async def get_or_create_chatroom(user_id):
-  chatrooms = await load_json(CHATROOM_FILE, {})
+  chatrooms = await load_json_snapshot(CHATROOM_FILE, {})
 
   if user_id not in chatrooms:
+    # 追加する場合だけ最上位のdictをコピーする
+    chatrooms = dict(chatrooms)
     user_files = await get_user_files(user_id)
-    await save_json(user_files["chat_log"], [])
+    if user_files["chat_log"].endswith(".jsonl"):
+      await truncate_jsonl(user_files["chat_log"])
+    else:
+      await save_json(user_files["chat_log"], [])
     await save_json(user_files["summary"], [])
     await save_json(user_files["user_history"], {})
 
@@ -58,8 +51,13 @@ async def get_or_create_chatroom(user_id):
   return chatrooms[user_id]
 
 async def get_last_conversation_pair(user_id):
-  chatroom = await get_or_create_chatroom(user_id)
-  history = await load_json(chatroom["files"]["chat_log"], [])
+  await get_or_create_chatroom(user_id)
+  # chatroom.jsonに記録されたパスは移行前の形式の場合があるため再計算する
+  chat_log = (await get_user_files(user_id))["chat_log"]
+  if chat_log.endswith(".jsonl"):
+    history = await read_jsonl_tail(chat_log, 32)
+  else:
+    history = await load_json_snapshot(chat_log, [])
   if len(history) < 2:
     return None
   for i in range(len(history) - 2, -1, -1):
@@ -80,12 +78,12 @@ def generate_summary_task(history_json, user_id):
     user_files = chatroom["files"]
     last_pair = run_async(get_last_conversation_pair(user_id))
     if last_pair:
-      last_two_json = json.dumps(last_pair, ensure_ascii=False, indent=2)
+      last_two_json = json_codec.dumps(last_pair, pretty=True)
     else:
       last_two_json = "We can't find the conversation history"
-    user_history = run_async(load_json(user_files["user_history"], {}))
+    user_history = run_async(load_json_snapshot(user_files["user_history"], {}))
     user_history_json = run_async(to_pretty_json(user_history))
-    summary = run_async(load_json(user_files["summary"], []))
+    summary = run_async(load_json_snapshot(user_files["summary"], []))
     summary_json = run_async(to_pretty_json(summary))
     summarizing_prompt = summarizing_prompt = f"""You are an expert conversation summarizer.
 
@@ -125,13 +123,11 @@ def generate_summary_task(history_json, user_id):
     And this is the last conversation with users:
     {last_two_json}
     """
-    models_to_try = [
-      "anthropic/claude-3.7-sonnet",
-      "openai/gpt-4.1"
-    ]
-    models_to_try = [m for m in models_to_try if m is not None]
+    # スコアボード（Webワーカーと同じファイル）で要約が速く失敗しにくい順に試す
+    models_to_try = model_scoreboard.route(TASK_SUMMARY)
     last_exception = None
     for current_model in models_to_try:
+      start = time.monotonic()
       try:    
         resp = openrouter_client.chat.completions.create(
           model=current_model,
@@ -140,11 +136,13 @@ def generate_summary_task(history_json, user_id):
             {"role": "user", "content": summarizing_prompt}
           ]
         )
+        model_scoreboard.record(TASK_SUMMARY, current_model, ttft=time.monotonic() - start)
         summary = [{"role": "developer", "content": resp.choices[0].message.content}]
         run_async(save_json(user_files["summary"], summary))
         print(f"Summary generated successfully for user {user_id}")
         return
       except Exception as e:
+        model_scoreboard.record(TASK_SUMMARY, current_model, error=True)
         logging.warning(f"Failed to generate summary with model {current_model}: {str(e)}")
         last_exception = e
         continue
@@ -155,4 +153,9 @@ def generate_summary_task(history_json, user_id):
   except Exception as e:
     print(f"Error generating summary: {e}")
     import traceback
-    print(traceback.format_exc())
\ No newline at end of file
+    print(traceback.format_exc())
+async def summarize_after_flush(chatroom_manager, history_json, user_id):
+  """このターンの書き込みを待ってからサマリーを更新する（Webワーカーのバックグラウンドタスク用）"""
+  # サマリーはディスクのチャットログを読むため、未フラッシュ分を先に書き込む
+  await chatroom_manager.flush(user_id)
+  await asyncio.to_thread(generate_summary_task, history_json, user_id)
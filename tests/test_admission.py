@@ -0,0 +1,47 @@
+"""
+utils.admission のテスト（python -m pytest tests）
+"""
+import asyncio
+
+import pytest
+
+from utils.admission import BATCH, INTERACTIVE, AdmissionController, AdmissionRejected
+
+
+def test_abandoned_waiters_do_not_fill_the_queue():
+    """タイムアウト・切断した待ちはキューの長さに数えない"""
+    async def run():
+        controller = AdmissionController(
+            enabled=True, max_in_flight=1, max_in_flight_per_user=10, max_queue=2, timeout=0.05,
+            rates={"openrouter": (0, 0)}
+        )
+        release = asyncio.Event()
+
+        async def hold():
+            async with controller.slot("openrouter", INTERACTIVE):
+                await release.wait()
+
+        holder = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        # 枠が空かないまま、キューの上限を超える数の待ちがタイムアウトする
+        for _ in range(5):
+            with pytest.raises(AdmissionRejected) as rejected:
+                async with controller.slot("openrouter", BATCH):
+                    pass
+            assert rejected.value.reason == "timeout"
+        # 切断された待ち
+        waiter = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+
+        assert controller.snapshot()["queue_depth"] == 0
+        late = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.wait_for(asyncio.gather(holder, late), 1)
+        return controller
+
+    controller = asyncio.run(run())
+    assert controller.metrics.rejected == {}
+    assert controller.in_flight == 0
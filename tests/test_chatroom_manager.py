@@ -0,0 +1,69 @@
+"""
+ChatroomManager のテスト（python -m pytest tests）
+"""
+import asyncio
+import os
+
+from utils.chatroom_manager import ChatroomManager
+from utils.jsonl_log import read_jsonl
+
+
+def test_corrupt_legacy_log_without_backup_keeps_service(tmp_path):
+    """読み込めないレガシーログ（.bakなし）があっても、ファイルを残したまま空のログで続ける"""
+    legacy_path = tmp_path / "chat_log_u1.json"
+    legacy_path.write_text('[{"role": "user", "content": "途中で切れ', encoding="utf-8")
+
+    async def run():
+        manager = ChatroomManager(data_dir=str(tmp_path), write_behind=False)
+        history = await manager.get_chat_log("u1")
+        await manager.add_message("u1", {"role": "user", "content": "こんにちは"})
+        return manager, history
+
+    manager, history = asyncio.run(run())
+
+    assert history == []
+    assert legacy_path.read_text(encoding="utf-8").startswith('[{"role"')
+    assert asyncio.run(read_jsonl(str(tmp_path / "chat_log_u1.jsonl"))) == [{"role": "user", "content": "こんにちは"}]
+    assert str(legacy_path) in manager.get_metrics()["migration_failures"]
+
+
+def test_legacy_log_is_migrated(tmp_path):
+    legacy_path = tmp_path / "thread_history_u2.json"
+    legacy_path.write_text('[{"role": "user", "content": "q"}, {"role": "assistant", "content": "a"}]', encoding="utf-8")
+
+    async def run():
+        manager = ChatroomManager(data_dir=str(tmp_path), write_behind=False)
+        return await manager.get_chat_data("u2")
+
+    _, _, _, thread_history = asyncio.run(run())
+
+    assert [message["content"] for message in thread_history] == ["q", "a"]
+    assert not legacy_path.exists()
+    assert os.path.exists(str(legacy_path) + ".migrated")
+
+
+def test_read_during_flush_has_no_duplicates(tmp_path, monkeypatch):
+    """フラッシュの書き込みが終わった直後（未フラッシュ分を消す前）に読んでも重複しない"""
+    import utils.chatroom_manager as chatroom_manager_module
+
+    written = asyncio.Event()
+    original_append = chatroom_manager_module.append_jsonl
+
+    async def slow_append(filepath, records):
+        await original_append(filepath, records)
+        written.set()
+        await asyncio.sleep(0.05)
+
+    monkeypatch.setattr(chatroom_manager_module, "append_jsonl", slow_append)
+
+    async def run():
+        manager = ChatroomManager(data_dir=str(tmp_path), write_behind=True)
+        await manager.add_message("u3", {"role": "user", "content": "q"})
+        await manager.add_message("u3", {"role": "assistant", "content": "a"})
+        flush = asyncio.create_task(manager.flush("u3"))
+        await written.wait()
+        history = await manager.get_chat_log("u3")
+        await flush
+        return history
+
+    assert [message["content"] for message in asyncio.run(run())] == ["q", "a"]
@@ -0,0 +1,29 @@
+"""
+utils.file_operations のテスト（python -m pytest tests）
+"""
+import time
+
+from utils import file_operations
+from utils.file_operations import atomic_write_text, sync_pending
+
+
+def test_batch_fsyncs_a_lone_write_within_the_interval(tmp_path, monkeypatch):
+    """batchでは、後に書き込みがなくても間隔の終わりにまとめてfsyncする"""
+    # 他のテストで書き込んだ分を先にfsyncしておく
+    sync_pending()
+    synced = []
+    monkeypatch.setattr(file_operations, "FSYNC_POLICY", "batch")
+    monkeypatch.setattr(file_operations, "FSYNC_BATCH_INTERVAL", 0.05)
+    real_fsync = file_operations.os.fsync
+    monkeypatch.setattr(file_operations.os, "fsync", lambda fd: synced.append(fd) or real_fsync(fd))
+
+    atomic_write_text(str(tmp_path / "a.json"), "{}", backup=False)
+    atomic_write_text(str(tmp_path / "b.json"), "[]", backup=False)
+    assert synced == []
+
+    deadline = time.monotonic() + 2
+    while len(synced) < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    # 2つのファイルとディレクトリ
+    assert len(synced) == 3
+    assert not file_operations._unsynced
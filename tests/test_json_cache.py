@@ -0,0 +1,17 @@
+"""
+utils.json_cache のテスト（python -m pytest tests）
+"""
+from utils.json_cache import JsonCache, approx_size
+from utils.snapshot import freeze
+
+
+def test_snapshot_size_counts_contents():
+    """読み取り専用のスナップショットも中身まで数え、予算を超えたら追い出す"""
+    data = freeze({"messages": [{"role": "user", "content": "x" * 1000} for _ in range(10)]})
+    assert approx_size(data) >= 10 * 1000
+
+    cache = JsonCache(max_bytes=15000, ttl=60)
+    cache.set("a.json", data)
+    cache.set("b.json", data)
+    assert cache.stats()["*"]["bytes"] <= 15000
+    assert cache.stats()["*"]["entries"] == 1
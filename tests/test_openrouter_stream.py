@@ -0,0 +1,67 @@
+"""
+AIOpenRouterStreamClient のテスト（python -m pytest tests）
+"""
+import asyncio
+from types import SimpleNamespace
+
+from utils.openrouter_stream import AIOpenRouterStreamClient
+from utils.response_cache import response_cache
+
+
+class _FakeStream:
+    def __init__(self, texts):
+        self.texts = texts
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for text in self.texts:
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))])
+
+
+class _FakeClient:
+    def __init__(self):
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, **request):
+        self.calls += 1
+        return _FakeStream(["回答", str(self.calls)])
+
+
+def _stream_twice(cache):
+    fake = _FakeClient()
+    client = AIOpenRouterStreamClient(openrouter_client=fake, hedging=False)
+
+    async def run():
+        await response_cache.clear()
+        answers = []
+        for _ in range(2):
+            texts = client._stream_openrouter("質問", "system", "test/model", fallback_models=[], cache=cache)
+            answers.append("".join([text async for text in texts]))
+        await response_cache.clear()
+        return answers
+
+    return asyncio.run(run()), fake.calls
+
+
+def test_stream_is_not_cached_by_default():
+    """チャットの回答は明示的に有効にしない限りキャッシュしない"""
+    answers, calls = _stream_twice(cache=False)
+
+    assert answers == ["回答1", "回答2"]
+    assert calls == 2
+
+
+def test_stream_cache_when_opted_in():
+    answers, calls = _stream_twice(cache=True)
+
+    assert answers == ["回答1", "回答1"]
+    assert calls == 1
@@ -0,0 +1,50 @@
+"""
+SemanticCache のテスト（python -m pytest tests）
+"""
+import os
+import subprocess
+import sys
+
+import pytest
+
+from utils.semantic_cache import SemanticCache, vectorize
+
+OPPOSITE_QUESTIONS = [
+    ("保険はいる？", "保険はいらない？"),
+    ("住宅ローンは繰り上げ返済すべきですか", "住宅ローンは繰り上げ返済しないほうがいいですか"),
+    ("繰り上げ返済しなくてもいいですか", "繰り上げ返済しないといけないですか"),
+]
+
+
+@pytest.mark.parametrize("stored, asked", OPPOSITE_QUESTIONS)
+def test_opposite_question_is_not_hit(stored, asked):
+    """語尾の否定だけが違う質問には前回の回答を返さない"""
+    cache = SemanticCache(enabled=True)
+    cache.store("u1:v1", stored, "回答")
+
+    assert cache.lookup("u1:v1", asked) is None
+    assert cache.lookup("u1:v1", stored) is not None
+
+
+def test_paraphrase_is_hit():
+    cache = SemanticCache(enabled=True)
+    cache.store("u1:v1", "老後資金は足りますか", "回答")
+
+    hit = cache.lookup("u1:v1", "老後の資金って足りる？")
+
+    assert hit is not None and hit.answer == "回答"
+
+
+def test_vectorize_is_stable_across_processes():
+    """特徴はPYTHONHASHSEEDによらず同じ（ワーカー間・再起動後でも同じベクトルになる）"""
+    code = "from utils.semantic_cache import vectorize; print(sorted(vectorize('老後資金は足りますか')))"
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    outputs = {
+        subprocess.run(
+            [sys.executable, "-c", code], cwd=root, capture_output=True, text=True, check=True,
+            env={**os.environ, "PYTHONHASHSEED": seed}
+        ).stdout
+        for seed in ("1", "2")
+    }
+
+    assert outputs == {f"{sorted(vectorize('老後資金は足りますか'))}\n"}
@@ -0,0 +1,344 @@
+# utils/admission.py
+"""
+LLMの呼び出しの流量制御（アドミッション制御）
+
+ワーカーがOpenRouter / Anthropicに同時に送る呼び出しの数に上限がなかったため、
+/financial/generate-lifeplan などの大きなFunction callingが集中すると、プロバイダーの
+レート制限を使い切って対話中のチャットが待たされていた。すべてのLLMの呼び出しを
+llm_admission.slot() で囲み、次の3つで流量を制御する。
+
+- プロバイダーごとのトークンバケット（1秒あたりの呼び出し数とバースト）
+- ワーカー全体・ユーザーごとの同時実行数の上限（ストリーミングは最後まで枠を使う）
+- ユーザーとタスクの種類（interactive / batch / background）ごとの重み付き公平キューイング
+  （対話中のチャットを優先し、1人のユーザーのバッチ処理が他のユーザーを待たせない）
+
+キューの長さ・待ち時間は snapshot() で /admin/metrics に表示する。
+"""
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional, Tuple
+
+INTERACTIVE = "interactive"  # ストリーミングのチャットなど、ユーザーが画面で待っている呼び出し
+BATCH = "batch"  # ライフプランの生成などのFunction calling
+BACKGROUND = "background"  # 発話の分類・要約など、ユーザーを待たせない呼び出し
+
+PROVIDER_OPENROUTER = "openrouter"
+PROVIDER_ANTHROPIC = "anthropic"
+
+LLM_ADMISSION = os.getenv("LLM_ADMISSION", "true").lower() == "true"
+LLM_MAX_IN_FLIGHT = int(os.getenv("LLM_MAX_IN_FLIGHT", 32))  # ワーカー全体で同時に実行する呼び出し
+LLM_MAX_IN_FLIGHT_PER_USER = int(os.getenv("LLM_MAX_IN_FLIGHT_PER_USER", 4))  # 1人のユーザーが同時に実行する呼び出し
+# interactive以外が使える枠の割合（残りは対話中のチャットのために空けておく）
+ADMISSION_BATCH_SHARE = float(os.getenv("ADMISSION_BATCH_SHARE", 0.75))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", 256))  # これ以上待っている場合はすぐに断る
+ADMISSION_TIMEOUT = float(os.getenv("ADMISSION_TIMEOUT", 30))  # キューで待つ最大秒数
+# タスクの種類ごとの重み（大きいほど多くの枠を得る）
+ADMISSION_WEIGHTS = {
+    INTERACTIVE: float(os.getenv("ADMISSION_WEIGHT_INTERACTIVE", 8)),
+    BATCH: float(os.getenv("ADMISSION_WEIGHT_BATCH", 2)),
+    BACKGROUND: float(os.getenv("ADMISSION_WEIGHT_BACKGROUND", 1)),
+}
+# プロバイダーごとの1秒あたりの呼び出し数とバースト
+PROVIDER_RATES = {
+    PROVIDER_OPENROUTER: (float(os.getenv("OPENROUTER_RPS", 8)), float(os.getenv("OPENROUTER_BURST", 16))),
+    PROVIDER_ANTHROPIC: (float(os.getenv("ANTHROPIC_RPS", 4)), float(os.getenv("ANTHROPIC_BURST", 8))),
+}
+# 待ち時間のパーセンタイルの計算に保持するサンプル数
+_WAIT_WINDOW = 500
+
+# 呼び出し元のユーザー（リクエストのハンドラーで設定し、ストリーミングやタスクにも引き継がれる）
+_current_user: ContextVar[Optional[str]] = ContextVar("admission_user", default=None)
+
+
+def set_admission_user(user_id: Any) -> None:
+    """このリクエスト（コンテキスト）のLLMの呼び出しをユーザーの呼び出しとして数える"""
+    _current_user.set(None if user_id is None else str(user_id))
+
+
+class AdmissionRejected(Exception):
+    """キューが満杯・待ち時間の上限を超えたため、LLMを呼び出さなかった"""
+
+    def __init__(self, reason: str, provider: str, task_class: str):
+        super().__init__(f"LLM call rejected ({reason}) for {provider}/{task_class}")
+        self.reason = reason
+        self.provider = provider
+        self.task_class = task_class
+
+
+class TokenBucket:
+    """1秒あたりrate回・最大burst回までの呼び出しを許すトークンバケット"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self) -> float:
+        """トークンを1つ使う。足りなければ使わずに、使えるようになるまでの秒数を返す"""
+        if self.rate <= 0:
+            return 0.0
+        self._refill(time.monotonic())
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class _Waiter:
+    __slots__ = ("provider", "user", "task_class", "future", "enqueued_at")
+
+    def __init__(self, provider: str, user: str, task_class: str, future: asyncio.Future):
+        self.provider = provider
+        self.user = user
+        self.task_class = task_class
+        self.future = future
+        self.enqueued_at = time.monotonic()
+
+
+class AdmissionMetrics:
+    """待ち時間と受け付けた・断った呼び出しの数（タスクの種類ごと）"""
+
+    def __init__(self):
+        self.admitted: Dict[str, int] = {}
+        self.rejected: Dict[str, int] = {}
+        self.timeouts: Dict[str, int] = {}
+        self._waits: Dict[str, Deque[float]] = {}
+
+    def record_wait(self, task_class: str, seconds: float) -> None:
+        self.admitted[task_class] = self.admitted.get(task_class, 0) + 1
+        waits = self._waits.get(task_class)
+        if waits is None:
+            waits = self._waits[task_class] = deque(maxlen=_WAIT_WINDOW)
+        waits.append(seconds)
+
+    def to_dict(self) -> Dict[str, Any]:
+        def percentile(values: List[float], p: float) -> float:
+            return round(values[min(len(values) - 1, int(len(values) * p))], 4)
+
+        wait_seconds = {}
+        for task_class, waits in self._waits.items():
+            ordered = sorted(waits)
+            wait_seconds[task_class] = {
+                "p50": percentile(ordered, 0.5),
+                "p95": percentile(ordered, 0.95),
+                "max": round(ordered[-1], 4)
+            }
+        return {
+            "admitted": dict(self.admitted),
+            "rejected": dict(self.rejected),
+            "timeouts": dict(self.timeouts),
+            "wait_seconds": wait_seconds
+        }
+
+
+class AdmissionController:
+    """
+    LLMの呼び出しの枠を重み付き公平キューイングで割り当てる
+
+    ユーザーとタスクの種類の組（フロー）ごとに、前回の終了タグ（仮想時間）から
+    cost / 重み だけ進めたタグを付け、タグの小さい順に枠を割り当てる。
+    状態はワーカー内のすべてのコルーチンで共有する（イベントループは1つなのでロックは不要）。
+    """
+
+    def __init__(
+        self,
+        enabled: bool = LLM_ADMISSION,
+        max_in_flight: int = LLM_MAX_IN_FLIGHT,
+        max_in_flight_per_user: int = LLM_MAX_IN_FLIGHT_PER_USER,
+        batch_share: float = ADMISSION_BATCH_SHARE,
+        max_queue: int = ADMISSION_MAX_QUEUE,
+        timeout: float = ADMISSION_TIMEOUT,
+        weights: Optional[Dict[str, float]] = None,
+        rates: Optional[Dict[str, Tuple[float, float]]] = None
+    ):
+        self.enabled = enabled
+        self.max_in_flight = max_in_flight
+        self.max_in_flight_per_user = max_in_flight_per_user
+        self.batch_share = batch_share
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.weights = weights or ADMISSION_WEIGHTS
+        self.buckets = {
+            provider: TokenBucket(rate, burst) for provider, (rate, burst) in (rates or PROVIDER_RATES).items()
+        }
+        self.metrics = AdmissionMetrics()
+        self.in_flight = 0
+        self._in_flight_by_user: Dict[str, int] = {}
+        self._in_flight_by_class: Dict[str, int] = {}
+        self._queue: List[Tuple[float, int, _Waiter]] = []
+        # キューで待っている呼び出しの数（キャンセル済みでヒープに残っているものは数えない）
+        self._waiting = 0
+        self._seq = itertools.count()
+        self._virtual_time = 0.0
+        self._flow_finish: Dict[Tuple[str, str], float] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def _class_limit(self, task_class: str) -> int:
+        if task_class == INTERACTIVE:
+            return self.max_in_flight
+        return max(1, int(self.max_in_flight * self.batch_share))
+
+    def _non_interactive_in_flight(self) -> int:
+        return self.in_flight - self._in_flight_by_class.get(INTERACTIVE, 0)
+
+    def _blocked(self, waiter: _Waiter) -> bool:
+        """枠が空いても、ユーザー・タスクの種類の上限でまだ実行できないか"""
+        if waiter.user and self._in_flight_by_user.get(waiter.user, 0) >= self.max_in_flight_per_user:
+            return True
+        if waiter.task_class != INTERACTIVE and self._non_interactive_in_flight() >= self._class_limit(waiter.task_class):
+            return True
+        return False
+
+    def _grant(self, finish: float, waiter: _Waiter) -> None:
+        self._virtual_time = max(self._virtual_time, finish)
+        self.in_flight += 1
+        if waiter.user:
+            self._in_flight_by_user[waiter.user] = self._in_flight_by_user.get(waiter.user, 0) + 1
+        self._in_flight_by_class[waiter.task_class] = self._in_flight_by_class.get(waiter.task_class, 0) + 1
+        self._waiting -= 1
+        self.metrics.record_wait(waiter.task_class, time.monotonic() - waiter.enqueued_at)
+        waiter.future.set_result(None)
+
+    def _dispatch(self) -> None:
+        """空いている枠を、終了タグの小さい待ちから順に割り当てる"""
+        self._timer = None
+        deferred = []
+        refill_in: Optional[float] = None
+        while self._queue and self.in_flight < self.max_in_flight:
+            item = heapq.heappop(self._queue)
+            finish, _, waiter = item
+            if waiter.future.done():
+                # 待っている間にキャンセル・タイムアウトした
+                continue
+            if self._blocked(waiter):
+                deferred.append(item)
+                continue
+            bucket = self.buckets.get(waiter.provider)
+            wait = bucket.take() if bucket is not None else 0.0
+            if wait > 0:
+                deferred.append(item)
+                refill_in = wait if refill_in is None else min(refill_in, wait)
+                continue
+            self._grant(finish, waiter)
+        for item in deferred:
+            heapq.heappush(self._queue, item)
+        if refill_in is not None and self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(refill_in, self._dispatch)
+
+    def _abandon(self, waiter: _Waiter) -> None:
+        """タイムアウト・切断した待ちをキューの長さから外す（ヒープからは_dispatchで取り除く）"""
+        if waiter.future.done():
+            return
+        waiter.future.cancel()
+        self._waiting -= 1
+        if len(self._queue) > 2 * self._waiting + 64:
+            # 枠が空かずに取り除かれないキャンセル済みの待ちが溜まったら作り直す
+            self._queue = [item for item in self._queue if not item[2].future.done()]
+            heapq.heapify(self._queue)
+
+    def _release(self, waiter: _Waiter) -> None:
+        self.in_flight -= 1
+        if waiter.user:
+            remaining = self._in_flight_by_user.get(waiter.user, 0) - 1
+            if remaining > 0:
+                self._in_flight_by_user[waiter.user] = remaining
+            else:
+                self._in_flight_by_user.pop(waiter.user, None)
+        self._in_flight_by_class[waiter.task_class] -= 1
+        self._dispatch()
+
+    def _reject(self, reason: str, provider: str, task_class: str) -> AdmissionRejected:
+        counts = self.metrics.timeouts if reason == "timeout" else self.metrics.rejected
+        counts[task_class] = counts.get(task_class, 0) + 1
+        return AdmissionRejected(reason, provider, task_class)
+
+    @asynccontextmanager
+    async def slot(
+        self,
+        provider: str = PROVIDER_OPENROUTER,
+        task_class: str = INTERACTIVE,
+        cost: float = 1.0
+    ) -> AsyncIterator[None]:
+        """
+        LLMを1回呼び出す枠を確保する（ストリーミングは読み終わるまでブロックの中で読む）
+
+        キューが満杯、またはtimeout秒以内に枠が空かなければ AdmissionRejected を送出する。
+        costは重み付き公平キューイングで使う呼び出しの重さ（大きいほど後回しになる）。
+        """
+        if not self.enabled:
+            yield
+            return
+        if self._waiting >= self.max_queue:
+            raise self._reject("queue_full", provider, task_class)
+
+        user = _current_user.get() or ""
+        flow = (user, task_class)
+        finish = max(self._virtual_time, self._flow_finish.get(flow, 0.0)) + cost / self.weights.get(task_class, 1.0)
+        self._flow_finish[flow] = finish
+        waiter = _Waiter(provider, user, task_class, asyncio.get_running_loop().create_future())
+        heapq.heappush(self._queue, (finish, next(self._seq), waiter))
+        self._waiting += 1
+        self._dispatch()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), self.timeout)
+        except asyncio.TimeoutError:
+            if waiter.future.done():
+                # タイムアウトと同時に枠が割り当てられた
+                self._release(waiter)
+            else:
+                self._abandon(waiter)
+            raise self._reject("timeout", provider, task_class) from None
+        except BaseException:
+            # 待っている間にクライアントが切断した
+            if waiter.future.done() and not waiter.future.cancelled():
+                self._release(waiter)
+            else:
+                self._abandon(waiter)
+            raise
+        finally:
+            if len(self._flow_finish) > 10000:
+                # 終わったフローのタグは仮想時間より古いので捨ててよい
+                self._flow_finish = {k: v for k, v in self._flow_finish.items() if v > self._virtual_time}
+        try:
+            yield
+        finally:
+            self._release(waiter)
+
+    def snapshot(self) -> Dict[str, Any]:
+        queued: Dict[str, int] = {}
+        oldest = 0.0
+        now = time.monotonic()
+        for _, _, waiter in self._queue:
+            if not waiter.future.done():
+                queued[waiter.task_class] = queued.get(waiter.task_class, 0) + 1
+                oldest = max(oldest, now - waiter.enqueued_at)
+        return {
+            "enabled": self.enabled,
+            "max_in_flight": self.max_in_flight,
+            "max_in_flight_per_user": self.max_in_flight_per_user,
+            "in_flight": self.in_flight,
+            "in_flight_by_class": {k: v for k, v in self._in_flight_by_class.items() if v},
+            "queue_depth": sum(queued.values()),
+            "queue_depth_by_class": queued,
+            "oldest_wait_seconds": round(oldest, 3),
+            "buckets": {
+                provider: {"rate": bucket.rate, "burst": bucket.burst, "tokens": round(bucket.tokens, 2)}
+                for provider, bucket in self.buckets.items()
+            },
+            **self.metrics.to_dict()
+        }
+
+
+# プロセス内で共有するインスタンス
+llm_admission = AdmissionController()
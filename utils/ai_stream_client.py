@@ -1,23 +1,40 @@
-import json
+from contextlib import aclosing
 from typing import AsyncGenerator, Dict, Any, Optional
 from colorama import Fore, Style
 import anthropic
-from openai import OpenAI
+from openai import AsyncOpenAI
 from datetime import datetime
 
 # 修正したwith_retry関数をインポート
 from .retry_logic import with_retry_generator
+from . import json_codec
+from .llm_clients import get_llm_clients
+from .admission import INTERACTIVE, PROVIDER_ANTHROPIC, PROVIDER_OPENROUTER, AdmissionRejected, llm_admission
+from .openrouter_stream import continuation_messages
 
 class AIStreamClient:
     """AIモデルのストリーミングレスポンスを処理するクラス"""
     
     def __init__(
         self, 
-        anthropic_client: anthropic.Anthropic,
-        openrouter_client: OpenAI
+        anthropic_client: Optional[anthropic.AsyncAnthropic] = None,
+        openrouter_client: Optional[AsyncOpenAI] = None
     ):
-        self.anthropic_client = anthropic_client
-        self.openrouter_client = openrouter_client
+        # 指定がなければ共有のクライアント（utils.llm_clients）を使う
+        self._anthropic_client = anthropic_client
+        self._openrouter_client = openrouter_client
+
+    @property
+    def anthropic_client(self) -> anthropic.AsyncAnthropic:
+        if self._anthropic_client is not None:
+            return self._anthropic_client
+        return get_llm_clients().anthropic
+
+    @property
+    def openrouter_client(self) -> AsyncOpenAI:
+        if self._openrouter_client is not None:
+            return self._openrouter_client
+        return get_llm_clients().openrouter
         
     async def _stream_anthropic(
         self, 
@@ -28,22 +45,25 @@ class AIStreamClient:
     ) -> AsyncGenerator[str, None]:
         """Anthropic APIを使用してストリーミングレスポンスを生成"""
         
-        async def _stream_func():
-            """with_retry_generator関数で使用する実際のストリーミング関数"""
-            with self.anthropic_client.messages.stream(
+        async def _stream_func(prefix: str = ""):
+            """with_retry_generator関数で使用する実際のストリーミング関数（prefixがあればその続きを生成）"""
+            messages = [{"role": "user", "content": user_input}]
+            if prefix.rstrip():
+                # アシスタントの回答の書き出しを渡すと、その続きから生成される（末尾の空白は受け付けられない）
+                messages.append({"role": "assistant", "content": prefix.rstrip()})
+            # 同期クライアントではトークンの受信ごとにイベントループ（他のリクエスト）が止まるため、非同期クライアントを使う
+            async with llm_admission.slot(PROVIDER_ANTHROPIC, INTERACTIVE), self.anthropic_client.messages.stream(
                 model=model,
                 max_tokens=max_tokens,
                 system=system_prompt,
-                messages=[
-                    {"role": "user", "content": user_input}
-                ]
+                messages=messages
             ) as stream:
-                for text in stream.text_stream:
+                async for text in stream.text_stream:
                     print(text, end="", flush=True)
                     yield text
         
         # リトライロジックでラップした関数を実行
-        async for text in with_retry_generator(
+        async with aclosing(with_retry_generator(
             _stream_func,
             max_retries=5,
             retry_on_exceptions=(anthropic.APIStatusError,),
@@ -51,9 +71,13 @@ class AIStreamClient:
                 anthropic.APIStatusError: "Anthropic APIエラー",
                 "429": "APIが混雑しています",
                 "overloaded_error": "APIが過負荷状態です"
-            }
-        ):
-            yield text
+            },
+            # 混雑で枠が確保できなかった場合はリトライしない
+            abort_on_exceptions=(AdmissionRejected,),
+            resume_func=_stream_func
+        )) as texts:
+            async for text in texts:
+                yield text
     
     async def _stream_openrouter(
         self, 
@@ -64,28 +88,28 @@ class AIStreamClient:
     ) -> AsyncGenerator[str, None]:
         """OpenRouter APIを使用してストリーミングレスポンスを生成"""
         
-        async def _stream_func():
-            """実際のストリーミング処理を行う関数"""
-            stream = self.openrouter_client.chat.completions.create(
-                model=model,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_input} 
-                ],
-                max_tokens=max_tokens,
-                stream=True
-            )
-            
-            print(f"\n{Fore.BLUE}Claude:{Style.RESET_ALL}", end="")
-            
-            async for chunk in stream:
-                delta = chunk.choices[0].delta 
-                if delta and delta.content:
-                    print(delta.content, end="", flush=True)
-                    yield delta.content
+        async def _stream_func(prefix: str = ""):
+            """実際のストリーミング処理を行う関数（prefixがあればその続きを生成）"""
+            async with llm_admission.slot(PROVIDER_OPENROUTER, INTERACTIVE):
+                stream = await self.openrouter_client.chat.completions.create(
+                    model=model,
+                    messages=continuation_messages(system_prompt, user_input, prefix),
+                    max_tokens=max_tokens,
+                    stream=True
+                )
+                
+                print(f"\n{Fore.BLUE}Claude:{Style.RESET_ALL}", end="")
+                
+                # 途中で閉じられた（クライアントが切断した・リトライで再開した）場合はHTTPのストリームも閉じる
+                async with stream:
+                    async for chunk in stream:
+                        delta = chunk.choices[0].delta 
+                        if delta and delta.content:
+                            print(delta.content, end="", flush=True)
+                            yield delta.content
         
         # リトライロジックでラップした関数を実行
-        async for text in with_retry_generator(
+        async with aclosing(with_retry_generator(
             _stream_func,
             max_retries=5,
             retry_on_exceptions=(Exception,),
@@ -93,9 +117,13 @@ class AIStreamClient:
                 Exception: "OpenRouter APIエラー",
                 "429": "APIが混雑しています",
                 "overload": "APIが過負荷状態です"
-            }
-        ):
-            yield text
+            },
+            # 混雑で枠が確保できなかった場合はリトライしない
+            abort_on_exceptions=(AdmissionRejected,),
+            resume_func=_stream_func
+        )) as texts:
+            async for text in texts:
+                yield text
     
     async def stream_response(
         self, 
@@ -109,16 +137,18 @@ class AIStreamClient:
         
         if provider.lower() == "anthropic":
             model = model or "claude-3-7-sonnet-20250219"
-            async for text in self._stream_anthropic(user_input, system_prompt, model, max_tokens):
-                yield text
+            async with aclosing(self._stream_anthropic(user_input, system_prompt, model, max_tokens)) as texts:
+                async for text in texts:
+                    yield text
         elif provider.lower() == "openrouter":
             model = model or "anthropic/claude-3.7-sonnet"
-            async for text in self._stream_openrouter(user_input, system_prompt, model, max_tokens):
-                yield text
+            async with aclosing(self._stream_openrouter(user_input, system_prompt, model, max_tokens)) as texts:
+                async for text in texts:
+                    yield text
         else:
-            yield json.dumps({"error": f"未知のプロバイダー: {provider}"})
+            yield json_codec.dumps({"error": f"未知のプロバイダー: {provider}"})
 
 # 使用例:
-# ai_client = AIStreamClient(anthropic_client, openrouter_client)
+# ai_client = AIStreamClient()  # 共有のAsyncAnthropic / AsyncOpenAIを使う
 # async for text in ai_client.stream_response(user_input, system_prompt, "anthropic"):
 #     # テキストを処理
\ No newline at end of file
@@ -1,42 +1,132 @@
 # utils/chatroom_manager.py
 import uuid
 import os
-from typing import Dict, List, Any, Optional, Tuple
+import asyncio
+import contextlib
+import logging
+import time
+from typing import Dict, List, Any, Mapping, Optional, Sequence, Tuple
 from datetime import datetime
 
 # 前述の最適化されたファイル操作関数をインポート
-from .file_operations import load_json, save_json, to_pretty_json
+from .file_operations import load_json, load_json_snapshot, save_json, to_pretty_json
+from .snapshot import thaw
+from .jsonl_log import (
+    append_jsonl,
+    read_jsonl,
+    read_jsonl_tail,
+    truncate_jsonl,
+    migrate_json_to_jsonl
+)
+from .user_locks import UserLockManager, user_locks
+
+# チャットログの保存形式（"jsonl": 追記専用, "json": 従来のJSON配列）
+CHAT_STORAGE_MODE = os.getenv("CHAT_STORAGE_MODE", "jsonl")
+
+# 追記専用で保存するファイルの種類
+APPEND_ONLY_KEYS = ("chat_log", "thread_history")
+
+# chatroom.jsonの更新を直列化するロックのキー
+REGISTRY_LOCK_KEY = "__chatroom_registry__"
+
+# 直近の会話ペアを探す際に末尾から読み込む件数
+RECENT_WINDOW = 32
+
+# write-behind（書き込みをメモリに溜めてまとめてフラッシュする）の設定
+WRITE_BEHIND = os.getenv("CHAT_WRITE_BEHIND", "true").lower() == "true"
+FLUSH_INTERVAL = float(os.getenv("CHAT_FLUSH_INTERVAL", 2.0))  # 未フラッシュを保持する最大秒数
+FLUSH_MAX_RECORDS = int(os.getenv("CHAT_FLUSH_MAX_RECORDS", 64))  # ユーザーごとの未フラッシュ件数の上限
 
 class ChatroomManager:
     """チャットルームとユーザーデータの管理を行うクラス"""
     
-    def __init__(self, data_dir: str = "data", max_rallies: int = 6):
+    def __init__(
+        self,
+        data_dir: str = "data",
+        max_rallies: int = 6,
+        storage_mode: str = CHAT_STORAGE_MODE,
+        write_behind: bool = WRITE_BEHIND,
+        locks: UserLockManager = user_locks
+    ):
         self.data_dir = data_dir
         self.max_rallies = max_rallies
+        self.storage_mode = storage_mode
+        self.write_behind = write_behind
+        self.locks = locks
         self.chatroom_file = os.path.join(data_dir, "chatroom.json")
         
+        # チャットルームのレジストリ（chatroom.jsonの内容）と、ファイルの存在確認が済んだユーザー
+        self._chatrooms: Optional[Dict[str, Any]] = None
+        self._verified_users: set = set()
+        
+        # 未フラッシュのデータ（user_id -> filepath -> データ）
+        self._pending_appends: Dict[str, Dict[str, List[Dict[str, Any]]]] = {}
+        self._pending_docs: Dict[str, Dict[str, Any]] = {}
+        self._pending_since: Dict[str, float] = {}
+        self._flush_tasks: Dict[str, asyncio.Task] = {}
+        self._flusher: Optional[asyncio.Task] = None
+        
+        # JSONLに移行できなかったレガシーファイル（パス -> 理由）。/admin/metrics に表示する
+        self.migration_failures: Dict[str, str] = {}
+        
+        if storage_mode not in ("json", "jsonl"):
+            raise ValueError(f"Unsupported storage mode: {storage_mode}")
+        
         # ディレクトリが存在することを確認
         os.makedirs(data_dir, exist_ok=True)
     
+    @property
+    def append_only(self) -> bool:
+        return self.storage_mode == "jsonl"
+    
     async def get_user_files(self, user_id: str) -> Dict[str, str]:
         """ユーザーに関連するファイルパスを取得"""
+        log_ext = "jsonl" if self.append_only else "json"
         return {
-            "chat_log": os.path.join(self.data_dir, f"chat_log_{user_id}.json"),
+            "chat_log": os.path.join(self.data_dir, f"chat_log_{user_id}.{log_ext}"),
             "summary": os.path.join(self.data_dir, f"summary_{user_id}.json"),
             "user_history": os.path.join(self.data_dir, f"user_history_{user_id}.json"),
-            "thread_history": os.path.join(self.data_dir, f"thread_history_{user_id}.json"),
+            "thread_history": os.path.join(self.data_dir, f"thread_history_{user_id}.{log_ext}"),
             "strategy_data": os.path.join(self.data_dir, f"strategy_{user_id}.json")
         }
     
+    async def load_registry(self, force: bool = False) -> Dict[str, Any]:
+        """chatroom.jsonをプロセス内のレジストリに読み込む（起動時に1回）"""
+        if self._chatrooms is None or force:
+            chatrooms = await load_json_snapshot(self.chatroom_file, {})
+            # 他のワーカーが作成したユーザーも取り込む（既存のエントリは保持）
+            # スナップショットはコピーせず、最上位のdictだけを作り直す
+            merged = dict(chatrooms)
+            merged.update(self._chatrooms or {})
+            self._chatrooms = merged
+        return self._chatrooms
+    
     async def get_or_create_chatroom(self, user_id: str) -> Dict[str, Any]:
-        chatrooms = await load_json(self.chatroom_file, {})
-        if user_id not in chatrooms:
-            chatrooms[user_id] = {
-                "created_at": datetime.now().isoformat(),
-                "files": await self.get_user_files(user_id)
-            }
-            await save_json(self.chatroom_file, chatrooms)
-        user_files = await self.get_user_files(user_id)
+        # ファイルの存在確認が済んだユーザーはファイルシステムにアクセスしない
+        if user_id in self._verified_users:
+            return self._chatrooms[user_id]
+        
+        async with self.locks.acquire(REGISTRY_LOCK_KEY):
+            if user_id in self._verified_users:
+                return self._chatrooms[user_id]
+            chatrooms = await self.load_registry()
+            if user_id not in chatrooms:
+                # 他のワーカーが登録済みの可能性があるため一度だけ読み直す
+                chatrooms = await self.load_registry(force=True)
+            if user_id not in chatrooms:
+                chatrooms[user_id] = {
+                    "created_at": datetime.now().isoformat(),
+                    "files": await self.get_user_files(user_id)
+                }
+                await save_json(self.chatroom_file, chatrooms)
+            user_files = await self.get_user_files(user_id)
+            await self._ensure_user_files(user_id, user_files)
+            chatrooms[user_id] = {**chatrooms[user_id], "files": user_files}
+            self._verified_users.add(user_id)
+            return chatrooms[user_id]
+    
+    async def _ensure_user_files(self, user_id: str, user_files: Dict[str, str]) -> None:
+        """ユーザーのファイルがなければ作成する"""
         required_files = {
             "chat_log": [],
             "summary": [],
@@ -46,25 +136,234 @@ class ChatroomManager:
         }
         for file_key, default_value in required_files.items():
             file_path = user_files[file_key]
-            if not os.path.exists(file_path):
+            if os.path.exists(file_path):
+                continue
+            if self.append_only and file_key in APPEND_ONLY_KEYS:
+                # 従来形式のJSON配列が残っていればJSONLに移行する
+                legacy_path = file_path[:-1]
+                if os.path.exists(legacy_path):
+                    # 大きな履歴の変換・fsyncでイベントループを止めないよう別スレッドで行う
+                    async with self.locks.acquire(user_id):
+                        if not os.path.exists(file_path):
+                            try:
+                                await asyncio.to_thread(migrate_json_to_jsonl, legacy_path, file_path)
+                            except ValueError as e:
+                                # 読み込めないファイルは残したまま（復元できるように）、空のログで続ける
+                                logging.error(f"Legacy log {legacy_path} was not migrated; starting an empty log: {e}")
+                                self.migration_failures[legacy_path] = str(e)
+                                await truncate_jsonl(file_path)
+                else:
+                    await truncate_jsonl(file_path)
+            else:
                 await save_json(file_path, default_value)
-        chatrooms[user_id]["files"] = user_files
-        return chatrooms[user_id]
+    
+    def _pending_records(self, user_id: str, filepath: str) -> List[Dict[str, Any]]:
+        return self._pending_appends.get(user_id, {}).get(filepath, [])
+    
+    async def _read_log(self, user_id: str, filepath: str) -> Sequence[Dict[str, Any]]:
+        """
+        チャットログ全体を読み込む（未フラッシュ分を含む）
+
+        読み取り専用。jsonモードではキャッシュのスナップショット（tuple）をコピーせずに返す。
+        """
+        async with self._read_guard(user_id):
+            pending = list(self._pending_records(user_id, filepath))
+            if self.append_only:
+                return await read_jsonl(filepath) + pending
+            history = await load_json_snapshot(filepath, [])
+            return history + tuple(pending) if pending else history
+    
+    async def _read_log_tail(self, user_id: str, filepath: str, n: int) -> List[Dict[str, Any]]:
+        """チャットログの末尾n件を読み込む（未フラッシュ分を含む）"""
+        pending = self._pending_records(user_id, filepath)
+        if len(pending) >= n:
+            return pending[-n:]
+        async with self._read_guard(user_id):
+            pending = list(self._pending_records(user_id, filepath))
+            if self.append_only:
+                history = await read_jsonl_tail(filepath, n - len(pending)) if n > len(pending) else []
+            else:
+                # 末尾だけをコピーする
+                history = thaw((await load_json_snapshot(filepath, []))[-(n - len(pending)):]) if n > len(pending) else []
+            return (history + pending)[-n:]
+    
+    def _read_guard(self, user_id: str):
+        """
+        ディスクと未フラッシュ分を合わせて読む間、フラッシュを待たせる
+
+        フラッシュ中はバッチがディスクにも未フラッシュ分にもある瞬間があり、
+        その間に読むと同じメッセージが2回入るため、フラッシュと同じロックで読み込む。
+        """
+        if not self.write_behind:
+            return contextlib.nullcontext()
+        return self.locks.acquire(self._flush_lock_key(user_id))
+    
+    async def _write_log(self, filepath: str, records: List[Dict[str, Any]]) -> None:
+        """チャットログに複数件をまとめて追記する"""
+        if self.append_only:
+            await append_jsonl(filepath, records)
+            return
+        # 既存の履歴はコピーせず、スナップショットに追記して保存する
+        history = await load_json_snapshot(filepath, [])
+        await save_json(filepath, history + tuple(records))
+    
+    async def _append_log(self, user_id: str, filepath: str, record: Dict[str, Any]) -> None:
+        """チャットログに1件追記する"""
+        if not self.write_behind:
+            async with self.locks.acquire(user_id):
+                await self._write_log(filepath, [record])
+            return
+        self._pending_appends.setdefault(user_id, {}).setdefault(filepath, []).append(record)
+        self._mark_dirty(user_id)
+    
+    async def _load_doc(self, user_id: str, filepath: str, default: Any) -> Any:
+        """JSONドキュメントを変更するために読み込む（未フラッシュ分があればそれを優先、なければコピー）"""
+        docs = self._pending_docs.get(user_id, {})
+        if filepath in docs:
+            return docs[filepath]
+        return await load_json(filepath, default)
+    
+    async def _load_doc_snapshot(self, user_id: str, filepath: str, default: Any) -> Any:
+        """JSONドキュメントを読み取り専用で読み込む（コピーしない）"""
+        docs = self._pending_docs.get(user_id, {})
+        if filepath in docs:
+            return docs[filepath]
+        return await load_json_snapshot(filepath, default)
+    
+    async def _save_doc(self, user_id: str, filepath: str, data: Any) -> None:
+        """JSONドキュメントを保存する（write-behind時はメモリに保持）"""
+        if not self.write_behind:
+            await save_json(filepath, data)
+            return
+        self._pending_docs.setdefault(user_id, {})[filepath] = data
+        self._mark_dirty(user_id)
+    
+    def _mark_dirty(self, user_id: str) -> None:
+        self._pending_since.setdefault(user_id, time.monotonic())
+        pending_count = sum(len(records) for records in self._pending_appends.get(user_id, {}).values())
+        if pending_count >= FLUSH_MAX_RECORDS:
+            self.schedule_flush(user_id)
+    
+    def _flush_lock_key(self, user_id: str) -> str:
+        # メモリ上の変更（ユーザーロック）とディスクへの書き込みは別のロックで直列化する
+        return f"{user_id}:flush"
+    
+    async def flush(self, user_id: str) -> None:
+        """ユーザーの未フラッシュデータをディスクに書き込む"""
+        async with self.locks.acquire(self._flush_lock_key(user_id)):
+            appends = self._pending_appends.get(user_id, {})
+            docs = self._pending_docs.get(user_id, {})
+            # 書き込みが完了するまでは未フラッシュ分として読み取りに含める
+            for filepath, records in list(appends.items()):
+                batch = list(records)
+                await self._write_log(filepath, batch)
+                del records[:len(batch)]
+                if not records:
+                    appends.pop(filepath, None)
+            for filepath, data in list(docs.items()):
+                await save_json(filepath, data)
+                if docs.get(filepath) is data:
+                    del docs[filepath]
+            if not appends:
+                self._pending_appends.pop(user_id, None)
+            if not docs:
+                self._pending_docs.pop(user_id, None)
+            if user_id not in self._pending_appends and user_id not in self._pending_docs:
+                self._pending_since.pop(user_id, None)
+    
+    def schedule_flush(self, user_id: str) -> None:
+        """レスポンスを待たせずにバックグラウンドでフラッシュする"""
+        if user_id not in self._pending_since:
+            return
+        running = self._flush_tasks.get(user_id)
+        if running is not None and not running.done():
+            return
+        task = asyncio.create_task(self.flush(user_id))
+        self._flush_tasks[user_id] = task
+        task.add_done_callback(lambda t: self._on_flush_done(user_id, t))
+    
+    def _on_flush_done(self, user_id: str, task: asyncio.Task) -> None:
+        if self._flush_tasks.get(user_id) is task:
+            del self._flush_tasks[user_id]
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            logging.error(f"Failed to flush chat data for user {user_id}: {task.exception()}")
+        elif user_id in self._pending_since:
+            # フラッシュ中に追加されたデータがあれば続けて書き込む
+            self.schedule_flush(user_id)
+    
+    def end_turn(self, user_id: str) -> None:
+        """1ターン分の書き込みが揃ったことを通知（ターンごとに1回フラッシュ）"""
+        self.schedule_flush(user_id)
+    
+    async def flush_all(self) -> None:
+        """すべてのユーザーの未フラッシュデータを書き込む"""
+        await asyncio.gather(*list(self._flush_tasks.values()), return_exceptions=True)
+        for user_id in list(self._pending_since):
+            try:
+                await self.flush(user_id)
+            except Exception as e:
+                logging.error(f"Failed to flush chat data for user {user_id}: {e}")
+    
+    async def _flush_loop(self) -> None:
+        """一定時間以上フラッシュされていないデータを定期的に書き込む"""
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL / 2)
+            now = time.monotonic()
+            for user_id, since in list(self._pending_since.items()):
+                if now - since >= FLUSH_INTERVAL:
+                    self.schedule_flush(user_id)
+    
+    def start(self) -> None:
+        """定期フラッシュを開始（アプリケーション起動時に呼び出す）"""
+        if self.write_behind and self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_loop())
+    
+    async def shutdown(self) -> None:
+        """定期フラッシュを停止し、残りのデータをすべて書き込む"""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        await self.flush_all()
+    
+    def get_metrics(self) -> Dict[str, Any]:
+        return {
+            "storage_mode": self.storage_mode,
+            "write_behind": self.write_behind,
+            "pending_users": len(self._pending_since),
+            "migration_failures": dict(self.migration_failures)
+        }
     
     async def get_last_conversation_pair(self, user_id: str) -> Optional[Dict[str, Dict]]:
         """最新の会話ペア（ユーザー・アシスタント）を取得"""
         chatroom = await self.get_or_create_chatroom(user_id)
         # change the caht_log to thread_history
-        history = await load_json(chatroom["files"]["thread_history"], [])
+        history = await self._read_log_tail(user_id, chatroom["files"]["thread_history"], RECENT_WINDOW)
+        if len(history) == RECENT_WINDOW:
+            pair = self._find_last_pair(history)
+            if pair is not None:
+                return pair
+            # 直近の範囲に会話ペアがなければ全体を探す
+            history = await self._read_log(user_id, chatroom["files"]["thread_history"])
         
         if len(history) < 2:
             return None
             
+        return self._find_last_pair(history)
+    
+    @staticmethod
+    def _find_last_pair(history: List[Dict[str, Any]]) -> Optional[Dict[str, Dict]]:
         for i in range(len(history) - 2, -1, -1):
             if history[i]["role"] == "user" and history[i + 1]["role"] == "assistant":
+                # 履歴はスナップショットの場合があるため、返す2件だけをコピーする
                 return {
-                    "user": history[i],
-                    "assistant": history[i + 1]
+                    "user": thaw(history[i]),
+                    "assistant": thaw(history[i + 1])
                 }
                 
         return None
@@ -72,62 +371,89 @@ class ChatroomManager:
     async def update_user_messages(self, user_id: str, message_pair: Dict[str, Any]) -> None:
         """ユーザーのメッセージ履歴を更新"""
         chatroom = await self.get_or_create_chatroom(user_id)
-        user_history = await load_json(chatroom["files"]["user_history"], {})
-        # change the chat_log to thread_history
-        history = await load_json(chatroom["files"]["thread_history"], [])
-        
-        if user_id not in user_history:
-            user_history[user_id] = {
-                "created_at": datetime.now().isoformat(),
-                "messages": []
-            }
-            
-        if "messages" not in user_history[user_id]:
-            user_history[user_id]["messages"] = []
+        # load → 変更 → save の間に同じユーザーの別リクエストが割り込まないようにする
+        async with self.locks.acquire(user_id):
+            user_history = await self._load_doc(user_id, chatroom["files"]["user_history"], {})
+            # change the chat_log to thread_history
+            # 必要なのは末尾4件のみ（history[-4:-2]）
+            history = await self._read_log_tail(user_id, chatroom["files"]["thread_history"], 4)
             
-        if len(history) > 2:
-            user_history[user_id]["messages"].append(history[-4:-2])
-            
-        if len(user_history[user_id]["messages"]) > self.max_rallies:
-            user_history[user_id]["messages"] = user_history[user_id]["messages"][-self.max_rallies:]
-            
-        await save_json(chatroom["files"]["user_history"], user_history)
+            if user_id not in user_history:
+                user_history[user_id] = {
+                    "created_at": datetime.now().isoformat(),
+                    "messages": []
+                }
+                
+            if "messages" not in user_history[user_id]:
+                user_history[user_id]["messages"] = []
+                
+            if len(history) > 2:
+                user_history[user_id]["messages"].append(history[-4:-2])
+                
+            if len(user_history[user_id]["messages"]) > self.max_rallies:
+                user_history[user_id]["messages"] = user_history[user_id]["messages"][-self.max_rallies:]
+                
+            await self._save_doc(user_id, chatroom["files"]["user_history"], user_history)
     
     async def add_message(self, user_id: str, message: Dict[str, Any]) -> None:
         """メッセージをチャット履歴に追加"""
         chatroom = await self.get_or_create_chatroom(user_id)
-        history = await load_json(chatroom["files"]["chat_log"], [])
-        history.append(message)
-        await save_json(chatroom["files"]["chat_log"], history)
+        await self._append_log(user_id, chatroom["files"]["chat_log"], message)
     
 
     async def add_thread(self, user_id: str, thread: Dict[str, Any]) -> None:
         """スレッドをチャット履歴に追加"""
         chatroom = await self.get_or_create_chatroom(user_id)
-        history = await load_json(chatroom["files"]["thread_history"], [])
-        history.append(thread)
-        await save_json(chatroom["files"]["thread_history"], history)
+        await self._append_log(user_id, chatroom["files"]["thread_history"], thread)
     
     async def clear_chat_data(self, user_id: str) -> None:
         """ユーザーのチャットデータをクリア"""
         chatroom = await self.get_or_create_chatroom(user_id)
         user_files = chatroom["files"]
         
-        await save_json(user_files["chat_log"], [])
-        await save_json(user_files["summary"], [])
-        await save_json(user_files["user_history"], {})
-        await save_json(user_files["thread_history"], [])
-        await save_json(user_files["strategy_data"], {})
+        # 実行中のフラッシュを待ってから未フラッシュのデータを破棄する
+        running = self._flush_tasks.get(user_id)
+        if running is not None:
+            await asyncio.gather(running, return_exceptions=True)
+        async with self.locks.acquire(user_id), self.locks.acquire(self._flush_lock_key(user_id)):
+            self._pending_appends.pop(user_id, None)
+            self._pending_docs.pop(user_id, None)
+            self._pending_since.pop(user_id, None)
+            
+            if self.append_only:
+                await truncate_jsonl(user_files["chat_log"])
+                await truncate_jsonl(user_files["thread_history"])
+            else:
+                await save_json(user_files["chat_log"], [])
+                await save_json(user_files["thread_history"], [])
+            await save_json(user_files["summary"], [])
+            await save_json(user_files["user_history"], {})
+            await save_json(user_files["strategy_data"], {})
         
     
-    async def get_chat_data(self, user_id: str) -> Tuple[List, List, Dict]:
-        """ユーザーのチャットデータを取得"""
+    async def get_chat_log(self, user_id: str) -> Sequence[Dict[str, Any]]:
+        """ユーザーのチャットログ全体を取得（読み取り専用）"""
+        chatroom = await self.get_or_create_chatroom(user_id)
+        return await self._read_log(user_id, chatroom["files"]["chat_log"])
+    
+    async def get_chat_data(self, user_id: str) -> Tuple[Sequence, Sequence, Mapping, Sequence]:
+        """ユーザーのチャットデータを取得（読み取り専用。変更する場合はコピーする）"""
         chatroom = await self.get_or_create_chatroom(user_id)
         user_files = chatroom["files"]
         
-        history = await load_json(user_files["chat_log"], [])
-        summary = await load_json(user_files["summary"], [])
-        user_history = await load_json(user_files["user_history"], {})
-        thread_history = await load_json(user_files["thread_history"], [])
+        history = await self._read_log(user_id, user_files["chat_log"])
+        summary = await load_json_snapshot(user_files["summary"], [])
+        user_history = await self._load_doc_snapshot(user_id, user_files["user_history"], {})
+        thread_history = await self._read_log(user_id, user_files["thread_history"])
         
         return history, summary, user_history, thread_history
+
+
+# プロセス内で共有するインスタンス（未フラッシュのデータを全ルーターで共有するため）
+_chatroom_managers: Dict[str, ChatroomManager] = {}
+
+def get_chatroom_manager(data_dir: str = "data", max_rallies: int = 6) -> ChatroomManager:
+    """データディレクトリごとに共有のChatroomManagerを取得"""
+    if data_dir not in _chatroom_managers:
+        _chatroom_managers[data_dir] = ChatroomManager(data_dir=data_dir, max_rallies=max_rallies)
+    return _chatroom_managers[data_dir]
@@ -0,0 +1,232 @@
+# utils/circuit_breaker.py
+"""
+モデルごとのサーキットブレーカー
+
+プロバイダーが落ちているモデルに毎回リトライしてからフォールバックすると、
+すべてのリクエストが数秒ずつ無駄に待たされる。直近の失敗率が閾値を超えたモデルは
+一定時間（open）呼び出さずにすぐ次のモデルへ進み、時間が経ったら少数のプローブ
+（half-open）で回復を確認してから通常の呼び出し（closed）に戻す。
+
+状態はワーカー内のすべてのコルーチンで共有する（イベントループは1つなのでロックは不要）。
+"""
+import os
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional, Tuple
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+CIRCUIT_WINDOW_SECONDS = float(os.getenv("CIRCUIT_WINDOW_SECONDS", 60))  # 失敗率を計算する期間
+CIRCUIT_MIN_REQUESTS = int(os.getenv("CIRCUIT_MIN_REQUESTS", 5))  # 期間内にこの件数未満なら判定しない
+CIRCUIT_FAILURE_RATE = float(os.getenv("CIRCUIT_FAILURE_RATE", 0.5))  # これ以上の失敗率でopenにする
+CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", 30))  # openのまま待つ秒数
+CIRCUIT_HALF_OPEN_PROBES = int(os.getenv("CIRCUIT_HALF_OPEN_PROBES", 1))  # half-openで同時に通すリクエスト数
+CIRCUIT_BREAKER = os.getenv("CIRCUIT_BREAKER", "true").lower() == "true"
+
+# 期間内に保持する結果の上限（高負荷時にメモリを使いすぎないため）
+_MAX_WINDOW_RECORDS = 1000
+
+
+class CircuitOpenError(Exception):
+    """サーキットがopenのため呼び出さなかった"""
+
+    def __init__(self, name: str, retry_in: float = 0.0):
+        super().__init__(f"Circuit for {name} is open (retry in {retry_in:.1f}s)")
+        self.name = name
+        self.retry_in = retry_in
+
+
+def is_provider_failure(exception: BaseException) -> bool:
+    """
+    プロバイダー側の障害とみなす例外か
+
+    429・408・5xx、およびステータスのない例外（接続エラー・タイムアウトなど）は障害として数え、
+    それ以外の4xx（リクエストの内容の問題）は数えない。
+    """
+    status = getattr(exception, "status_code", None)
+    if status is None:
+        return True
+    return status in (408, 429) or status >= 500
+
+
+class CircuitBreaker:
+    """1つのモデル（呼び出し先）のサーキットブレーカー"""
+
+    def __init__(
+        self,
+        name: str,
+        window_seconds: float = CIRCUIT_WINDOW_SECONDS,
+        min_requests: int = CIRCUIT_MIN_REQUESTS,
+        failure_rate: float = CIRCUIT_FAILURE_RATE,
+        open_seconds: float = CIRCUIT_OPEN_SECONDS,
+        half_open_probes: int = CIRCUIT_HALF_OPEN_PROBES
+    ):
+        self.name = name
+        self.window_seconds = window_seconds
+        self.min_requests = min_requests
+        self.failure_rate = failure_rate
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.probes_in_flight = 0
+        self._window: Deque[Tuple[float, bool]] = deque(maxlen=_MAX_WINDOW_RECORDS)
+        self._failures = 0  # _window内の失敗の数
+        # 累計
+        self.opened = 0
+        self.rejected = 0
+        self.successes = 0
+        self.failures = 0
+
+    def _prune(self, now: float) -> None:
+        cutoff = now - self.window_seconds
+        window = self._window
+        while window and window[0][0] < cutoff:
+            if not window.popleft()[1]:
+                self._failures -= 1
+
+    def _record(self, now: float, ok: bool) -> None:
+        window = self._window
+        if len(window) == window.maxlen and not window[0][1]:
+            self._failures -= 1
+        window.append((now, ok))
+        if not ok:
+            self._failures += 1
+
+    def _open(self, now: float) -> None:
+        self.state = OPEN
+        self.opened_at = now
+        self.opened += 1
+        self.probes_in_flight = 0
+
+    def allow(self) -> bool:
+        """
+        呼び出してよいか（half-openではプローブの枠を確保する）
+
+        Trueを返した場合は、結果に応じて record_success / record_failure / release のいずれかを呼び出す。
+        """
+        now = time.monotonic()
+        if self.state == OPEN:
+            if now - self.opened_at < self.open_seconds:
+                self.rejected += 1
+                return False
+            self.state = HALF_OPEN
+            self.probes_in_flight = 0
+        if self.state == HALF_OPEN:
+            if self.probes_in_flight >= self.half_open_probes:
+                self.rejected += 1
+                return False
+            self.probes_in_flight += 1
+        return True
+
+    def retry_in(self) -> float:
+        """openの場合、half-openになるまでの秒数"""
+        if self.state != OPEN:
+            return 0.0
+        return max(0.0, self.open_seconds - (time.monotonic() - self.opened_at))
+
+    def record_success(self) -> None:
+        now = time.monotonic()
+        self.successes += 1
+        if self.state == HALF_OPEN:
+            # プローブが成功したら、過去の失敗は忘れて通常の呼び出しに戻す
+            self.state = CLOSED
+            self.probes_in_flight = 0
+            self._window.clear()
+            self._failures = 0
+        self._record(now, True)
+
+    def record_failure(self) -> None:
+        now = time.monotonic()
+        self.failures += 1
+        if self.state == HALF_OPEN:
+            self._open(now)
+            return
+        if self.state == OPEN:
+            return
+        self._record(now, False)
+        self._prune(now)
+        total = len(self._window)
+        if total >= self.min_requests and self._failures / total >= self.failure_rate:
+            self._open(now)
+
+    def release(self) -> None:
+        """結果を記録せずに終わった呼び出し（キャンセル・リクエストの誤りなど）のプローブの枠を返す"""
+        if self.state == HALF_OPEN and self.probes_in_flight > 0:
+            self.probes_in_flight -= 1
+
+    def reset(self) -> None:
+        """closedに戻す（管理画面から）"""
+        self.state = CLOSED
+        self.probes_in_flight = 0
+        self._window.clear()
+        self._failures = 0
+
+    def snapshot(self) -> Dict[str, Any]:
+        self._prune(time.monotonic())
+        total = len(self._window)
+        return {
+            "state": self.state,
+            "retry_in": round(self.retry_in(), 3),
+            "window_requests": total,
+            "window_failure_rate": round(self._failures / total, 4) if total else 0.0,
+            "probes_in_flight": self.probes_in_flight,
+            "opened": self.opened,
+            "rejected": self.rejected,
+            "successes": self.successes,
+            "failures": self.failures
+        }
+
+
+class CircuitBreakerRegistry:
+    """名前（モデル名）ごとのサーキットブレーカー"""
+
+    def __init__(self, enabled: bool = CIRCUIT_BREAKER, **settings: Any):
+        self.enabled = enabled
+        self.settings = settings
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    def get(self, name: str) -> Optional[CircuitBreaker]:
+        """名前のサーキットブレーカーを取得（無効な場合はNone）"""
+        if not self.enabled:
+            return None
+        breaker = self._breakers.get(name)
+        if breaker is None:
+            breaker = self._breakers[name] = CircuitBreaker(name, **self.settings)
+        return breaker
+
+    def is_open(self, name: str) -> bool:
+        """呼び出しを止めている（openで、まだhalf-openになる時間ではない）か"""
+        breaker = self._breakers.get(name) if self.enabled else None
+        return breaker is not None and breaker.state == OPEN and breaker.retry_in() > 0
+
+    def reset(self, name: Optional[str] = None) -> bool:
+        """サーキットをclosedに戻す（nameを省略した場合はすべて）。該当がなければFalse"""
+        if name is None:
+            for breaker in self._breakers.values():
+                breaker.reset()
+            return True
+        breaker = self._breakers.get(name)
+        if breaker is None:
+            return False
+        breaker.reset()
+        return True
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "settings": {
+                "window_seconds": self.settings.get("window_seconds", CIRCUIT_WINDOW_SECONDS),
+                "min_requests": self.settings.get("min_requests", CIRCUIT_MIN_REQUESTS),
+                "failure_rate": self.settings.get("failure_rate", CIRCUIT_FAILURE_RATE),
+                "open_seconds": self.settings.get("open_seconds", CIRCUIT_OPEN_SECONDS),
+                "half_open_probes": self.settings.get("half_open_probes", CIRCUIT_HALF_OPEN_PROBES)
+            },
+            "breakers": {name: breaker.snapshot() for name, breaker in self._breakers.items()}
+        }
+
+
+# プロセス内で共有するインスタンス（OpenRouterのモデルごと）
+model_breakers = CircuitBreakerRegistry()
@@ -0,0 +1,120 @@
+# utils/disconnect.py
+"""
+クライアントの切断を検出して上流のLLMストリームを止める
+
+顧客がタブを閉じても回答の生成を続けると、上流のトークンとワーカーの時間が無駄になる。
+DisconnectWatcherはストリームを読みながら一定間隔で request.is_disconnected() を確認し、
+切断されていれば上流のストリームを閉じる（HTTP接続も閉じられる）。
+サーバーが切断時にタスクをキャンセルした場合（uvicornのASGI 2.3など）も同じように扱う。
+
+切断時点までの回答をどう残すかは PARTIAL_ANSWER_POLICY で切り替える。
+- "save": 途中までの回答を partial 付きでチャットログに保存する（分類のLLM呼び出しはしない）
+- "discard": 何も保存しない
+"""
+import asyncio
+import logging
+import os
+import time
+import uuid
+from contextlib import aclosing
+from datetime import datetime
+from typing import Any, AsyncIterator, Awaitable, Callable, List, Optional, Set
+
+from starlette.requests import Request
+
+from .retry_logic import StreamRestart
+
+# is_disconnected() を確認する間隔（秒）
+DISCONNECT_POLL_INTERVAL = float(os.getenv("DISCONNECT_POLL_INTERVAL", 0.25))
+# 切断時の途中までの回答の扱い（"save" / "discard"）
+PARTIAL_ANSWER_POLICY = os.getenv("PARTIAL_ANSWER_POLICY", "save").lower()
+
+# キャンセルされたリクエストから切り離して実行する保存処理（参照を保持してGCされないようにする）
+_background_tasks: Set[asyncio.Task] = set()
+
+
+def _spawn(coro: Awaitable[Any]) -> None:
+    task = asyncio.ensure_future(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+class DisconnectWatcher:
+    """1つのストリーミングレスポンスの切断を監視するクラス"""
+
+    def __init__(
+        self,
+        request: Request,
+        on_disconnect: Optional[Callable[[str], Awaitable[Any]]] = None,
+        poll_interval: float = DISCONNECT_POLL_INTERVAL
+    ):
+        self.request = request
+        self.on_disconnect = on_disconnect
+        self.poll_interval = poll_interval
+        self.disconnected = False
+        self._texts: List[str] = []
+
+    @property
+    def partial_text(self) -> str:
+        """切断までに受け取ったテキスト"""
+        return "".join(self._texts)
+
+    def _handle_disconnect(self) -> None:
+        if self.disconnected:
+            return
+        self.disconnected = True
+        logging.info(f"Client disconnected; upstream stream closed after {len(self.partial_text)} chars")
+        if self.on_disconnect is not None:
+            # リクエストのタスクはキャンセルされているため、保存は別タスクで行う
+            _spawn(self.on_disconnect(self.partial_text))
+
+    async def watch(self, stream: AsyncIterator[Any]) -> AsyncIterator[Any]:
+        """
+        ストリームをそのまま返しつつ切断を監視する
+
+        切断されたら上流のストリームを閉じて終了する（呼び出し側は self.disconnected で判定）。
+        """
+        last_poll = time.monotonic()
+        try:
+            async with aclosing(stream):
+                async for item in stream:
+                    now = time.monotonic()
+                    if now - last_poll >= self.poll_interval:
+                        last_poll = now
+                        if await self.request.is_disconnected():
+                            self._handle_disconnect()
+                            return
+                    if isinstance(item, str):
+                        self._texts.append(item)
+                    elif isinstance(item, StreamRestart):
+                        self._texts.clear()
+                    yield item
+        except asyncio.CancelledError:
+            # サーバーが切断を検出してレスポンスのタスクをキャンセルした
+            self._handle_disconnect()
+            raise
+
+
+def partial_answer_saver(chatroom_manager: Any, user_id: Any) -> Optional[Callable[[str], Awaitable[None]]]:
+    """PARTIAL_ANSWER_POLICYに応じた切断時の保存処理を返す（保存しない場合はNone）"""
+    if PARTIAL_ANSWER_POLICY != "save":
+        return None
+
+    async def save(text: str) -> None:
+        if not text:
+            return
+        message = {
+            "role": "assistant",
+            "content": text,
+            "user_id": user_id,
+            "id": str(uuid.uuid4()),
+            "timestamp": datetime.now().isoformat(),
+            "partial": True
+        }
+        try:
+            await chatroom_manager.add_message(user_id, message)
+            chatroom_manager.end_turn(user_id)
+        except Exception as e:
+            logging.error(f"Failed to save partial answer for {user_id}: {e}")
+
+    return save
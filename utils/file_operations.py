@@ -1,84 +1,277 @@
 from functools import lru_cache
 import asyncio
 import aiofiles
-import json
+import atexit
+import logging
 import os
-from typing import Any, Dict, List, Optional, Union
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional, Union
 
-# キャッシュサイズ設定
-CACHE_SIZE = 100
+from . import json_codec
+from .json_cache import JsonCache, file_signature, parse_prefix_budgets
+from .snapshot import freeze, thaw
 
-# JSONデータのキャッシュ
-_json_cache = {}
-_json_cache_ttl = {}  # Time-to-live for cache entries
+# キャッシュサイズ設定（バイト数の上限）
+CACHE_MAX_BYTES = int(os.getenv("JSON_CACHE_MAX_BYTES", 64 * 1024 * 1024))
 CACHE_TTL = 60  # キャッシュの有効期間（秒）
+# プレフィックスごとの予算（チャットログがCRMデータを追い出さないように分ける）
+CACHE_PREFIX_BUDGETS = parse_prefix_budgets(os.getenv(
+    "JSON_CACHE_PREFIX_BUDGETS",
+    "data/chat_log_=16777216,data/thread_history_=16777216,crm_dummy_data/=8388608"
+))
 
-async def load_json(filepath: str, default: Any) -> Any:
+# キャッシュの整合性確認の間隔（秒）。0なら読み込みのたびにos.statでファイルの更新を確認する
+# （gunicornの他ワーカーやCeleryワーカーが書き込んだ内容を古いまま返さないため）
+CACHE_REVALIDATE_INTERVAL = float(os.getenv("JSON_CACHE_REVALIDATE_INTERVAL", 0))
+
+# JSONデータのキャッシュ
+_json_cache = JsonCache(CACHE_MAX_BYTES, CACHE_TTL, CACHE_PREFIX_BUDGETS, CACHE_REVALIDATE_INTERVAL)
+
+# fsyncのポリシー（"none": しない, "batch": 一定間隔ごとにまとめて, "always": 書き込みごと）
+FSYNC_POLICY = os.getenv("FSYNC_POLICY", "batch")
+FSYNC_BATCH_INTERVAL = float(os.getenv("FSYNC_BATCH_INTERVAL", 1.0))  # batch時のfsync間隔（秒）
+
+# 直前の正常な世代を残すか
+KEEP_BACKUP = os.getenv("JSON_KEEP_BACKUP", "true").lower() == "true"
+BACKUP_SUFFIX = ".bak"
+QUARANTINE_SUFFIX = ".corrupt"
+
+# batch時にまだfsyncしていないファイル（次のグループコミットでまとめてfsyncする）
+_unsynced: set = set()
+_sync_lock = threading.Lock()
+_sync_timer: Optional[threading.Timer] = None
+
+def should_fsync() -> bool:
+    """今回の書き込みをすぐにfsyncするか（batchの場合はsync_laterでまとめる）"""
+    return FSYNC_POLICY == "always"
+
+def sync_later(filepath: str) -> None:
     """
-    JSONファイルを読み込む（キャッシュ機能付き）
+    batchポリシーで、書き込んだファイルを FSYNC_BATCH_INTERVAL 秒以内にfsyncする
+
+    間隔の最初の書き込みでタイマーを開始し、間隔の終わりにそれまでのファイルをまとめてfsyncする
+    （その後に書き込みがなくても、書き込んだ内容は間隔内に永続化される）。
     """
-    current_time = asyncio.get_event_loop().time()
-    
-    # キャッシュが有効かチェック
-    if filepath in _json_cache and filepath in _json_cache_ttl:
-        if current_time - _json_cache_ttl[filepath] < CACHE_TTL:
-            return _json_cache[filepath]
+    global _sync_timer
+    if FSYNC_POLICY != "batch":
+        return
+    with _sync_lock:
+        _unsynced.add(filepath)
+        if _sync_timer is None:
+            _sync_timer = threading.Timer(FSYNC_BATCH_INTERVAL, sync_pending)
+            _sync_timer.daemon = True
+            _sync_timer.start()
+
+def sync_pending() -> None:
+    """fsyncしていないファイルとそのディレクトリをまとめてfsyncする（グループコミット）"""
+    global _unsynced, _sync_timer
+    with _sync_lock:
+        paths, _unsynced = _unsynced, set()
+        if _sync_timer is not None:
+            _sync_timer.cancel()
+        _sync_timer = None
+    dirpaths = set()
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            # 削除・隔離されたファイル
+            continue
+        try:
+            os.fsync(fd)
+        except OSError as e:
+            logging.warning(f"Failed to fsync {path}: {e}")
+        finally:
+            os.close(fd)
+        dirpaths.add(os.path.dirname(path) or ".")
+    for dirpath in dirpaths:
+        _fsync_dir(dirpath)
+
+# 終了時に残りをfsyncする
+atexit.register(sync_pending)
+
+def _fsync_dir(dirpath: str) -> None:
+    """rename結果を永続化するためにディレクトリをfsync"""
+    try:
+        fd = os.open(dirpath, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def _keep_backup(filepath: str) -> None:
+    """置き換え前のファイルを直前の世代として残す"""
+    backup_path = filepath + BACKUP_SUFFIX
+    tmp_backup = backup_path + ".tmp"
+    try:
+        # ハードリンクなら内容をコピーせずに残せる
+        if os.path.exists(tmp_backup):
+            os.remove(tmp_backup)
+        os.link(filepath, tmp_backup)
+    except OSError:
+        shutil.copy2(filepath, tmp_backup)
+    os.replace(tmp_backup, backup_path)
+
+def atomic_write_text(filepath: str, text: Union[str, bytes], backup: bool = KEEP_BACKUP) -> None:
+    """
+    一時ファイルに書き込んでからos.replaceで置き換える（同期版）
+
+    書き込み途中でクラッシュしても、読み手には古い内容か新しい内容のどちらかが見える。
+    textにはエンコード済みのバイト列（UTF-8）も渡せる。
+    """
+    dirpath = os.path.dirname(filepath) or "."
+    os.makedirs(dirpath, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{os.path.basename(filepath)}.", suffix=".tmp", dir=dirpath)
+    sync = should_fsync()
+    try:
+        if isinstance(text, str):
+            text = text.encode("utf-8")
+        with os.fdopen(fd, "wb") as f:
+            f.write(text)
+            f.flush()
+            if sync:
+                os.fsync(f.fileno())
+        if backup and os.path.exists(filepath):
+            _keep_backup(filepath)
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    if sync:
+        _fsync_dir(dirpath)
+    else:
+        sync_later(filepath)
+
+def quarantine_file(filepath: str) -> str:
+    """壊れたファイルを隔離し、隔離先のパスを返す"""
+    quarantine_path = f"{filepath}{QUARANTINE_SUFFIX}-{int(time.time())}"
+    os.replace(filepath, quarantine_path)
+    return quarantine_path
+
+def recover_json(filepath: str) -> Any:
+    """
+    壊れたJSONファイルを隔離し、直前の世代から復元する（同期版）
+
+    復元できた場合はそのデータを、できなかった場合はValueErrorを送出する。
+    """
+    quarantine_path = quarantine_file(filepath)
+    logging.warning(f"Corrupted JSON file quarantined: {filepath} -> {quarantine_path}")
+    backup_path = filepath + BACKUP_SUFFIX
+    if os.path.exists(backup_path):
+        try:
+            with open(backup_path, "rb") as f:
+                data = json_codec.loads(f.read())
+        except (json_codec.JSONDecodeError, UnicodeDecodeError):
+            data = None
+        else:
+            atomic_write_text(filepath, json_codec.dumps(data), backup=False)
+            logging.warning(f"Restored {filepath} from {backup_path}")
+            return data
+    raise ValueError(f"No valid backup for {filepath}")
+
+async def load_json_snapshot(filepath: str, default: Any) -> Any:
+    """
+    JSONファイルを読み取り専用のスナップショットとして読み込む（キャッシュ機能付き）
+
+    dictはMappingProxyType、listはtupleで返す。コピーしないため大きなデータでも軽い。
+    """
+    # キャッシュが有効かチェック（ファイルが更新されていないこともstatで確認する）
+    hit, data = _json_cache.get(filepath, lambda: file_signature(filepath))
+    if hit:
+        return data
     
     try:
-        # ファイルが存在するかチェック
-        if not os.path.exists(filepath):
-            _json_cache[filepath] = default
-            _json_cache_ttl[filepath] = current_time
-            return default
+        # ファイルが存在するかチェック（読み込む前のシグネチャを記録する）
+        signature = file_signature(filepath)
+        if signature is None:
+            data = freeze(default)
+            _json_cache.set(filepath, data, signature=None)
+            return data
         
-        async with aiofiles.open(filepath, "r", encoding='utf-8') as f:
+        async with aiofiles.open(filepath, "rb") as f:
             content = await f.read()
             try:
-                data = json.loads(content)
-                # キャッシュを更新
-                _json_cache[filepath] = data
-                _json_cache_ttl[filepath] = current_time
+                data = freeze(json_codec.loads(content))
+                # キャッシュを更新（サイズはファイルの長さで見積もる）
+                _json_cache.set(filepath, data, size=len(content), signature=signature)
+                return data
+            except (json_codec.JSONDecodeError, UnicodeDecodeError):
+                # 壊れたファイルは隔離し、直前の世代があれば復元する
+                try:
+                    data = await asyncio.to_thread(recover_json, filepath)
+                except ValueError:
+                    logging.error(f"Could not recover {filepath}; using default")
+                    data = default
+                data = freeze(data)
+                # 復元したファイルの長さで見積もる（復元できなければデータから見積もる）
+                signature = file_signature(filepath)
+                _json_cache.set(filepath, data, size=signature[1] if signature else None, signature=signature)
                 return data
-            except json.JSONDecodeError:
-                _json_cache[filepath] = default
-                _json_cache_ttl[filepath] = current_time
-                return default
     except FileNotFoundError:
-        _json_cache[filepath] = default
-        _json_cache_ttl[filepath] = current_time
-        return default
+        data = freeze(default)
+        _json_cache.set(filepath, data, signature=None)
+        return data
+
+async def load_json(filepath: str, default: Any) -> Any:
+    """
+    JSONファイルを読み込む（キャッシュ機能付き）
+
+    変更可能なコピーを返すため、呼び出し側が変更してもキャッシュには影響しない。
+    読み取りだけならload_json_snapshotを使う。
+    """
+    return thaw(await load_json_snapshot(filepath, default))
 
 async def save_json(filepath: str, data: Any) -> None:
     """
-    JSONファイルを保存し、キャッシュも更新する
+    JSONファイルをアトミックに保存し、キャッシュも更新する
+
+    保存形式はコンパクトなJSON（人が読む場合はto_pretty_jsonを使う）。
     """
-    # ディレクトリが存在することを確認
-    os.makedirs(os.path.dirname(filepath), exist_ok=True)
-    
-    async with aiofiles.open(filepath, "w", encoding='utf-8') as f:
-        json_str = json.dumps(data, indent=2, ensure_ascii=False)
-        await f.write(json_str)
+    payload = json_codec.dumps_bytes(data)
+    await asyncio.to_thread(atomic_write_text, filepath, payload)
     
-    # キャッシュを更新
-    _json_cache[filepath] = data
-    _json_cache_ttl[filepath] = asyncio.get_event_loop().time()
+    # キャッシュを更新（保存後に呼び出し側がdataを変更してもキャッシュは変わらない）
+    _json_cache.set(filepath, freeze(data), size=len(payload), signature=file_signature(filepath))
+
+@asynccontextmanager
+async def edit_json(filepath: str, default: Any) -> AsyncIterator[Any]:
+    """
+    JSONファイルを変更して保存する
+
+    ブロック内で例外が発生した場合は保存せず、キャッシュもディスクも変更されない。
+
+    使用例:
+        async with edit_json(path, {}) as data:
+            data["key"] = value
+    """
+    data = await load_json(filepath, default)
+    yield data
+    await save_json(filepath, data)
 
 async def to_pretty_json(data: Any) -> str:
     """
     データを整形されたJSON文字列に変換
     """
-    return json.dumps(data, ensure_ascii=False, indent=2)
+    return json_codec.dumps(data, pretty=True)
 
 # キャッシュをクリアする関数
 def clear_cache(filepath: Optional[str] = None) -> None:
     """
     特定のファイルまたはすべてのキャッシュをクリア
     """
-    if filepath:
-        if filepath in _json_cache:
-            del _json_cache[filepath]
-        if filepath in _json_cache_ttl:
-            del _json_cache_ttl[filepath]
-    else:
-        _json_cache.clear()
-        _json_cache_ttl.clear()
\ No newline at end of file
+    _json_cache.invalidate(filepath)
+
+def cache_stats() -> Dict[str, Any]:
+    """
+    キャッシュのヒット・ミス・破棄の統計を取得
+    """
+    return _json_cache.stats()
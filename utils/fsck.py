@@ -0,0 +1,109 @@
+# utils/fsck.py
+"""
+データディレクトリの整合性チェック
+
+使用例:
+    python -m utils.fsck data            # チェックのみ
+    python -m utils.fsck data --repair   # 修復・隔離を実行
+
+- *.json: デコードできなければ直前の世代（.bak）から復元し、なければ隔離する
+- *.jsonl: 壊れた行（書き込み途中で途切れた末尾行など）を取り除き、取り除いた行は隔離ファイルに残す
+- 書き込み途中で残った一時ファイル（*.tmp）を削除する
+"""
+import os
+import sys
+from typing import Dict, List
+
+from . import json_codec
+from .file_operations import (
+    BACKUP_SUFFIX,
+    QUARANTINE_SUFFIX,
+    atomic_write_text,
+    quarantine_file,
+    recover_json
+)
+
+
+def _check_json(filepath: str) -> bool:
+    try:
+        with open(filepath, "rb") as f:
+            json_codec.loads(f.read())
+        return True
+    except (json_codec.JSONDecodeError, UnicodeDecodeError):
+        return False
+
+
+def _split_jsonl(filepath: str):
+    """JSONLファイルを正常な行と壊れた行に分ける"""
+    good, bad = [], []
+    with open(filepath, "rb") as f:
+        content = f.read()
+    for line in content.split(b"\n"):
+        if not line.strip():
+            continue
+        try:
+            json_codec.loads(line)
+            good.append(line)
+        except (json_codec.JSONDecodeError, UnicodeDecodeError):
+            bad.append(line)
+    return good, bad
+
+
+def fsck(data_dir: str, repair: bool = False) -> Dict[str, List[str]]:
+    """
+    データディレクトリをスキャンし、結果を種類ごとに返す
+    """
+    report = {"ok": [], "restored": [], "quarantined": [], "repaired": [], "removed_tmp": [], "corrupt": []}
+    for filename in sorted(os.listdir(data_dir)):
+        filepath = os.path.join(data_dir, filename)
+        if not os.path.isfile(filepath) or QUARANTINE_SUFFIX in filename:
+            continue
+
+        if filename.endswith(".tmp"):
+            if repair:
+                os.remove(filepath)
+            report["removed_tmp"].append(filename)
+
+        elif filename.endswith(".json") or filename.endswith(".json" + BACKUP_SUFFIX):
+            if _check_json(filepath):
+                report["ok"].append(filename)
+            elif not repair:
+                report["corrupt"].append(filename)
+            elif filename.endswith(BACKUP_SUFFIX):
+                quarantine_file(filepath)
+                report["quarantined"].append(filename)
+            else:
+                try:
+                    recover_json(filepath)
+                    report["restored"].append(filename)
+                except ValueError:
+                    report["quarantined"].append(filename)
+
+        elif filename.endswith(".jsonl"):
+            good, bad = _split_jsonl(filepath)
+            if not bad:
+                report["ok"].append(filename)
+            elif not repair:
+                report["corrupt"].append(filename)
+            else:
+                with open(f"{filepath}{QUARANTINE_SUFFIX}-lines", "ab") as f:
+                    f.write(b"\n".join(bad) + b"\n")
+                text = b"".join(line + b"\n" for line in good).decode("utf-8")
+                atomic_write_text(filepath, text, backup=False)
+                report["repaired"].append(filename)
+    return report
+
+
+if __name__ == "__main__":
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    if len(args) != 1:
+        print("Usage: python -m utils.fsck <data_dir> [--repair]")
+        sys.exit(1)
+    result = fsck(args[0], repair="--repair" in sys.argv)
+    for kind, files in result.items():
+        if kind == "ok":
+            print(f"ok: {len(files)} files")
+            continue
+        for name in files:
+            print(f"{kind}: {name}")
+    sys.exit(1 if result["corrupt"] else 0)
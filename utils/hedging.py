@@ -0,0 +1,213 @@
+# utils/hedging.py
+"""
+最初のトークンが遅いストリームのヘッジ（予備のリクエスト）
+
+上流がときどき止まると、その数%のリクエストがTTFTのp99を決めてしまう。
+最初のトークンが期限（モデルごとのTTFTのパーセンタイルから決める）までに届かなければ、
+フォールバック先の次のモデルにも同時にリクエストを送り、先にトークンを返した方を採用して
+もう一方はキャンセルする。
+
+ヘッジした割合・どちらが勝ったか・余分に送ったプロンプトの量を記録し、期限の調整に使う。
+"""
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Callable, Deque, Dict, Optional
+
+# ヘッジを使うか（余分なリクエストの費用がかかるため既定では使わない）
+HEDGE_REQUESTS = os.getenv("HEDGE_REQUESTS", "false").lower() == "true"
+# 期限にするTTFTのパーセンタイル（0.95ならおよそ5%のリクエストをヘッジする）
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", 0.95))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", 1.0))  # 期限の下限（秒）
+HEDGE_MAX_DELAY = float(os.getenv("HEDGE_MAX_DELAY", 8.0))  # 期限の上限（秒）
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", 3.0))  # TTFTのサンプルが少ない間の期限（秒）
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", 20))
+TTFT_WINDOW = int(os.getenv("TTFT_WINDOW", 500))  # モデルごとに保持するTTFTのサンプル数
+
+_EMPTY = object()
+
+
+class TTFTTracker:
+    """モデルごとの直近のTTFT（リクエストから最初のトークンまでの秒数）"""
+
+    def __init__(self, window: int = TTFT_WINDOW):
+        self.window = window
+        self._samples: Dict[str, Deque[float]] = {}
+
+    def record(self, model: str, seconds: float) -> None:
+        samples = self._samples.get(model)
+        if samples is None:
+            samples = self._samples[model] = deque(maxlen=self.window)
+        samples.append(seconds)
+
+    def percentile(self, model: str, p: float) -> Optional[float]:
+        samples = self._samples.get(model)
+        if not samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+    def deadline(
+        self,
+        model: str,
+        percentile: float = HEDGE_PERCENTILE,
+        min_delay: float = HEDGE_MIN_DELAY,
+        max_delay: float = HEDGE_MAX_DELAY,
+        default_delay: float = HEDGE_DEFAULT_DELAY,
+        min_samples: int = HEDGE_MIN_SAMPLES
+    ) -> float:
+        """ヘッジするまでに最初のトークンを待つ秒数"""
+        samples = self._samples.get(model)
+        if samples is None or len(samples) < min_samples:
+            return default_delay
+        return min(max_delay, max(min_delay, self.percentile(model, percentile)))
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            model: {
+                "samples": len(samples),
+                "p50": round(self.percentile(model, 0.5), 3),
+                "p95": round(self.percentile(model, 0.95), 3),
+                "p99": round(self.percentile(model, 0.99), 3),
+                "hedge_deadline": round(self.deadline(model), 3)
+            }
+            for model, samples in self._samples.items() if samples
+        }
+
+
+class HedgeMetrics:
+    """ヘッジの回数と結果"""
+
+    def __init__(self):
+        self.requests = 0  # ヘッジが有効だったリクエスト
+        self.hedged = 0  # 期限までに最初のトークンが届かず、予備のリクエストを送った回数
+        self.primary_wins = 0  # ヘッジした後、元のリクエストが先にトークンを返した回数
+        self.hedge_wins = 0  # 予備のリクエストが先にトークンを返した回数
+        self.cancelled = 0  # キャンセルしたリクエスト
+        self.wasted_tokens = 0  # 採用しなかったリクエストから受け取ったトークン（差分の数）
+        self.extra_prompt_chars = 0  # 予備のリクエストで余分に送ったプロンプトの文字数
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "hedged": self.hedged,
+            "hedge_rate": round(self.hedged / self.requests, 4) if self.requests else 0.0,
+            "primary_wins": self.primary_wins,
+            "hedge_wins": self.hedge_wins,
+            "cancelled": self.cancelled,
+            "wasted_tokens": self.wasted_tokens,
+            "extra_prompt_chars": self.extra_prompt_chars
+        }
+
+
+# プロセス内で共有するインスタンス
+ttft_tracker = TTFTTracker()
+hedge_metrics = HedgeMetrics()
+
+
+async def _cancel(task: asyncio.Future, stream: Any) -> None:
+    """最初の要素を待っているタスクをキャンセルし、ストリームを閉じる"""
+    task.cancel()
+    try:
+        await task
+    except BaseException:
+        pass
+    await stream.aclose()
+
+
+async def hedged_stream(
+    start_primary: Callable[[], AsyncIterator[Any]],
+    start_hedge: Callable[[], AsyncIterator[Any]],
+    delay: float,
+    hedge_cost: int = 0,
+    metrics: HedgeMetrics = hedge_metrics
+) -> AsyncIterator[Any]:
+    """
+    最初の要素がdelay秒以内に届かなければ予備のストリームも開始し、先に要素を返した方を流す
+
+    片方が失敗した場合はもう一方を待つ（両方失敗した場合は後の例外を送出する）。
+    hedge_costは予備のリクエストで余分に送るプロンプトの文字数（メトリクス用）。
+    """
+    metrics.requests += 1
+    primary = start_primary()
+    contenders: Dict[asyncio.Future, Any] = {asyncio.ensure_future(primary.__anext__()): primary}
+    winner = None
+    first: Any = _EMPTY
+    try:
+        done, _ = await asyncio.wait(contenders, timeout=delay)
+        hedge = None
+        if not done:
+            metrics.hedged += 1
+            metrics.extra_prompt_chars += hedge_cost
+            hedge = start_hedge()
+            contenders[asyncio.ensure_future(hedge.__anext__())] = hedge
+
+        error: Optional[BaseException] = None
+        while contenders and winner is None:
+            done, _ = await asyncio.wait(contenders, return_when=asyncio.FIRST_COMPLETED)
+            # 同時に終わった場合は元のリクエストを優先する
+            for task in sorted(done, key=lambda t: contenders[t] is not primary):
+                stream = contenders.pop(task)
+                exception = task.exception()
+                if exception is not None and not isinstance(exception, StopAsyncIteration):
+                    error = exception
+                    await stream.aclose()
+                    continue
+                if winner is not None:
+                    # 勝者が決まった後に届いた最初のトークンは使わない
+                    if exception is None:
+                        metrics.wasted_tokens += 1
+                    await stream.aclose()
+                    continue
+                winner = stream
+                first = _EMPTY if exception is not None else task.result()
+        if winner is None:
+            raise error
+        if hedge is not None:
+            if winner is hedge:
+                metrics.hedge_wins += 1
+            else:
+                metrics.primary_wins += 1
+        for task, stream in list(contenders.items()):
+            metrics.cancelled += 1
+            await _cancel(task, stream)
+        contenders.clear()
+
+        if first is _EMPTY:
+            return
+        yield first
+        async for item in winner:
+            yield item
+    finally:
+        # 呼び出し側が途中で閉じた（クライアントが切断した）場合も両方のストリームを閉じる
+        for task, stream in contenders.items():
+            await _cancel(task, stream)
+        if winner is not None:
+            await winner.aclose()
+
+
+class FirstTokenTimer:
+    """リクエストから最初のトークンまでの時間を計ってTTFTTrackerに記録する（受け取った差分の数も数える）"""
+
+    def __init__(self, model: str, tracker: TTFTTracker = ttft_tracker):
+        self.model = model
+        self.tracker = tracker
+        self.start = time.monotonic()
+        self.first_at: Optional[float] = None
+        self.tokens = 0
+
+    @property
+    def ttft(self) -> Optional[float]:
+        return None if self.first_at is None else self.first_at - self.start
+
+    def mark(self) -> None:
+        """差分を受け取るたびに呼び出す"""
+        self.tokens += 1
+        if self.first_at is None:
+            self.first_at = time.monotonic()
+            self.tracker.record(self.model, self.first_at - self.start)
+
+    def generation_seconds(self) -> Optional[float]:
+        """最初のトークンから現在までの秒数（生成速度の計算用）"""
+        return None if self.first_at is None else time.monotonic() - self.first_at
@@ -0,0 +1,400 @@
+# utils/intent_classifier.py
+"""
+発話の意図ラベル（スレッドの type）をローカルで判定する軽量な分類器
+
+ラベルのためだけにLLMの往復を待たないよう、次の順番で判定する。
+1. ルール: あいさつ・お礼・相づちなどの短い発話を正規表現で判定する（ラベルはモデルの表記にそろえる）
+2. 線形モデル: 文字n-gram（ハッシュ化）の特徴量に対する多クラスロジスティック回帰
+3. どちらも確信度が INTENT_CONFIDENCE_THRESHOLD 未満なら None を返す（LLMで分類する）
+
+モデルは保存済みのスレッド履歴（thread_history_*）のラベルから学習する。
+    python -m utils.intent_classifier train data            # 学習して data/intent_model.json に保存
+    python -m utils.intent_classifier eval data             # 保存済みのモデルを評価
+    python -m utils.intent_classifier train data --test-ratio 0.2 --out data/intent_model.json
+"""
+import glob
+import math
+import os
+import random
+import re
+import sys
+import time
+import unicodedata
+import zlib
+from collections import Counter
+from datetime import datetime
+from operator import add
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from . import json_codec
+from .file_operations import atomic_write_text
+
+# ローカルの分類器を使うか（falseなら常にLLMで分類する）
+INTENT_CLASSIFIER = os.getenv("INTENT_CLASSIFIER", "true").lower() == "true"
+INTENT_MODEL_PATH = os.getenv("INTENT_MODEL_PATH", os.path.join("data", "intent_model.json"))
+# この確信度（最大のクラス確率）未満ならLLMに任せる
+INTENT_CONFIDENCE_THRESHOLD = float(os.getenv("INTENT_CONFIDENCE_THRESHOLD", 0.8))
+
+HASH_DIM = 1 << 18  # 特徴量のハッシュの次元数
+NGRAM_RANGE = (1, 3)  # 文字n-gramの長さ
+MAX_CHARS = 256  # 特徴量に使う先頭の文字数（長い回答でも一定時間で判定するため）
+RULE_MAX_CHARS = 40  # ルールを適用する発話の最大文字数
+# 学習データから除くラベル（最初の発話に付く固定のラベルなど）
+IGNORED_LABELS = {"first"}
+
+# 短い発話のルール（上から順に判定）
+RULES: List[Tuple[str, "re.Pattern"]] = [
+    ("Greeting", re.compile(r"^(こんにちは|こんばんは|おはよう|はじめまして|初めまして|よろしくお願い)")),
+    ("Gratitude", re.compile(r"(ありがとう|有難う|助かりました|感謝します)")),
+    ("Acknowledgment", re.compile(r"^(はい|了解|承知|わかりました|分かりました|なるほど|OK|ok)[。！!、\s]*$")),
+    ("Farewell", re.compile(r"^(さようなら|失礼します|またよろしく|それでは)")),
+]
+
+_WHITESPACE = re.compile(r"\s+")
+_LABEL_STRIP = re.compile(r"[\s\"'`*.。、,!！?？:：「」『』()（）\[\]]+")
+
+
+def normalize_text(text: str) -> str:
+    """全角・半角や大文字・小文字の違いをなくし、空白をまとめる"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+def normalize_label(label: Any) -> Optional[str]:
+    """LLMが返したラベルの記号や空白を取り除く（空になればNone）"""
+    if not isinstance(label, str):
+        return None
+    label = _LABEL_STRIP.sub("", label)
+    return label or None
+
+
+def featurize(text: str, max_chars: int = MAX_CHARS, ngram_range: Tuple[int, int] = NGRAM_RANGE,
+              dim: int = HASH_DIM) -> List[int]:
+    """
+    文字n-gramのハッシュ値（重複なし）を返す
+
+    特徴量はすべて値1の2値特徴で、スコアには 1/sqrt(特徴数) を掛けて長さの影響をならす。
+    ハッシュにはプロセスごとに変わらない crc32 を使う。
+    """
+    normalized = normalize_text(text)[:max_chars]
+    if not normalized:
+        return []
+    # 前後の空白で発話の先頭・末尾のn-gramを区別する
+    text = " " + normalized + " "
+    features = set()
+    low, high = ngram_range
+    for n in range(low, high + 1):
+        for i in range(len(text) - n + 1):
+            features.add(zlib.crc32(text[i:i + n].encode("utf-8")) % dim)
+    return list(features)
+
+
+def _softmax(scores: List[float]) -> List[float]:
+    top = max(scores)
+    exps = [math.exp(score - top) for score in scores]
+    total = sum(exps)
+    return [value / total for value in exps]
+
+
+class LinearIntentModel:
+    """ハッシュ化した文字n-gramに対する多クラスロジスティック回帰"""
+
+    def __init__(self, labels: List[str], weights: Optional[Dict[int, List[float]]] = None,
+                 bias: Optional[List[float]] = None, meta: Optional[Dict[str, Any]] = None):
+        self.labels = labels
+        self.weights: Dict[int, List[float]] = weights or {}
+        self.bias = bias or [0.0] * len(labels)
+        self.meta = meta or {}
+
+    def _scores(self, features: List[int]) -> List[float]:
+        total = [0.0] * len(self.labels)
+        weights = self.weights
+        for feature in features:
+            row = weights.get(feature)
+            if row is not None:
+                total = list(map(add, total, row))
+        scale = 1.0 / math.sqrt(len(features)) if features else 0.0
+        return [b + scale * t for b, t in zip(self.bias, total)]
+
+    def predict_proba(self, text: str) -> List[float]:
+        return _softmax(self._scores(featurize(text)))
+
+    def predict(self, text: str) -> Tuple[str, float]:
+        """最も確率の高いラベルとその確率を返す"""
+        probs = self.predict_proba(text)
+        best = max(range(len(probs)), key=probs.__getitem__)
+        return self.labels[best], probs[best]
+
+    @classmethod
+    def train(cls, samples: Sequence[Tuple[str, str]], epochs: int = 12, learning_rate: float = 0.5,
+              l2: float = 1e-6, seed: int = 0) -> "LinearIntentModel":
+        """(テキスト, ラベル) のリストからSGDで学習する"""
+        labels = sorted({label for _, label in samples})
+        if len(labels) < 2:
+            raise ValueError("学習には2種類以上のラベルが必要です")
+        index = {label: i for i, label in enumerate(labels)}
+        data = [(featurize(text), index[label]) for text, label in samples]
+        model = cls(labels)
+        k = len(labels)
+        rng = random.Random(seed)
+        for epoch in range(epochs):
+            rng.shuffle(data)
+            rate = learning_rate / (1 + epoch)
+            decay = 1 - rate * l2
+            for features, target in data:
+                if not features:
+                    continue
+                probs = _softmax(model._scores(features))
+                probs[target] -= 1.0
+                scale = 1.0 / math.sqrt(len(features))
+                model.bias = [b - rate * g for b, g in zip(model.bias, probs)]
+                step = [rate * g * scale for g in probs]
+                for feature in features:
+                    row = model.weights.get(feature)
+                    if row is None:
+                        row = model.weights[feature] = [0.0] * k
+                    for j in range(k):
+                        row[j] = row[j] * decay - step[j]
+        return model
+
+    def to_dict(self) -> Dict[str, Any]:
+        # 0に近い重みの行は保存しない（ファイルサイズを抑える）
+        weights = {
+            feature: [round(w, 5) for w in row]
+            for feature, row in self.weights.items()
+            if max(abs(w) for w in row) >= 1e-4
+        }
+        return {
+            "version": 1,
+            "labels": self.labels,
+            "hash_dim": HASH_DIM,
+            "ngram_range": list(NGRAM_RANGE),
+            "max_chars": MAX_CHARS,
+            "bias": [round(b, 5) for b in self.bias],
+            "weights": weights,
+            "meta": self.meta
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "LinearIntentModel":
+        if data.get("hash_dim") != HASH_DIM or tuple(data.get("ngram_range", ())) != NGRAM_RANGE:
+            raise ValueError("特徴量の設定が異なるモデルです（再学習してください）")
+        weights = {int(feature): row for feature, row in data["weights"].items()}
+        return cls(data["labels"], weights, data["bias"], data.get("meta"))
+
+    def save(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        atomic_write_text(path, json_codec.dumps_bytes(self.to_dict()), backup=False)
+
+    @classmethod
+    def load(cls, path: str) -> "LinearIntentModel":
+        with open(path, "rb") as f:
+            return cls.from_dict(json_codec.loads(f.read()))
+
+
+class IntentClassifier:
+    """ルールと線形モデルで意図ラベルを判定し、確信度が低ければNoneを返す"""
+
+    def __init__(self, model: Optional[LinearIntentModel] = None,
+                 threshold: float = INTENT_CONFIDENCE_THRESHOLD):
+        self.model = model
+        self.threshold = threshold
+        self.rules = self._rules_for(model)
+
+        # メトリクス
+        self.rule_hits = 0
+        self.model_hits = 0
+        self.escalated = 0
+
+    @staticmethod
+    def _rules_for(model: Optional[LinearIntentModel]) -> List[Tuple[str, "re.Pattern"]]:
+        """
+        ルールのラベルをモデルが学習したラベルの表記にそろえる
+
+        スレッドの type に同じ意図の別の表記が混ざらないよう、load_training_data と同じく
+        大文字・小文字を区別せずに対応させ、学習したラベルにないルールは使わない。
+        モデルがなければルールのラベルをそのまま使う。
+        """
+        if model is None:
+            return list(RULES)
+        vocabulary = {label.casefold(): label for label in model.labels}
+        rules = []
+        for label, pattern in RULES:
+            canonical = vocabulary.get(label.casefold())
+            if canonical is not None:
+                rules.append((canonical, pattern))
+        return rules
+
+    def classify(self, text: str) -> Tuple[Optional[str], float]:
+        """
+        (ラベル, 確信度) を返す。ラベルがNoneの場合はLLMで分類する
+        """
+        stripped = text.strip()
+        if len(stripped) <= RULE_MAX_CHARS:
+            normalized = unicodedata.normalize("NFKC", stripped)
+            for label, pattern in self.rules:
+                if pattern.search(normalized):
+                    self.rule_hits += 1
+                    return label, 1.0
+        if self.model is not None:
+            label, confidence = self.model.predict(text)
+            if confidence >= self.threshold:
+                self.model_hits += 1
+                return label, confidence
+            self.escalated += 1
+            return None, confidence
+        self.escalated += 1
+        return None, 0.0
+
+    def get_metrics(self) -> Dict[str, Any]:
+        total = self.rule_hits + self.model_hits + self.escalated
+        return {
+            "model_loaded": self.model is not None,
+            "labels": len(self.model.labels) if self.model is not None else 0,
+            "threshold": self.threshold,
+            "rule_hits": self.rule_hits,
+            "model_hits": self.model_hits,
+            "escalated": self.escalated,
+            "local_ratio": round((self.rule_hits + self.model_hits) / total, 4) if total else 0.0
+        }
+
+
+_classifier: Optional[IntentClassifier] = None
+
+
+def get_intent_classifier() -> Optional[IntentClassifier]:
+    """プロセス内で共有する分類器を取得（無効な場合はNone）"""
+    global _classifier
+    if not INTENT_CLASSIFIER:
+        return None
+    if _classifier is None:
+        model = None
+        if os.path.exists(INTENT_MODEL_PATH):
+            try:
+                model = LinearIntentModel.load(INTENT_MODEL_PATH)
+            except Exception as e:
+                print(f"Failed to load intent model {INTENT_MODEL_PATH}: {e}")
+        _classifier = IntentClassifier(model)
+    return _classifier
+
+
+# ---- 学習データ ----
+
+def _read_records(path: str) -> List[Dict[str, Any]]:
+    with open(path, "rb") as f:
+        content = f.read()
+    if path.endswith(".jsonl"):
+        records = []
+        for line in content.split(b"\n"):
+            if line.strip():
+                try:
+                    records.append(json_codec.loads(line))
+                except json_codec.JSONDecodeError:
+                    continue
+        return records
+    try:
+        data = json_codec.loads(content)
+    except json_codec.JSONDecodeError:
+        return []
+    return data if isinstance(data, list) else []
+
+
+def load_training_data(data_dir: str) -> List[Tuple[str, str]]:
+    """
+    スレッド履歴から (テキスト, ラベル) を集める
+
+    アシスタントのスレッドはidが同じチャットログのメッセージ（回答そのもの）をテキストに使い、
+    見つからなければスレッドの要約を使う。ラベルの表記ゆれ（大文字・小文字など）は
+    最も多い表記にまとめる。
+    """
+    samples = []
+    for path in sorted(glob.glob(os.path.join(data_dir, "thread_history_*.json*"))):
+        if not (path.endswith(".json") or path.endswith(".jsonl")):
+            continue
+        suffix = os.path.basename(path)[len("thread_history_"):]
+        raw_by_id = {}
+        for log_path in (os.path.join(data_dir, "chat_log_" + suffix),):
+            if os.path.exists(log_path):
+                raw_by_id = {m.get("id"): m.get("content") for m in _read_records(log_path) if m.get("id")}
+        for thread in _read_records(path):
+            label = normalize_label(thread.get("type"))
+            if label is None or label.lower() in IGNORED_LABELS:
+                continue
+            text = raw_by_id.get(thread.get("id")) or thread.get("content")
+            if isinstance(text, str) and text.strip():
+                samples.append((text, label))
+
+    variants = Counter(label for _, label in samples)
+    canonical = {}
+    for label, _ in variants.most_common():
+        canonical.setdefault(label.casefold(), label)
+    return [(text, canonical[label.casefold()]) for text, label in samples]
+
+
+def split_samples(samples: List[Tuple[str, str]], test_ratio: float, seed: int = 0):
+    shuffled = list(samples)
+    random.Random(seed).shuffle(shuffled)
+    cut = int(len(shuffled) * (1 - test_ratio))
+    return shuffled[:cut], shuffled[cut:]
+
+
+def evaluate(classifier: IntentClassifier, samples: Sequence[Tuple[str, str]]) -> Dict[str, Any]:
+    """正解率と、ローカルで判定した割合・その正解率を求める"""
+    correct = local = local_correct = 0
+    start = time.perf_counter()
+    for text, label in samples:
+        predicted, _ = classifier.classify(text)
+        if predicted is not None:
+            local += 1
+            local_correct += predicted == label
+        elif classifier.model is not None:
+            # LLMに任せた発話はモデルの予測で正解率を数える（モデルがなければ予測なし）
+            predicted, _ = classifier.model.predict(text)
+        correct += predicted == label
+    elapsed = time.perf_counter() - start
+    n = len(samples)
+    return {
+        "samples": n,
+        "accuracy": round(correct / n, 4) if n else 0.0,
+        "local_ratio": round(local / n, 4) if n else 0.0,
+        "local_accuracy": round(local_correct / local, 4) if local else 0.0,
+        "us_per_utterance": round(elapsed / n * 1e6, 1) if n else 0.0
+    }
+
+
+def _option(args: List[str], name: str, default: str) -> str:
+    if name in args:
+        return args[args.index(name) + 1]
+    return default
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if len(args) < 2 or args[0] not in ("train", "eval"):
+        print("Usage: python -m utils.intent_classifier train|eval <data_dir> "
+              "[--out PATH] [--model PATH] [--test-ratio 0.2] [--threshold 0.8]")
+        sys.exit(1)
+    command, data_dir = args[0], args[1]
+    threshold = float(_option(args, "--threshold", str(INTENT_CONFIDENCE_THRESHOLD)))
+    samples = load_training_data(data_dir)
+    print(f"{len(samples)} labeled utterances, {len(set(label for _, label in samples))} labels")
+
+    if command == "train":
+        out = _option(args, "--out", INTENT_MODEL_PATH)
+        test_ratio = float(_option(args, "--test-ratio", "0.2"))
+        train_set, test_set = split_samples(samples, test_ratio)
+        model = LinearIntentModel.train(train_set)
+        if test_set:
+            report = evaluate(IntentClassifier(model, threshold), test_set)
+            print(f"held-out: {report}")
+            model.meta["eval"] = report
+        # 評価の後はすべてのデータで学習し直して保存する
+        if test_set:
+            model = LinearIntentModel.train(samples)
+            model.meta["eval"] = report
+        model.meta.update({"samples": len(samples), "trained_at": datetime.now().isoformat()})
+        model.save(out)
+        print(f"saved {out} ({len(model.labels)} labels)")
+    else:
+        model = LinearIntentModel.load(_option(args, "--model", INTENT_MODEL_PATH))
+        print(evaluate(IntentClassifier(model, threshold), samples))
@@ -0,0 +1,197 @@
+# utils/json_cache.py
+"""
+JSONデータ用のLRU + TTLキャッシュ
+
+- バイト数（おおよそのサイズ）で上限を設け、超えたら最も古く使われたエントリから破棄する
+- パスのプレフィックスごとに予算を分けられる（チャットログがCRMデータを追い出さないように）
+- エントリにファイルのシグネチャ（mtime / サイズ / inode）を持たせ、他のプロセスによる更新を検出できる
+"""
+import os
+import sys
+import time
+from collections import OrderedDict
+from collections.abc import Mapping
+from typing import Any, Callable, Dict, Optional, Tuple
+
+DEFAULT_PARTITION = "*"
+
+
+def approx_size(obj: Any) -> int:
+    """オブジェクトのおおよそのサイズ（バイト）を見積もる"""
+    # 読み取り専用のスナップショット（MappingProxyType）もMappingとして中身まで数える
+    if isinstance(obj, Mapping):
+        return sys.getsizeof(obj) + sum(approx_size(k) + approx_size(v) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return sys.getsizeof(obj) + sum(approx_size(v) for v in obj)
+    return sys.getsizeof(obj)
+
+
+def parse_prefix_budgets(spec: str) -> Dict[str, int]:
+    """"data/chat_log_=16777216,crm_dummy_data/=8388608" 形式の設定を解析"""
+    budgets = {}
+    for item in spec.split(","):
+        if "=" not in item:
+            continue
+        prefix, budget = item.rsplit("=", 1)
+        budgets[os.path.normpath(prefix.strip())] = int(budget)
+    return budgets
+
+
+# シグネチャを照合しないことを表す値
+NO_SIGNATURE = object()
+
+
+def file_signature(filepath: str) -> Optional[Tuple[int, int, int]]:
+    """ファイルの (mtime_ns, size, inode) を取得（存在しなければNone）"""
+    try:
+        st = os.stat(filepath)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+class _Entry:
+    __slots__ = ("value", "size", "stored_at", "signature", "validated_at")
+
+    def __init__(self, value: Any, size: int, stored_at: float, signature: Any):
+        self.value = value
+        self.size = size
+        self.stored_at = stored_at
+        self.signature = signature
+        self.validated_at = stored_at
+
+
+class _Partition:
+    """予算ごとのLRU領域"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.stale = 0
+
+    def remove(self, key: str) -> None:
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry.size
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "stale": self.stale
+        }
+
+
+class JsonCache:
+    """バイト数上限付きのLRU + TTLキャッシュ"""
+
+    def __init__(
+        self,
+        max_bytes: int,
+        ttl: float,
+        prefix_budgets: Optional[Dict[str, int]] = None,
+        revalidate_interval: float = 0.0
+    ):
+        self.ttl = ttl
+        self.revalidate_interval = revalidate_interval
+        self._partitions: Dict[str, _Partition] = {DEFAULT_PARTITION: _Partition(max_bytes)}
+        # 長いプレフィックスから順に照合する
+        self._prefixes = sorted((prefix_budgets or {}).keys(), key=len, reverse=True)
+        for prefix, budget in (prefix_budgets or {}).items():
+            self._partitions[prefix] = _Partition(budget)
+
+    @staticmethod
+    def _normalize(key: str) -> str:
+        return os.path.normpath(key)
+
+    def _partition_for(self, key: str) -> _Partition:
+        for prefix in self._prefixes:
+            if key.startswith(prefix):
+                return self._partitions[prefix]
+        return self._partitions[DEFAULT_PARTITION]
+
+    def get(self, key: str, signature_func: Optional[Callable[[], Any]] = None) -> Tuple[bool, Any]:
+        """
+        (ヒットしたか, 値) を返す
+
+        signature_funcを渡すと、保存時のシグネチャと一致する場合のみヒットとする。
+        照合はrevalidate_intervalごとに1回だけ行う。
+        """
+        key = self._normalize(key)
+        partition = self._partition_for(key)
+        entry = partition.entries.get(key)
+        if entry is None:
+            partition.misses += 1
+            return False, None
+        if time.monotonic() - entry.stored_at >= self.ttl:
+            partition.remove(key)
+            partition.expirations += 1
+            partition.misses += 1
+            return False, None
+        if signature_func is not None and entry.signature is not NO_SIGNATURE:
+            now = time.monotonic()
+            if now - entry.validated_at >= self.revalidate_interval:
+                if signature_func() != entry.signature:
+                    # 他のプロセスがファイルを更新した
+                    partition.remove(key)
+                    partition.stale += 1
+                    partition.misses += 1
+                    return False, None
+                entry.validated_at = now
+        partition.entries.move_to_end(key)
+        partition.hits += 1
+        return True, entry.value
+
+    def set(self, key: str, value: Any, size: Optional[int] = None, signature: Any = NO_SIGNATURE) -> None:
+        """値を保存する（sizeを省略した場合は見積もる）"""
+        key = self._normalize(key)
+        partition = self._partition_for(key)
+        size = approx_size(value) if size is None else size
+        partition.remove(key)
+        if size > partition.max_bytes:
+            # 予算を超える単一エントリはキャッシュしない
+            return
+        partition.entries[key] = _Entry(value, size, time.monotonic(), signature)
+        partition.bytes += size
+        self._evict(partition)
+
+    def _evict(self, partition: _Partition) -> None:
+        # 予算内に収まるまで、最も古く使われたエントリから破棄する
+        now = time.monotonic()
+        while partition.bytes > partition.max_bytes and partition.entries:
+            key, entry = next(iter(partition.entries.items()))
+            partition.remove(key)
+            if now - entry.stored_at >= self.ttl:
+                partition.expirations += 1
+            else:
+                partition.evictions += 1
+
+    def invalidate(self, key: Optional[str] = None) -> None:
+        """特定のキーまたはすべてのエントリを破棄"""
+        if key is None:
+            for partition in self._partitions.values():
+                partition.entries.clear()
+                partition.bytes = 0
+            return
+        key = self._normalize(key)
+        self._partition_for(key).remove(key)
+
+    def __contains__(self, key: str) -> bool:
+        key = self._normalize(key)
+        return key in self._partition_for(key).entries
+
+    def stats(self) -> Dict[str, Any]:
+        """ヒット・ミス・破棄の件数などを取得"""
+        return {name: partition.stats() for name, partition in self._partitions.items()}
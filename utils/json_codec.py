@@ -0,0 +1,58 @@
+# utils/json_codec.py
+"""
+JSONのエンコード・デコードを1か所にまとめたモジュール
+
+orjsonがインストールされていればorjsonを、なければ標準ライブラリのjsonを使う。
+保存用の出力はコンパクト（空白なし）、人が読むための出力だけ整形する。
+どちらのバックエンドでも非ASCII文字はエスケープせずUTF-8のまま出力する。
+"""
+import json
+from typing import Any, Union
+
+from .snapshot import json_default
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BACKEND = "orjson" if orjson is not None else "json"
+
+# JSONDecodeErrorはどちらのバックエンドでもValueErrorのサブクラス
+JSONDecodeError = orjson.JSONDecodeError if orjson is not None else json.JSONDecodeError
+
+if orjson is not None:
+    _ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS
+    _ORJSON_PRETTY_OPTIONS = _ORJSON_OPTIONS | orjson.OPT_INDENT_2
+
+
+def _stdlib_dumps(obj: Any, pretty: bool) -> str:
+    if pretty:
+        return json.dumps(obj, ensure_ascii=False, indent=2, default=json_default)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=json_default)
+
+
+def dumps_bytes(obj: Any, pretty: bool = False) -> bytes:
+    """オブジェクトをUTF-8のJSONバイト列に変換"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, default=json_default, option=_ORJSON_PRETTY_OPTIONS if pretty else _ORJSON_OPTIONS)
+        except orjson.JSONEncodeError:
+            # 64bitを超える整数などorjsonが扱えない値は標準ライブラリに任せる
+            pass
+    return _stdlib_dumps(obj, pretty).encode("utf-8")
+
+
+def dumps(obj: Any, pretty: bool = False) -> str:
+    """オブジェクトをJSON文字列に変換"""
+    if orjson is not None:
+        return dumps_bytes(obj, pretty).decode("utf-8")
+    return _stdlib_dumps(obj, pretty)
+
+
+def loads(data: Union[str, bytes, bytearray]) -> Any:
+    """JSON文字列またはバイト列をデコード"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
@@ -0,0 +1,199 @@
+# utils/jsonl_log.py
+"""
+append-only JSONL 形式のメッセージログ
+
+1行に1メッセージを書き込むため、追記のコストは履歴の長さに依存しない（O(1)）。
+直近の会話だけが必要な場合はファイル末尾から逆方向に読み込む。
+"""
+import asyncio
+import logging
+import os
+import sys
+from typing import Any, Dict, List, Optional
+
+import aiofiles
+
+from . import json_codec
+from .file_operations import BACKUP_SUFFIX, atomic_write_text, quarantine_file, should_fsync, sync_later
+
+# 末尾読み込み時のブロックサイズ（バイト）
+TAIL_BLOCK_SIZE = 64 * 1024
+
+# 移行済みのレガシーJSONファイルに付ける拡張子
+MIGRATED_SUFFIX = ".migrated"
+
+
+def _encode_line(record: Any) -> bytes:
+    """1レコードをJSONLの1行に変換"""
+    return json_codec.dumps_bytes(record) + b"\n"
+
+
+def _decode_lines(lines: List[bytes]) -> List[Any]:
+    """JSONLの行をデコード（書き込み途中で途切れた行は読み飛ばす）"""
+    records = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            records.append(json_codec.loads(line))
+        except (json_codec.JSONDecodeError, UnicodeDecodeError):
+            continue
+    return records
+
+
+def _append_sync(filepath: str, payload: bytes) -> None:
+    """JSONLファイルに追記する（同期版）"""
+    with open(filepath, "ab+") as f:
+        if f.tell() > 0:
+            # 前回の書き込みが途中で途切れていたら、新しい行と混ざらないよう改行を補う
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                payload = b"\n" + payload
+        f.write(payload)
+        f.flush()
+        if should_fsync():
+            os.fsync(f.fileno())
+        else:
+            sync_later(filepath)
+
+
+async def append_jsonl(filepath: str, records: List[Any]) -> None:
+    """
+    レコードをJSONLファイルの末尾に追記する
+    """
+    if not records:
+        return
+    os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+    payload = b"".join(_encode_line(record) for record in records)
+    await asyncio.to_thread(_append_sync, filepath, payload)
+
+
+async def read_jsonl(filepath: str) -> List[Any]:
+    """
+    JSONLファイル全体を読み込む
+    """
+    if not os.path.exists(filepath):
+        return []
+    async with aiofiles.open(filepath, "rb") as f:
+        content = await f.read()
+    return _decode_lines(content.split(b"\n"))
+
+
+def _read_tail_sync(filepath: str, n: int) -> List[Any]:
+    """ファイル末尾からn件のレコードを読み込む（同期版）"""
+    with open(filepath, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        buffer = b""
+        # n件＋途中で切れた先頭行の分だけ改行が揃うまで逆方向に読む
+        while position > 0 and buffer.count(b"\n") <= n:
+            read_size = min(TAIL_BLOCK_SIZE, position)
+            position -= read_size
+            f.seek(position)
+            buffer = f.read(read_size) + buffer
+    lines = buffer.split(b"\n")
+    if position > 0:
+        # 先頭の行はブロック境界で切れている可能性がある
+        lines = lines[1:]
+    records = _decode_lines(lines)
+    return records[-n:] if n > 0 else []
+
+
+async def read_jsonl_tail(filepath: str, n: int) -> List[Any]:
+    """
+    JSONLファイルの末尾n件を読み込む
+    """
+    if n <= 0 or not os.path.exists(filepath):
+        return []
+    return await asyncio.to_thread(_read_tail_sync, filepath, n)
+
+
+async def truncate_jsonl(filepath: str) -> None:
+    """
+    JSONLファイルを空にする
+    """
+    await asyncio.to_thread(atomic_write_text, filepath, "", False)
+
+
+def _load_legacy_json(json_path: str) -> Any:
+    """
+    レガシーのJSONファイルを読み込む
+
+    デコードできなければ直前の世代（.bak）を使い、壊れたファイルは隔離する。
+    .bakもなければファイルはそのまま残してValueErrorを送出する
+    （空の履歴として移行すると、顧客の履歴が消えたように見えるため）。
+    """
+    with open(json_path, "rb") as f:
+        content = f.read()
+    try:
+        return json_codec.loads(content)
+    except (json_codec.JSONDecodeError, UnicodeDecodeError):
+        pass
+    backup_path = json_path + BACKUP_SUFFIX
+    if os.path.exists(backup_path):
+        try:
+            with open(backup_path, "rb") as f:
+                data = json_codec.loads(f.read())
+        except (json_codec.JSONDecodeError, UnicodeDecodeError):
+            pass
+        else:
+            quarantine_path = quarantine_file(json_path)
+            logging.warning(f"Corrupted legacy log quarantined: {json_path} -> {quarantine_path}; migrating {backup_path}")
+            return data
+    logging.error(f"Could not decode legacy log {json_path}; left in place without migrating")
+    raise ValueError(f"JSONとして読み込めません: {json_path}")
+
+
+def migrate_json_to_jsonl(json_path: str, jsonl_path: str) -> int:
+    """
+    JSON配列のファイルをJSONLに変換する
+
+    変換後のレガシーファイルは `.migrated` を付けて残す。
+    変換したレコード数を返す。読み込めない場合はValueErrorを送出し、JSONLは作らない。
+    """
+    data = _load_legacy_json(json_path)
+    if not isinstance(data, list):
+        raise ValueError(f"JSON配列ではありません: {json_path}")
+
+    atomic_write_text(jsonl_path, b"".join(_encode_line(record) for record in data), backup=False)
+    if os.path.exists(json_path):
+        os.replace(json_path, json_path + MIGRATED_SUFFIX)
+    return len(data)
+
+
+def migrate_data_dir(data_dir: str, prefixes: tuple = ("chat_log_", "thread_history_")) -> Dict[str, Optional[int]]:
+    """
+    データディレクトリ内のチャットログを一括でJSONLに変換する
+
+    変換できなかったファイルは残したまま、結果をNoneにする。
+    """
+    results: Dict[str, Optional[int]] = {}
+    for filename in sorted(os.listdir(data_dir)):
+        if not filename.endswith(".json") or not filename.startswith(prefixes):
+            continue
+        json_path = os.path.join(data_dir, filename)
+        jsonl_path = json_path + "l"
+        if os.path.exists(jsonl_path):
+            continue
+        try:
+            results[filename] = migrate_json_to_jsonl(json_path, jsonl_path)
+        except ValueError as e:
+            logging.error(f"Failed to migrate {json_path}: {e}")
+            results[filename] = None
+    return results
+
+
+if __name__ == "__main__":
+    # 使用例: python -m utils.jsonl_log migrate data
+    if len(sys.argv) != 3 or sys.argv[1] != "migrate":
+        print("Usage: python -m utils.jsonl_log migrate <data_dir>")
+        sys.exit(1)
+    results = migrate_data_dir(sys.argv[2])
+    for name, count in results.items():
+        if count is None:
+            print(f"{name}: FAILED (left in place; restore it or run python -m utils.fsck)")
+        else:
+            print(f"{name}: {count} records migrated")
+    if None in results.values():
+        sys.exit(1)
@@ -0,0 +1,282 @@
+# utils/llm_clients.py
+"""
+アプリケーション全体で共有するLLMクライアント
+
+以前は wsgi.py・各ルーター・AIOpenRouterStreamClient のインスタンスごとに AsyncOpenAI を作っており、
+それぞれが別のhttpxコネクションプールを持つため、TLSハンドシェイクやKeep-Aliveの再利用が
+分散していた。LLMClients は1つの httpx.AsyncClient（コネクションプール）を持ち、
+FastAPIのlifespanで作成・終了する。ルーターは Depends(get_llm_clients) で受け取る。
+Anthropic（AsyncAnthropic）はSDKが別のHTTPライブラリを使うためプールは共有できないが、
+同じくアプリケーション全体で1つのクライアントを使い、タイムアウトも同じ設定にする。
+
+- Keep-Alive・最大接続数・タイムアウトは環境変数で調整する
+- HTTP/2 は h2 パッケージがインストールされていれば使う（LLM_HTTP2=auto）
+- リクエスト数・同時実行数・新規接続数などのメトリクスを /admin/metrics で確認できる
+"""
+import asyncio
+import importlib.util
+import os
+import threading
+import time
+from typing import Any, Dict, Optional
+
+import anthropic
+import httpx
+from openai import AsyncOpenAI, OpenAI
+
+OPENROUTER_BASE_URL = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
+
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", 100))  # 同時接続数の上限
+LLM_MAX_KEEPALIVE = int(os.getenv("LLM_MAX_KEEPALIVE", 20))  # 待機させておく接続数の上限
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", 60))  # 待機中の接続を閉じるまでの秒数
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", 5))
+# ストリーミングではトークンの間隔がこの秒数を超えるとタイムアウトになる
+LLM_READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", 120))
+LLM_WRITE_TIMEOUT = float(os.getenv("LLM_WRITE_TIMEOUT", 10))
+LLM_POOL_TIMEOUT = float(os.getenv("LLM_POOL_TIMEOUT", 10))  # 空き接続を待つ秒数
+# "auto": h2がインストールされていればHTTP/2を使う / "true" / "false"
+LLM_HTTP2 = os.getenv("LLM_HTTP2", "auto").lower()
+# 起動時にバックグラウンドで接続を張っておくか
+LLM_WARM_UP = os.getenv("LLM_WARM_UP", "true").lower() == "true"
+
+
+def http2_available() -> bool:
+    return importlib.util.find_spec("h2") is not None
+
+
+def _use_http2(setting: str = LLM_HTTP2) -> bool:
+    if setting == "auto":
+        return http2_available()
+    return setting == "true"
+
+
+def llm_timeout() -> httpx.Timeout:
+    return httpx.Timeout(
+        connect=LLM_CONNECT_TIMEOUT,
+        read=LLM_READ_TIMEOUT,
+        write=LLM_WRITE_TIMEOUT,
+        pool=LLM_POOL_TIMEOUT
+    )
+
+
+def llm_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=LLM_MAX_CONNECTIONS,
+        max_keepalive_connections=LLM_MAX_KEEPALIVE,
+        keepalive_expiry=LLM_KEEPALIVE_EXPIRY
+    )
+
+
+class PoolMetrics:
+    """コネクションプールの利用状況"""
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.connects = 0  # 新しく張ったTCP接続の数
+        self.tls_handshakes = 0
+        self.total_headers_seconds = 0.0  # リクエスト送信からレスポンスヘッダーまでの時間の合計
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak_in_flight,
+            "connects": self.connects,
+            "tls_handshakes": self.tls_handshakes,
+            # 既存の接続を使い回したリクエストの割合
+            "reuse_ratio": round(1 - self.connects / self.requests, 4) if self.requests else 0.0,
+            "headers_seconds_avg": round(self.total_headers_seconds / self.requests, 6) if self.requests else 0.0
+        }
+
+
+class _TrackedStream(httpx.AsyncByteStream):
+    """レスポンスの本文を読み終える（閉じる）までを実行中として数える"""
+
+    def __init__(self, stream: httpx.AsyncByteStream, metrics: PoolMetrics):
+        self._stream = stream
+        self._metrics = metrics
+        self._closed = False
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self) -> None:
+        if not self._closed:
+            self._closed = True
+            self._metrics.in_flight -= 1
+        await self._stream.aclose()
+
+
+class InstrumentedTransport(httpx.AsyncBaseTransport):
+    """httpxのトランスポートをラップしてメトリクスを記録する"""
+
+    def __init__(self, transport: httpx.AsyncHTTPTransport, metrics: PoolMetrics):
+        self._transport = transport
+        self.metrics = metrics
+
+    async def _trace(self, event: str, info: Dict[str, Any]) -> None:
+        if event == "connection.connect_tcp.complete":
+            self.metrics.connects += 1
+        elif event == "connection.start_tls.complete":
+            self.metrics.tls_handshakes += 1
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        request.extensions = {**request.extensions, "trace": self._trace}
+        metrics = self.metrics
+        metrics.requests += 1
+        metrics.in_flight += 1
+        metrics.peak_in_flight = max(metrics.peak_in_flight, metrics.in_flight)
+        start = time.perf_counter()
+        try:
+            response = await self._transport.handle_async_request(request)
+        except BaseException:
+            metrics.errors += 1
+            metrics.in_flight -= 1
+            raise
+        metrics.total_headers_seconds += time.perf_counter() - start
+        response.stream = _TrackedStream(response.stream, metrics)
+        return response
+
+    def pool_state(self) -> Dict[str, Any]:
+        """プール内の接続の数（httpcoreのプールが見える場合のみ）"""
+        pool = getattr(self._transport, "_pool", None)
+        connections = list(getattr(pool, "connections", []) or [])
+        idle = sum(1 for connection in connections if connection.is_idle())
+        return {
+            "connections": len(connections),
+            "idle": idle,
+            "active": len(connections) - idle,
+            "http2": sum(1 for connection in connections if "HTTP/2" in connection.info())
+        }
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+class LLMClients:
+    """共有のコネクションプールと、その上に作ったLLMのAPIクライアント"""
+
+    def __init__(
+        self,
+        openrouter_api_key: Optional[str] = None,
+        openrouter_base_url: str = OPENROUTER_BASE_URL,
+        anthropic_api_key: Optional[str] = None,
+        anthropic_base_url: Optional[str] = None,
+        http2: Optional[bool] = None,
+        limits: Optional[httpx.Limits] = None,
+        timeout: Optional[httpx.Timeout] = None,
+        verify: Any = True
+    ):
+        api_key = openrouter_api_key or os.getenv("OPENROUTER_API_KEY")
+        if not api_key:
+            raise ValueError("OpenRouter API key is required")
+        self.http2 = _use_http2() if http2 is None else http2
+        self.limits = limits or llm_limits()
+        self.timeout = timeout or llm_timeout()
+        self.metrics = PoolMetrics()
+        self.transport = InstrumentedTransport(
+            httpx.AsyncHTTPTransport(limits=self.limits, http2=self.http2, verify=verify),
+            self.metrics
+        )
+        self.http_client = httpx.AsyncClient(transport=self.transport, timeout=self.timeout)
+        # openaiのクライアントはリクエストごとにタイムアウトを指定するため、同じ値を渡す
+        self.openrouter = AsyncOpenAI(
+            base_url=openrouter_base_url,
+            api_key=api_key,
+            http_client=self.http_client,
+            timeout=self.timeout
+        )
+        # イベントループをブロックしないよう、Anthropicも非同期クライアントを使う
+        self.anthropic = anthropic.AsyncAnthropic(
+            api_key=anthropic_api_key or os.getenv("ANTHROPIC_API_KEY"),
+            base_url=anthropic_base_url,
+            timeout=anthropic.Timeout(
+                connect=LLM_CONNECT_TIMEOUT,
+                read=LLM_READ_TIMEOUT,
+                write=LLM_WRITE_TIMEOUT,
+                pool=LLM_POOL_TIMEOUT
+            )
+        )
+        self._warm_up_task: Optional[asyncio.Task] = None
+
+    async def warm_up(self, url: Optional[str] = None) -> None:
+        """起動時に接続を1本張っておく（最初のリクエストでTLSハンドシェイクを待たないため）"""
+        try:
+            await self.http_client.head(url or str(self.openrouter.base_url), timeout=LLM_CONNECT_TIMEOUT)
+        except httpx.HTTPError as e:
+            print(f"LLM connection warm-up failed: {e}")
+
+    async def aclose(self) -> None:
+        if self._warm_up_task is not None and not self._warm_up_task.done():
+            self._warm_up_task.cancel()
+        await self.http_client.aclose()
+        await self.anthropic.close()
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """コネクションプールの利用状況を取得"""
+        return {
+            **self.metrics.to_dict(),
+            **self.transport.pool_state(),
+            "max_connections": self.limits.max_connections,
+            "max_keepalive_connections": self.limits.max_keepalive_connections,
+            "http2_enabled": self.http2
+        }
+
+
+# プロセス内で共有するインスタンス（lifespanで作成する）
+_llm_clients: Optional[LLMClients] = None
+
+
+async def open_llm_clients(warm_up: bool = LLM_WARM_UP) -> LLMClients:
+    """共有のLLMクライアントを作成（アプリケーション起動時に呼び出す）"""
+    global _llm_clients
+    if _llm_clients is None:
+        _llm_clients = LLMClients()
+    if warm_up:
+        # 起動を待たせないようバックグラウンドで接続する
+        _llm_clients._warm_up_task = asyncio.ensure_future(_llm_clients.warm_up())
+    return _llm_clients
+
+
+async def close_llm_clients() -> None:
+    """共有のLLMクライアントの接続を閉じる（アプリケーション終了時に呼び出す）"""
+    global _llm_clients
+    if _llm_clients is not None:
+        await _llm_clients.aclose()
+        _llm_clients = None
+
+
+def get_llm_clients() -> LLMClients:
+    """
+    共有のLLMクライアントを取得する（FastAPIの依存関数としても使う）
+
+    lifespanの外（スクリプトなど）から呼ばれた場合はここで作成する。
+    """
+    global _llm_clients
+    if _llm_clients is None:
+        _llm_clients = LLMClients()
+    return _llm_clients
+
+
+# Celeryワーカーなど同期コード用のクライアント（プロセスごとに1つ）
+_sync_openrouter: Optional[OpenAI] = None
+_sync_lock = threading.Lock()
+
+
+def get_sync_openrouter_client() -> OpenAI:
+    """同期版のOpenRouterクライアントを取得（接続数・タイムアウトは非同期版と同じ設定）"""
+    global _sync_openrouter
+    with _sync_lock:
+        if _sync_openrouter is None:
+            _sync_openrouter = OpenAI(
+                base_url=OPENROUTER_BASE_URL,
+                api_key=os.getenv("OPENROUTER_API_KEY"),
+                http_client=httpx.Client(limits=llm_limits(), timeout=llm_timeout(), http2=_use_http2()),
+                timeout=llm_timeout()
+            )
+        return _sync_openrouter
@@ -0,0 +1,319 @@
+# utils/model_router.py
+"""
+レイテンシを見てモデルの順番を決めるルーティング（スコアボード）
+
+以前はストリーミングの回答・Function calling・要約（Celery）のモデルの順番がそれぞれの
+コードに固定で書かれていた。ModelScoreboard はタスクの種類とモデルの組ごとに
+TTFT・生成速度（tokens/sec）・エラー率の指数移動平均（EWMA）を記録し、呼び出しのたびに
+そのタスクで速く失敗しにくいモデルから順に返す。
+
+- 固定したいモデルは pin（MODEL_PINS または /admin/model-routing/pin）で先頭にできる
+- スコアボードは data/model_scoreboard.json に保存し、再起動後も引き継ぐ
+  （複数のワーカー・Celeryで共有し、保存時に更新の新しい方を残してマージする）
+"""
+import logging
+import os
+import random
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from . import json_codec
+from .admission import BATCH, PROVIDER_OPENROUTER, AdmissionRejected, llm_admission
+from .file_operations import atomic_write_text
+from .response_cache import ResponseCache, cache_key
+
+TASK_CHAT = "chat"  # ストリーミングの回答
+TASK_FUNCTION = "function_calling"  # Function callingによる構造化出力
+TASK_SUMMARY = "summary"  # 会話の要約（Celery）
+
+# タスクごとの候補（スコアがない間はこの順番で使う）
+TASK_MODELS: Dict[str, List[str]] = {
+    TASK_CHAT: ["anthropic/claude-3.7-sonnet", "openai/gpt-4.1"],
+    TASK_FUNCTION: ["openai/gpt-4.1", "openai/gpt-4o"],
+    TASK_SUMMARY: ["anthropic/claude-3.7-sonnet", "openai/gpt-4.1"],
+}
+# スコアの計算に使う、タスクごとの典型的な出力トークン数
+TASK_OUTPUT_TOKENS = {TASK_CHAT: 600, TASK_FUNCTION: 800, TASK_SUMMARY: 1000}
+
+MODEL_SCOREBOARD_PATH = os.getenv("MODEL_SCOREBOARD_PATH", os.path.join("data", "model_scoreboard.json"))
+MODEL_ROUTING = os.getenv("MODEL_ROUTING", "true").lower() == "true"
+ROUTER_EWMA_ALPHA = float(os.getenv("ROUTER_EWMA_ALPHA", 0.2))  # 新しい値の重み
+ROUTER_MIN_SAMPLES = int(os.getenv("ROUTER_MIN_SAMPLES", 5))  # これ未満のモデルはスコアを使わない
+ROUTER_EXPLORE = float(os.getenv("ROUTER_EXPLORE", 0.05))  # 先頭以外のモデルを試す割合（スコアを更新し続けるため）
+ROUTER_SAVE_INTERVAL = float(os.getenv("ROUTER_SAVE_INTERVAL", 30))  # 保存する間隔（秒）
+# "chat=openai/gpt-4.1,summary=anthropic/claude-3.7-sonnet" の形式で固定するモデル
+MODEL_PINS = os.getenv("MODEL_PINS", "")
+
+
+def _parse_pins(value: str) -> Dict[str, str]:
+    pins = {}
+    for item in value.split(","):
+        if "=" in item:
+            task, model = item.split("=", 1)
+            pins[task.strip()] = model.strip()
+    return pins
+
+
+class ModelStats:
+    """1つのタスク・モデルの組のEWMA"""
+
+    __slots__ = ("ttft", "tokens_per_second", "error_rate", "samples", "updated_at")
+
+    def __init__(self, ttft: Optional[float] = None, tokens_per_second: Optional[float] = None,
+                 error_rate: float = 0.0, samples: int = 0, updated_at: float = 0.0):
+        self.ttft = ttft
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+        self.samples = samples
+        self.updated_at = updated_at
+
+    def update(self, alpha: float, ttft: Optional[float], tokens_per_second: Optional[float], error: bool) -> None:
+        def ewma(old: Optional[float], new: float) -> float:
+            return new if old is None else old + alpha * (new - old)
+
+        if ttft is not None:
+            self.ttft = ewma(self.ttft, ttft)
+        if tokens_per_second is not None:
+            self.tokens_per_second = ewma(self.tokens_per_second, tokens_per_second)
+        self.error_rate = ewma(self.error_rate if self.samples else None, 1.0 if error else 0.0)
+        self.samples += 1
+        self.updated_at = time.time()
+
+    def expected_seconds(self, output_tokens: int) -> Optional[float]:
+        """典型的な出力の生成にかかる秒数（失敗して再試行する分を含む）"""
+        if self.ttft is None:
+            return None
+        seconds = self.ttft
+        if self.tokens_per_second:
+            seconds += output_tokens / self.tokens_per_second
+        return seconds / max(0.05, 1.0 - self.error_rate)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "ttft": self.ttft,
+            "tokens_per_second": self.tokens_per_second,
+            "error_rate": self.error_rate,
+            "samples": self.samples,
+            "updated_at": self.updated_at
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "ModelStats":
+        return cls(data.get("ttft"), data.get("tokens_per_second"), data.get("error_rate", 0.0),
+                   data.get("samples", 0), data.get("updated_at", 0.0))
+
+
+class ModelScoreboard:
+    """タスクの種類ごとのモデルのスコアボード"""
+
+    def __init__(
+        self,
+        path: str = MODEL_SCOREBOARD_PATH,
+        candidates: Optional[Dict[str, List[str]]] = None,
+        pins: Optional[Dict[str, str]] = None,
+        enabled: bool = MODEL_ROUTING,
+        alpha: float = ROUTER_EWMA_ALPHA,
+        min_samples: int = ROUTER_MIN_SAMPLES,
+        explore: float = ROUTER_EXPLORE,
+        save_interval: float = ROUTER_SAVE_INTERVAL
+    ):
+        self.path = path
+        self.candidates = candidates or TASK_MODELS
+        self.pins = dict(_parse_pins(MODEL_PINS) if pins is None else pins)
+        self.enabled = enabled
+        self.alpha = alpha
+        self.min_samples = min_samples
+        self.explore = explore
+        self.save_interval = save_interval
+        self._stats: Dict[str, Dict[str, ModelStats]] = {}
+        # Celeryのワーカーはスレッドで実行されることがあるため、更新はロックで守る
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._dirty = False
+        self._last_save = time.monotonic()
+
+    def _ensure_loaded(self) -> None:
+        if not self._loaded:
+            self.load()
+
+    def load(self) -> None:
+        """保存されたスコアボードを読み込む（ファイルがなければ空のまま）"""
+        data = self._read()
+        with self._lock:
+            self._loaded = True
+            for task, models in data.get("stats", {}).items():
+                for model, stats in models.items():
+                    self._stats.setdefault(task, {})[model] = ModelStats.from_dict(stats)
+            # 環境変数の指定を優先し、管理画面で固定したモデルを引き継ぐ
+            for task, model in data.get("pins", {}).items():
+                self.pins.setdefault(task, model)
+
+    def _read(self) -> Dict[str, Any]:
+        try:
+            with open(self.path, "rb") as f:
+                return json_codec.loads(f.read())
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logging.warning(f"Failed to load model scoreboard: {e}")
+            return {}
+
+    def save(self, force: bool = False) -> None:
+        """スコアボードを保存する（forceでなければ前回の保存からsave_interval秒経った場合のみ）"""
+        if not self._dirty or (not force and time.monotonic() - self._last_save < self.save_interval):
+            return
+        # 他のプロセスが保存した値のうち、こちらより新しいものは残す
+        stored = self._read()
+        with self._lock:
+            merged: Dict[str, Dict[str, Any]] = {}
+            for task, models in stored.get("stats", {}).items():
+                merged[task] = dict(models)
+            for task, models in self._stats.items():
+                for model, stats in models.items():
+                    other = merged.setdefault(task, {}).get(model)
+                    if other is None or other.get("updated_at", 0.0) <= stats.updated_at:
+                        merged[task][model] = stats.to_dict()
+            data = {"stats": merged, "pins": dict(self.pins)}
+            self._dirty = False
+            self._last_save = time.monotonic()
+        try:
+            atomic_write_text(self.path, json_codec.dumps_bytes(data), backup=False)
+        except OSError as e:
+            logging.warning(f"Failed to save model scoreboard: {e}")
+
+    def record(
+        self,
+        task: str,
+        model: str,
+        ttft: Optional[float] = None,
+        output_tokens: int = 0,
+        duration: Optional[float] = None,
+        error: bool = False
+    ) -> None:
+        """
+        1回の呼び出しの結果を記録する
+
+        ttftは最初のトークンまで（ストリーミングでない場合はレスポンスまで）の秒数、
+        durationは最初のトークンから最後までの秒数（output_tokensと合わせて生成速度の計算に使う）。
+        """
+        self._ensure_loaded()
+        tokens_per_second = None
+        if not error and output_tokens > 0 and duration and duration > 0:
+            tokens_per_second = output_tokens / duration
+        with self._lock:
+            stats = self._stats.setdefault(task, {}).get(model)
+            if stats is None:
+                stats = self._stats[task][model] = ModelStats()
+            stats.update(self.alpha, None if error else ttft, tokens_per_second, error)
+            self._dirty = True
+        self.save()
+
+    def route(self, task: str, candidates: Optional[List[str]] = None) -> List[str]:
+        """タスクに使うモデルを試す順番に並べて返す"""
+        self._ensure_loaded()
+        models = list(candidates or self.candidates.get(task, []))
+        pinned = self.pins.get(task)
+        if self.enabled and len(models) > 1:
+            output_tokens = TASK_OUTPUT_TOKENS.get(task, 600)
+            stats = self._stats.get(task, {})
+            scores = {}
+            for model in models:
+                model_stats = stats.get(model)
+                if model_stats is not None and model_stats.samples >= self.min_samples:
+                    scores[model] = model_stats.expected_seconds(output_tokens)
+            # すべての候補にスコアがそろうまでは既定の順番を使う
+            if len(scores) == len(models) and all(score is not None for score in scores.values()):
+                models.sort(key=lambda model: scores[model])
+            if self.explore > 0 and random.random() < self.explore:
+                # ときどき先頭以外のモデルを先に試し、そのモデルのスコアも更新し続ける
+                models.insert(0, models.pop(random.randrange(1, len(models))))
+        if pinned:
+            models = [pinned] + [model for model in models if model != pinned]
+        return models
+
+    def pin(self, task: str, model: Optional[str]) -> None:
+        """タスクのモデルを固定する（Noneで解除）"""
+        self._ensure_loaded()
+        with self._lock:
+            if model:
+                self.pins[task] = model
+            else:
+                self.pins.pop(task, None)
+            self._dirty = True
+        self.save(force=True)
+
+    def snapshot(self) -> Dict[str, Any]:
+        self._ensure_loaded()
+        with self._lock:
+            stats = {
+                task: {
+                    model: {
+                        **model_stats.to_dict(),
+                        "expected_seconds": model_stats.expected_seconds(TASK_OUTPUT_TOKENS.get(task, 600))
+                    }
+                    for model, model_stats in models.items()
+                }
+                for task, models in self._stats.items()
+            }
+        return {
+            "enabled": self.enabled,
+            "pins": dict(self.pins),
+            "candidates": self.candidates,
+            "stats": stats
+        }
+
+
+# プロセス内で共有するインスタンス
+model_scoreboard = ModelScoreboard()
+
+
+def _cacheable(response: Any, request: Dict[str, Any]) -> bool:
+    """途中で切れた回答や、ツールを呼ばなかったFunction callingの結果はキャッシュしない"""
+    choices = getattr(response, "choices", None)
+    if not choices or choices[0].finish_reason == "length":
+        return False
+    return "tools" not in request or bool(choices[0].message.tool_calls)
+
+
+async def routed_completion(
+    client: Any,
+    task: str,
+    scoreboard: ModelScoreboard = model_scoreboard,
+    task_class: str = BATCH,
+    cache: Optional[ResponseCache] = None,
+    cache_ttl: Optional[float] = None,
+    **kwargs: Any
+) -> Any:
+    """
+    タスクに合ったモデルを順に試してchat.completions.createを呼び出す（結果はスコアボードに記録）
+
+    モデルごとの失敗はログに残して次のモデルを試し、すべて失敗した場合は最後の例外を送出する。
+    呼び出しはtask_classとしてアドミッション制御（utils.admission）の枠を確保してから行う。
+    cacheを指定した場合は、どれかの候補のモデルで同じ呼び出しの結果があればそれを返す。
+    """
+    models = scoreboard.route(task)
+    if cache is not None:
+        cached = await cache.get_completion(*(cache_key(kind="completion", model=model, **kwargs) for model in models))
+        if cached is not None:
+            return cached
+    last_exception: Optional[BaseException] = None
+    for model in models:
+        try:
+            async with llm_admission.slot(PROVIDER_OPENROUTER, task_class):
+                start = time.monotonic()
+                response = await client.chat.completions.create(model=model, **kwargs)
+        except AdmissionRejected:
+            # 混雑で枠が確保できなかった（モデルの失敗ではない）
+            raise
+        except Exception as e:
+            scoreboard.record(task, model, error=True)
+            logging.warning(f"Failed to call {model} for {task}: {e}")
+            last_exception = e
+            continue
+        # ストリーミングでない呼び出しは生成速度を分けて測れないため、レスポンス全体の時間をTTFTとして記録する
+        scoreboard.record(task, model, ttft=time.monotonic() - start)
+        if cache is not None and _cacheable(response, kwargs):
+            await cache.put_completion(cache_key(kind="completion", model=model, **kwargs), response, cache_ttl)
+        return response
+    raise last_exception or ValueError(f"No models are configured for {task}")
@@ -1,12 +1,72 @@
 import os
 import logging
-from typing import AsyncGenerator, Optional, List, Dict
+import time
+from contextlib import aclosing
+from typing import Any, AsyncGenerator, Optional, List, Dict
 from colorama import Fore, Style
 from openai import AsyncOpenAI
 from datetime import datetime
 
 # 修正したwith_retry関数をインポート
-from .retry_logic import with_retry_generator
+from .retry_logic import CONTINUE_PROMPT, STREAM_RETRY_POLICY, StreamRestart, with_retry_generator
+from . import json_codec
+from .llm_clients import get_llm_clients
+from .circuit_breaker import CircuitOpenError, is_provider_failure, model_breakers
+from .hedging import HEDGE_REQUESTS, FirstTokenTimer, hedged_stream, ttft_tracker
+from .admission import BACKGROUND, INTERACTIVE, PROVIDER_OPENROUTER, AdmissionRejected, llm_admission
+from .response_cache import cache_key, replay_stream, response_cache
+from .model_router import TASK_CHAT, TASK_FUNCTION, TASK_MODELS, model_scoreboard
+
+# 発話の分類・要約（annotate_turns）の設定
+# 指定しない場合はスコアボードでFunction callingが最も速いモデルを使う
+ANNOTATION_MODEL = os.getenv("ANNOTATION_MODEL")
+ANNOTATION_MAX_TOKENS_PER_TURN = int(os.getenv("ANNOTATION_MAX_TOKENS_PER_TURN", 150))  # 1発話あたりの出力トークン上限
+ANNOTATION_CONTEXT_TURNS = int(os.getenv("ANNOTATION_CONTEXT_TURNS", 6))  # 文脈として送る直近のスレッド数
+# ストリーミングの回答をレスポンスのキャッシュに保存・再生するか（既定はしない）
+# チャットの回答は同じ質問でも毎回生成し直すべきもので、キャッシュはユーザー間でも共有されるため、
+# 呼び出し側（stream_response(cache=True)）か、この設定で明示的に有効にした場合だけ使う
+STREAM_RESPONSE_CACHE = os.getenv("STREAM_RESPONSE_CACHE", "false").lower() == "true"
+
+def _annotation_tool(name: str, with_type: bool) -> Dict[str, Any]:
+    """発話ごとの分類・要約を受け取るFunction callingのスキーマ"""
+    properties = {"index": {"type": "integer", "description": "Number of the utterance"}}
+    if with_type:
+        properties["type"] = {"type": "string", "description": "One-word label of the intention"}
+    properties["summary"] = {"type": "string", "description": "One-sentence summary with the subject and purpose"}
+    return {
+        "type": "function",
+        "function": {
+            "name": name,
+            "description": "Record the intention label and the one-sentence summary of each utterance" if with_type
+            else "Record the one-sentence summary of each utterance",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "annotations": {
+                        "type": "array",
+                        "items": {"type": "object", "properties": properties, "required": list(properties)}
+                    }
+                },
+                "required": ["annotations"]
+            }
+        }
+    }
+
+
+ANNOTATE_TURNS_TOOL = _annotation_tool("annotate_turns", with_type=True)
+# ラベルがすべてローカルの分類器で決まった場合は要約だけを生成させる
+SUMMARIZE_TURNS_TOOL = _annotation_tool("summarize_turns", with_type=False)
+
+def continuation_messages(system_prompt: str, user_input: str, prefix: str = "") -> List[Dict[str, str]]:
+    """回答を生成するメッセージ（prefixがあれば、その続きを生成させる指示を付ける）"""
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_input}
+    ]
+    if prefix:
+        messages.append({"role": "assistant", "content": prefix})
+        messages.append({"role": "user", "content": CONTINUE_PROMPT})
+    return messages
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -14,68 +74,131 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 class AIOpenRouterStreamClient:
     """AIモデルのストリーミングレスポンスを処理するクラス"""
     
-    def __init__(self, api_key: Optional[str] = None):
-        self.openrouter_client = AsyncOpenAI(
-            base_url="https://openrouter.ai/api/v1",
-            api_key=os.getenv("OPENROUTER_API_KEY")
-        )
+    def __init__(
+        self,
+        api_key: Optional[str] = None,
+        openrouter_client: Optional[AsyncOpenAI] = None,
+        hedging: bool = HEDGE_REQUESTS
+    ):
+        # 指定がなければ共有のクライアント（utils.llm_clients）を使う
+        self._openrouter_client = openrouter_client
+        # 最初のトークンが遅い場合に次のモデルにも同時にリクエストするか（utils.hedging）
+        self.hedging = hedging
+
+        self.openrouter_supported_models = list(TASK_MODELS[TASK_CHAT])
+
+    @property
+    def openrouter_client(self) -> AsyncOpenAI:
+        # lifespanで作成される前に構築されても、最初のリクエストの時点で共有のクライアントを参照する
+        if self._openrouter_client is not None:
+            return self._openrouter_client
+        return get_llm_clients().openrouter
 
-        if not self.openrouter_client.api_key:
-            raise ValueError("OpenRouter API key is required")
+    @openrouter_client.setter
+    def openrouter_client(self, client: AsyncOpenAI) -> None:
+        self._openrouter_client = client
 
-        self.openrouter_supported_models = [
-            "openai/gpt-4.1",
-            "anthropic/claude-3.7-sonnet"
-        ]
+    def _models_to_try(self, model: Optional[str], fallback_models: Optional[List[str]] = None) -> List[str]:
+        # デフォルトモデルの設定
+        if fallback_models is None:
+            # 直近のTTFT・生成速度・エラー率から決めた順番（utils.model_router）
+            fallback_models = model_scoreboard.route(TASK_CHAT)
+        # 指定されたモデルが既定のモデルと同じ場合は2回試さない
+        return list(dict.fromkeys(m for m in [model, *fallback_models] if m is not None))
     
     async def _stream_openrouter(
         self, 
         user_input: str, 
         system_prompt: str,
         model: Optional[str] = None,
-        max_tokens: int = 4000
+        max_tokens: int = 4000,
+        fallback_models: Optional[List[str]] = None,
+        cache: bool = STREAM_RESPONSE_CACHE
     ) -> AsyncGenerator[str, None]:
         """OpenRouter APIを使用してストリーミングレスポンスを生成
         
         モデルの優先順位:
         1. 指定されたモデル
-        2. Claude (anthropic/claude-3.7-sonnet)
-        3. OpenAI (openai/gpt-4.1)
+        2. スコアボード（utils.model_router）でストリーミングの回答が速い順の候補
+           （既定では Claude (anthropic/claude-3.7-sonnet) → OpenAI (openai/gpt-4.1)）
+        （fallback_modelsを指定した場合は 2. の代わりにそのモデルを順に試す）
+        
+        cache=True の場合だけ、同じ呼び出し（temperature=0.0）の回答をキャッシュから返し、保存する。
         """
-        # デフォルトモデルの設定
-        models_to_try = [
-            model,
-            "anthropic/claude-3.7-sonnet", 
-            "openai/gpt-4.1"
-        ]
-        models_to_try = [m for m in models_to_try if m is not None]
+        models_to_try = self._models_to_try(model, fallback_models)
+        
+        # キャッシュを有効にした場合、temperature=0.0 の回答は同じ入力に対してほぼ同じになるため、どのモデルの回答でもあれば返す
+        def _cache_key(cache_model: str) -> str:
+            return cache_key(
+                kind="stream", model=cache_model, max_tokens=max_tokens, temperature=0.0,
+                messages=continuation_messages(system_prompt, user_input, "")
+            )
+        cached = await response_cache.get_stream(*(_cache_key(m) for m in models_to_try)) if cache else None
+        if cached is not None:
+            async for text in replay_stream(cached):
+                yield text
+            return
         
         last_exception = None
+        # クライアントに送信済みのテキスト（モデルを切り替えた場合も続きから生成させる）
+        emitted: List[str] = []
         for current_model in models_to_try:
+            # 障害中のモデル（サーキットがopen）はリトライを待たずにすぐ次のモデルへ進む
+            breaker = model_breakers.get(current_model)
+            if model_breakers.is_open(current_model):
+                logging.info(f"Skipping {current_model}: circuit is open")
+                last_exception = CircuitOpenError(current_model, breaker.retry_in())
+                continue
             try:
-                async def _stream_func():
-                    """実際のストリーミング処理を行う関数"""
-                    stream = await self.openrouter_client.chat.completions.create(
-                        model=current_model,
-                        messages=[
-                            {"role": "system", "content": system_prompt},
-                            {"role": "user", "content": user_input} 
-                        ],
-                        max_tokens=max_tokens,
-                        stream=True,
-                        temperature=0.0
-                    )
-                    
-                    print(f"\n{Fore.BLUE}Model {current_model}:{Style.RESET_ALL}", end="")
-                    
-                    async for chunk in stream:
-                        delta = chunk.choices[0].delta 
-                        if delta and delta.content:
-                            print(delta.content, end="", flush=True)
-                            yield delta.content
+                async def _stream_func(prefix: str = ""):
+                    """実際のストリーミング処理を行う関数（prefixがあればその続きを生成）"""
+                    # ワーカー全体の同時実行数・レートの枠を確保してから呼び出す（ストリームを読み終わるまで使う）
+                    async with llm_admission.slot(PROVIDER_OPENROUTER, INTERACTIVE):
+                        if breaker is not None and not breaker.allow():
+                            raise CircuitOpenError(current_model, breaker.retry_in())
+                        timer = FirstTokenTimer(current_model)
+                        try:
+                            stream = await self.openrouter_client.chat.completions.create(
+                                model=current_model,
+                                messages=continuation_messages(system_prompt, user_input, prefix),
+                                max_tokens=max_tokens,
+                                stream=True,
+                                temperature=0.0
+                            )
+                        
+                            print(f"\n{Fore.BLUE}Model {current_model}:{Style.RESET_ALL}", end="")
+                        
+                            # 途中で閉じられた（クライアントが切断した）場合はHTTPのストリームも閉じる
+                            async with stream:
+                                async for chunk in stream:
+                                    delta = chunk.choices[0].delta 
+                                    if delta and delta.content:
+                                        timer.mark()
+                                        print(delta.content, end="", flush=True)
+                                        yield delta.content
+                        except Exception as e:
+                            if is_provider_failure(e):
+                                model_scoreboard.record(TASK_CHAT, current_model, error=True)
+                            if breaker is not None:
+                                if is_provider_failure(e):
+                                    breaker.record_failure()
+                                else:
+                                    breaker.release()
+                            raise
+                        except BaseException:
+                            # クライアントの切断などで閉じられた場合は成功・失敗のどちらにも数えない
+                            if breaker is not None:
+                                breaker.release()
+                            raise
+                        if breaker is not None:
+                            breaker.record_success()
+                        model_scoreboard.record(
+                            TASK_CHAT, current_model,
+                            ttft=timer.ttft, output_tokens=timer.tokens, duration=timer.generation_seconds()
+                        )
                 
-                # リトライロジックでラップした関数を実行
-                async for text in with_retry_generator(
+                # リトライロジックでラップした関数を実行（途中で失敗しても送信済みのテキストは繰り返さない）
+                async with aclosing(with_retry_generator(
                     _stream_func,
                     max_retries=2,
                     retry_on_exceptions=(Exception,),
@@ -83,14 +206,35 @@ class AIOpenRouterStreamClient:
                         Exception: f"OpenRouter APIエラー ({current_model})",
                         "429": "APIが混雑しています",
                         "overload": "APIが過負荷状態です"
-                    }
-                ):
-                    yield text
+                    },
+                    # リトライ中にサーキットがopenになったら、残りのリトライを待たずに次のモデルへ
+                    # （混雑で枠が確保できなかった場合もリトライしない）
+                    abort_on_exceptions=(CircuitOpenError, AdmissionRejected),
+                    resume_func=_stream_func,
+                    prefix="".join(emitted)
+                )) as texts:
+                    # このモデルが最初から生成した回答だけをキャッシュする（別のモデルの続きは保存しない）
+                    from_start = not emitted
+                    async for text in texts:
+                        if isinstance(text, StreamRestart):
+                            emitted.clear()
+                            from_start = True
+                        else:
+                            emitted.append(text)
+                        yield text
                 
+                if cache and from_start and emitted:
+                    await response_cache.put_stream(_cache_key(current_model), emitted)
                 # If we successfully yield text, break the loop
                 return
             
+            except AdmissionRejected:
+                # 別のモデルでも同じ枠を待つことになるため、フォールバックせずに失敗させる
+                raise
             except Exception as e:
+                if emitted and STREAM_RETRY_POLICY == "raise":
+                    # 回答の途中で別のモデルに切り替えると同じテキストを二重に送るため
+                    raise
                 logging.warning(f"Failed to stream with model {current_model}: {str(e)}")
                 last_exception = e
                 continue
@@ -105,68 +249,120 @@ class AIOpenRouterStreamClient:
         system_prompt: str,
         provider: str = "openrouter",
         model: Optional[str] = None,
-        max_tokens: int = 4000
+        max_tokens: int = 4000,
+        cache: bool = STREAM_RESPONSE_CACHE
     ) -> AsyncGenerator[str, None]:
-        """プロバイダーに基づいてストリーミングレスポンスを生成"""
+        """プロバイダーに基づいてストリーミングレスポンスを生成（cache=Trueで同じ呼び出しの回答をキャッシュする）"""
         if provider.lower() == "openrouter":
-            if not model:
-                model = "anthropic/claude-3.7-sonnet"
-            
-            if model not in self.openrouter_supported_models:
+            if model and model not in self.openrouter_supported_models:
                 logging.warning(f"Model {model} not in supported list. Using default.")
-                model = "anthropic/claude-3.7-sonnet"
+                model = None
             
-            async for text in self._stream_openrouter(user_input, system_prompt, model, max_tokens):
-                yield text
+            # モデルの指定がなければ、スコアボードで最も速いモデルから試す
+            models = self._models_to_try(model)
+            model = models[0]
+            # ヘッジ先は障害中（サーキットがopen）でない次のモデル
+            hedge_models = [m for m in models[1:] if not model_breakers.is_open(m)]
+            if self.hedging and hedge_models:
+                # 最初のトークンが期限（TTFTのパーセンタイル）までに届かなければ次のモデルにも送り、先に返した方を使う
+                stream = hedged_stream(
+                    lambda: self._stream_openrouter(user_input, system_prompt, model, max_tokens, cache=cache),
+                    lambda: self._stream_openrouter(
+                        user_input, system_prompt, hedge_models[0], max_tokens, fallback_models=hedge_models[1:],
+                        cache=cache
+                    ),
+                    ttft_tracker.deadline(model),
+                    hedge_cost=len(system_prompt) + len(user_input)
+                )
+            else:
+                stream = self._stream_openrouter(user_input, system_prompt, model, max_tokens, cache=cache)
+            async with aclosing(stream) as texts:
+                async for text in texts:
+                    yield text
         else:
             logging.error(f"Unsupported provider: {provider}")
             raise ValueError(f"Provider {provider} is not supported")
         
-    async def type_response(
-            self,
-            input: str,
-            threads: List[Dict[str, str]],
-            model: str = "openai/gpt-4.1",
-            max_tokens: int = 4000
-    ) -> AsyncGenerator[str, None]:
-        """ユーザーの入力に対する応答を生成"""
-        try:
-            response = await self.openrouter_client.chat.completions.create(
-                model=model,
-                messages=[
-                    {"role": "system", "content": f"""Classify the intention of the next utterance using a one-word label. Based on the recent conversation with users {threads}"""},
-                    {"role": "user", "content": input}
-                ],
-                max_tokens=max_tokens,
-            )
-            return response.choices[0].message.content
-        except Exception as e:
-            logging.error(f"Error generating type response: {str(e)}")
-            raise e
-        
-    async def content_response(
+    async def annotate_turns(
         self,
-        input: str,
+        utterances: List[Dict[str, str]],
         threads: List[Dict[str, str]],
-        model: str = "openai/gpt-4.1",
-        max_tokens: int = 4000
-    ) -> AsyncGenerator[str, None]:
-        """ユーザーの入力に対する応答を生成"""
+        model: Optional[str] = ANNOTATION_MODEL,
+        max_tokens_per_turn: int = ANNOTATION_MAX_TOKENS_PER_TURN,
+        labels: Optional[List[Optional[str]]] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        複数の発話の分類（type）と要約（summary）をFunction callingの1リクエストで生成
+
+        utterancesは {"role": ..., "content": ...} のリストで、同じ順番で
+        {"type": ..., "summary": ...} のリストを返す。
+        labelsにローカルで判定済みのラベルを渡すと、そのラベルを優先する
+        （すべて判定済みなら要約だけを生成させる）。
+        """
+        labels = labels or [None] * len(utterances)
+        with_type = any(label is None for label in labels)
+        tool = ANNOTATE_TURNS_TOOL if with_type else SUMMARIZE_TURNS_TOOL
+        instruction = (
+            "For each numbered utterance, classify its intention using a one-word label and summarize its main point in one sentence, clearly identifying the subject and purpose."
+            if with_type else
+            "For each numbered utterance, summarize its main point in one sentence, clearly identifying the subject and purpose."
+        )
+        numbered = "\n\n".join(
+            f"[{i}] ({utterance['role']})\n{utterance['content']}" for i, utterance in enumerate(utterances)
+        )
+        context = threads[-ANNOTATION_CONTEXT_TURNS:] if ANNOTATION_CONTEXT_TURNS > 0 else []
+        model = model or model_scoreboard.route(TASK_FUNCTION)[0]
+        request = dict(
+            model=model,
+            messages=[
+                {"role": "system", "content": f"""{instruction} Based on the recent conversation with users {context}"""},
+                {"role": "user", "content": numbered}
+            ],
+            tools=[tool],
+            tool_choice={"type": "function", "function": {"name": tool["function"]["name"]}},
+            max_tokens=max_tokens_per_turn * len(utterances),
+            temperature=0.0
+        )
+        # 「ありがとう」「はい」のような短い発話は同じ文脈で繰り返されるため、同じ呼び出しはキャッシュから返す
+        key = cache_key(kind="completion", **request)
         try:
-            response = await self.openrouter_client.chat.completions.create(
-                model=model,
-                messages=[
-                    {"role": "system", "content": f"""Summarize the main point of the following utterance in one sentence, clearly identifying the subject and purpose. Based on the recent conversation with users {threads}"""},
-                    {"role": "user", "content": input}
-                ],
-                max_tokens=max_tokens,
-            )
-            return response.choices[0].message.content
+            response = cached = await response_cache.get_completion(key)
+            if response is None:
+                # 発話の分類・要約はユーザーを待たせないため、対話中のチャットより後回しにする
+                async with llm_admission.slot(PROVIDER_OPENROUTER, BACKGROUND):
+                    start = time.monotonic()
+                    response = await self.openrouter_client.chat.completions.create(**request)
+                model_scoreboard.record(TASK_FUNCTION, model, ttft=time.monotonic() - start)
+            message = response.choices[0].message
+            if not message.tool_calls:
+                raise ValueError(f"{tool['function']['name']} was not called")
+            annotations = json_codec.loads(message.tool_calls[0].function.arguments)["annotations"]
+            by_index = {item["index"]: item for item in annotations}
+            result = [
+                {"type": labels[i] if labels[i] is not None else by_index[i]["type"], "summary": by_index[i]["summary"]}
+                for i in range(len(utterances))
+            ]
+            if cached is None:
+                # 形式の正しいレスポンスだけをキャッシュする
+                await response_cache.put_completion(key, response)
+            return result
         except Exception as e:
-            logging.error(f"Error generating content response: {str(e)}")
+            if is_provider_failure(e) and not isinstance(e, (ValueError, KeyError, AdmissionRejected)):
+                model_scoreboard.record(TASK_FUNCTION, model, error=True)
+            logging.error(f"Error generating turn annotations: {str(e)}")
             raise e
 
+    async def annotate_turn(
+        self,
+        utterance: Dict[str, str],
+        threads: List[Dict[str, str]],
+        model: Optional[str] = ANNOTATION_MODEL,
+        label: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """1つの発話の分類と要約を生成"""
+        return (await self.annotate_turns([utterance], threads, model=model, labels=[label]))[0]
+
 # 使用例:
-# ai_client = AIStreamClient(anthropic_client, openrouter_client)
+# ai_client = AIStreamClient()  # 共有のAsyncAnthropic / AsyncOpenAIを使う
 # async for text in ai_client.stream_response(user_input, system_prompt, "anthropic"):
 #     # テキストを処理
\ No newline at end of file
@@ -0,0 +1,280 @@
+# utils/response_cache.py
+"""
+決定的なLLMの呼び出しの完全一致キャッシュ
+
+短い発話の分類・要約や、同じフォームの送信で繰り返される create_financial_strategy などは、
+同じ入力に対してほぼ同じ出力になる。
+(model, messages, tools, パラメーター) のハッシュをキーにして結果を保存し、
+次に同じ呼び出しがあればLLMを呼ばずに返す。
+
+- メモリ上のLRU（RESPONSE_CACHE_MAX_ENTRIES件）と、任意でSQLiteのディスクキャッシュ
+  （RESPONSE_CACHE_SQLITE_PATH を指定した場合、再起動後・ワーカー間でも共有）
+- ストリーミングの回答（STREAM_RESPONSE_CACHE か呼び出し側で有効にした場合だけ）は差分のリストとして
+  保存し、ヒットした場合は待たずに続けて返す（SSEとしては通常の回答と同じ形で、すぐに最後まで送られる）
+- ヒット率と、呼ばずに済んだトークン数を snapshot() で /admin/metrics に表示する
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, AsyncGenerator, Dict, List, Optional, Tuple
+
+from openai.types.chat import ChatCompletion
+
+from . import json_codec
+
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "true").lower() == "true"
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", 1000))  # メモリに保持する件数
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", 3600))  # 既定の有効期限（秒）
+# SQLiteのディスクキャッシュのパス（空ならメモリのみ）
+RESPONSE_CACHE_SQLITE_PATH = os.getenv("RESPONSE_CACHE_SQLITE_PATH", "")
+RESPONSE_CACHE_DISK_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_DISK_MAX_ENTRIES", 100000))
+
+KIND_STREAM = "stream"
+KIND_COMPLETION = "completion"
+
+# ディスクキャッシュの期限切れ・上限を超えた行を削除する間隔（保存の回数）
+_PRUNE_EVERY = 200
+
+
+def cache_key(**request: Any) -> str:
+    """呼び出しの内容（model・messages・tools・パラメーター）から決まるキー"""
+    canonical = json.dumps(request, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class CacheMetrics:
+    """ヒット率と、キャッシュから返したために呼ばずに済んだトークン数"""
+
+    def __init__(self):
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.expired = 0
+        self.saved_prompt_tokens = 0
+        self.saved_completion_tokens = 0  # ストリーミングは差分1つをおよそ1トークンとして数える
+
+    def to_dict(self) -> Dict[str, Any]:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_ratio": round((self.memory_hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+            "stores": self.stores,
+            "expired": self.expired,
+            "saved_prompt_tokens": self.saved_prompt_tokens,
+            "saved_completion_tokens": self.saved_completion_tokens
+        }
+
+
+class _DiskCache:
+    """SQLiteのディスクキャッシュ（呼び出しはasyncio.to_threadで行う）"""
+
+    def __init__(self, path: str, max_entries: int):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._puts = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        # 複数のワーカーが同じファイルを読み書きするため、WALモードで読み込みを止めない
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, kind TEXT NOT NULL, value BLOB NOT NULL, "
+            "prompt_tokens INTEGER NOT NULL, completion_tokens INTEGER NOT NULL, "
+            "created_at REAL NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_created_at ON responses (created_at)")
+
+    def get(self, keys: Tuple[str, ...]) -> Optional[Tuple[str, str, bytes, int, int, float]]:
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                row = self._conn.execute(
+                    "SELECT key, kind, value, prompt_tokens, completion_tokens, expires_at "
+                    "FROM responses WHERE key = ? AND expires_at > ?",
+                    (key, now)
+                ).fetchone()
+                if row is not None:
+                    return row
+        return None
+
+    def put(self, key: str, kind: str, value: bytes, prompt_tokens: int, completion_tokens: int, expires_at: float) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, kind, value, prompt_tokens, completion_tokens, time.time(), expires_at)
+            )
+            self._puts += 1
+            if self._puts % _PRUNE_EVERY == 0:
+                self._conn.execute("DELETE FROM responses WHERE expires_at <= ?", (time.time(),))
+                self._conn.execute(
+                    "DELETE FROM responses WHERE key IN ("
+                    "SELECT key FROM responses ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,)
+                )
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class ResponseCache:
+    """LLMの呼び出しの結果のキャッシュ（メモリのLRU + 任意でSQLite）"""
+
+    def __init__(
+        self,
+        enabled: bool = RESPONSE_CACHE,
+        max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+        ttl: float = RESPONSE_CACHE_TTL,
+        sqlite_path: str = RESPONSE_CACHE_SQLITE_PATH,
+        disk_max_entries: int = RESPONSE_CACHE_DISK_MAX_ENTRIES
+    ):
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.sqlite_path = sqlite_path
+        self.disk_max_entries = disk_max_entries
+        self.metrics = CacheMetrics()
+        # key -> (kind, value, prompt_tokens, completion_tokens, expires_at)（expires_atはtime.time()）
+        self._entries: "OrderedDict[str, Tuple[str, Any, int, int, float]]" = OrderedDict()
+        self._disk: Optional[_DiskCache] = None
+        self._disk_failed = False
+
+    def _get_disk(self) -> Optional[_DiskCache]:
+        # 最初に使うときに開く（インポート時にファイルを作らないため）
+        if self._disk is None and self.sqlite_path and not self._disk_failed:
+            try:
+                self._disk = _DiskCache(self.sqlite_path, self.disk_max_entries)
+            except sqlite3.Error as e:
+                self._disk_failed = True
+                logging.warning(f"Failed to open response cache database: {e}")
+        return self._disk
+
+    def _remember(self, key: str, entry: Tuple[str, Any, int, int, float]) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def _get(self, kind: str, keys: Tuple[str, ...]) -> Optional[Any]:
+        if not self.enabled:
+            return None
+        now = time.time()
+        for key in keys:
+            entry = self._entries.get(key)
+            if entry is None:
+                continue
+            if entry[4] <= now:
+                self.metrics.expired += 1
+                del self._entries[key]
+                continue
+            if entry[0] == kind:
+                self._entries.move_to_end(key)
+                self.metrics.memory_hits += 1
+                self.metrics.saved_prompt_tokens += entry[2]
+                self.metrics.saved_completion_tokens += entry[3]
+                return entry[1]
+
+        disk = self._get_disk()
+        if disk is not None:
+            try:
+                row = await asyncio.to_thread(disk.get, keys)
+            except sqlite3.Error as e:
+                logging.warning(f"Failed to read response cache: {e}")
+                row = None
+            if row is not None and row[1] == kind:
+                key, _, payload, prompt_tokens, completion_tokens, expires_at = row
+                value = json_codec.loads(payload)
+                self._remember(key, (kind, value, prompt_tokens, completion_tokens, expires_at))
+                self.metrics.disk_hits += 1
+                self.metrics.saved_prompt_tokens += prompt_tokens
+                self.metrics.saved_completion_tokens += completion_tokens
+                return value
+        self.metrics.misses += 1
+        return None
+
+    async def _put(self, kind: str, key: str, value: Any, prompt_tokens: int, completion_tokens: int,
+                   ttl: Optional[float]) -> None:
+        if not self.enabled:
+            return
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        self._remember(key, (kind, value, prompt_tokens, completion_tokens, expires_at))
+        self.metrics.stores += 1
+        disk = self._get_disk()
+        if disk is not None:
+            try:
+                await asyncio.to_thread(
+                    disk.put, key, kind, json_codec.dumps_bytes(value), prompt_tokens, completion_tokens, expires_at
+                )
+            except sqlite3.Error as e:
+                logging.warning(f"Failed to write response cache: {e}")
+
+    async def get_stream(self, *keys: str) -> Optional[List[str]]:
+        """ストリーミングの回答（差分のリスト）を取得（keysのうち最初に見つかったもの）"""
+        return await self._get(KIND_STREAM, keys)
+
+    async def put_stream(self, key: str, chunks: List[str], ttl: Optional[float] = None) -> None:
+        await self._put(KIND_STREAM, key, list(chunks), 0, len(chunks), ttl)
+
+    async def get_completion(self, *keys: str) -> Optional[ChatCompletion]:
+        """chat.completions.createのレスポンスを取得（keysのうち最初に見つかったもの）"""
+        data = await self._get(KIND_COMPLETION, keys)
+        return None if data is None else ChatCompletion.model_validate(data)
+
+    async def put_completion(self, key: str, response: ChatCompletion, ttl: Optional[float] = None) -> None:
+        usage = getattr(response, "usage", None)
+        await self._put(
+            KIND_COMPLETION, key, response.model_dump(mode="json"),
+            getattr(usage, "prompt_tokens", 0) or 0, getattr(usage, "completion_tokens", 0) or 0, ttl
+        )
+
+    async def clear(self) -> None:
+        """すべてのエントリを削除する（管理画面から）"""
+        self._entries.clear()
+        disk = self._get_disk()
+        if disk is not None:
+            await asyncio.to_thread(disk.clear)
+
+    def close(self) -> None:
+        if self._disk is not None:
+            self._disk.close()
+            self._disk = None
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "disk": self.sqlite_path or None,
+            **self.metrics.to_dict()
+        }
+
+
+# プロセス内で共有するインスタンス
+response_cache = ResponseCache()
+
+
+async def replay_stream(chunks: List[str]) -> AsyncGenerator[str, None]:
+    """キャッシュしたストリーミングの回答を、待たずに続けて返す"""
+    for chunk in chunks:
+        yield chunk
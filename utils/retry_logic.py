@@ -1,10 +1,136 @@
 import asyncio
-from typing import Any, Callable, TypeVar, Optional, AsyncGenerator
+import os
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Dict, TypeVar, Optional, AsyncGenerator
 from colorama import Fore, Style
 import traceback
 
 T = TypeVar('T')
 
+# 回答の途中で失敗した場合の扱い
+# - resume: 送信済みのテキストを渡して続きから生成させる（resume_funcがない場合はrestart）
+# - restart: クライアントにrestartイベントを送り、最初から生成し直す
+# - raise: リトライせずに例外を送出する
+STREAM_RETRY_POLICY = os.getenv("STREAM_RETRY_POLICY", "resume").lower()
+# バックオフの上限（秒）
+RETRY_MAX_BACKOFF = float(os.getenv("RETRY_MAX_BACKOFF", 30))
+# Retry-After ヘッダーに従って待つ最大秒数（これより長い指定は上限で待つ）
+RETRY_AFTER_MAX = float(os.getenv("RETRY_AFTER_MAX", 60))
+
+# 続きを生成させる場合に、送信済みのテキストの後に付ける指示
+CONTINUE_PROMPT = (
+    "The previous answer was interrupted. Continue it exactly from where it stopped. "
+    "Do not repeat any text that was already written and do not add any preface."
+)
+
+
+class StreamRestart:
+    """
+    送信済みのテキストを破棄して最初から生成し直すことを示すマーカー
+
+    ストリームの途中に流れてくるので、呼び出し側はそれまでのテキストを捨てて
+    クライアントにrestartイベントを送る。
+    """
+
+    def __init__(self, discarded: str):
+        self.discarded = discarded
+
+    def __repr__(self) -> str:
+        return f"StreamRestart(discarded={len(self.discarded)} chars)"
+
+
+class RetryMetrics:
+    """リトライの回数と、やり直しで無駄になった出力の量"""
+
+    def __init__(self):
+        self.retries = 0  # 再試行の回数（ストリーム・通常の呼び出しの合計）
+        self.resumes = 0  # 送信済みのテキストの続きから再開した回数
+        self.restarts = 0  # 最初から生成し直した回数
+        self.aborts = 0  # 送信済みのテキストがあったためリトライせずに失敗させた回数（raiseポリシー）
+        self.exhausted = 0  # 最大リトライ回数に達して失敗した回数
+        self.retry_after_waits = 0  # Retry-After ヘッダーに従って待った回数
+        self.backoff_seconds = 0.0
+        # 最初から生成し直したために破棄した出力（差分1つをおよそ1トークンとして数える）
+        self.wasted_tokens = 0
+        self.wasted_chars = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "retries": self.retries,
+            "resumes": self.resumes,
+            "restarts": self.restarts,
+            "aborts": self.aborts,
+            "exhausted": self.exhausted,
+            "retry_after_waits": self.retry_after_waits,
+            "backoff_seconds": round(self.backoff_seconds, 3),
+            "wasted_tokens": self.wasted_tokens,
+            "wasted_chars": self.wasted_chars
+        }
+
+
+# プロセス内で共有するインスタンス
+retry_metrics = RetryMetrics()
+
+
+def retry_after_seconds(exception: BaseException) -> Optional[float]:
+    """例外のHTTPレスポンスから Retry-After（retry-after-ms / 秒数 / HTTP日付）を読み取る"""
+    response = getattr(exception, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return max(0.0, float(value) / 1000)
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(
+    attempt: int,
+    initial_backoff: float,
+    backoff_factor: float,
+    exception: Optional[BaseException] = None,
+    max_backoff: float = RETRY_MAX_BACKOFF,
+    metrics: RetryMetrics = retry_metrics
+) -> float:
+    """
+    attempt回目（1始まり）の失敗の後に待つ秒数
+
+    Retry-After の指定があればそれに従い、なければ full jitter
+    （0〜指数バックオフの上限の一様乱数）で、同時に失敗したリクエストの再試行を分散させる。
+    """
+    retry_after = retry_after_seconds(exception) if exception is not None else None
+    if retry_after is not None:
+        metrics.retry_after_waits += 1
+        return min(retry_after, RETRY_AFTER_MAX)
+    ceiling = min(max_backoff, initial_backoff * backoff_factor ** (attempt - 1))
+    return random.uniform(0, ceiling)
+
+
+def _error_message(e: BaseException, error_messages: dict) -> str:
+    # エラーメッセージの選択
+    error_msg = error_messages.get(type(e), str(e))
+    for key in error_messages:
+        if isinstance(key, str) and key.lower() in str(e).lower():
+            error_msg = error_messages[key]
+            break
+    return error_msg
+
+
 async def with_retry_generator(
     generator_func: Callable[..., AsyncGenerator[T, None]],
     *args: Any,
@@ -13,11 +139,20 @@ async def with_retry_generator(
     backoff_factor: float = 2.0,
     retry_on_exceptions: tuple = (Exception,),
     error_messages: dict = None,
+    abort_on_exceptions: tuple = (),
+    resume_func: Optional[Callable[..., AsyncGenerator[T, None]]] = None,
+    prefix: str = "",
+    policy: str = STREAM_RETRY_POLICY,
+    metrics: RetryMetrics = retry_metrics,
     **kwargs: Any
 ) -> AsyncGenerator[T, None]:
     """
     非同期ジェネレータ関数に対する汎用的なリトライロジック
-    
+
+    送信済みのテキストを記録し、途中で失敗した場合に同じテキストを二重に送らない。
+    policy が resume なら resume_func(送信済みのテキスト, *args, **kwargs) で続きから生成し、
+    restart なら StreamRestart を流してから最初から生成し直す。
+
     Parameters:
     - generator_func: リトライする非同期ジェネレータ関数
     - args: 関数への位置引数
@@ -26,10 +161,15 @@ async def with_retry_generator(
     - backoff_factor: バックオフ係数
     - retry_on_exceptions: リトライする例外のタプル
     - error_messages: 例外タイプごとのエラーメッセージ辞書
+    - abort_on_exceptions: リトライせずにすぐ送出する例外のタプル
+    - resume_func: 送信済みのテキストの続きを生成する非同期ジェネレータ関数
+    - prefix: すでにクライアントに送信済みのテキスト（別のモデルに切り替えた場合など）
+    - policy: 途中で失敗した場合の扱い（resume / restart / raise）
+    - metrics: リトライの回数などを記録するインスタンス
     - kwargs: 関数へのキーワード引数
-    
+
     Yields:
-    - ジェネレータから生成される値
+    - ジェネレータから生成される値（やり直す場合は StreamRestart）
     """
     if error_messages is None:
         error_messages = {
@@ -37,35 +177,61 @@ async def with_retry_generator(
             "429": "APIが混雑しています。時間をおいて再度お試しください。",
             "overloaded": "APIが混雑しています。時間をおいて再度お試しください。"
         }
-    
+    if policy == "resume" and resume_func is None:
+        policy = "restart"
+
     retry_count = 0
-    backoff_time = initial_backoff
-    
+    emitted = [prefix] if prefix else []
+    emitted_chunks = 0
+
     while retry_count < max_retries:
-        try:
+        if emitted and policy == "resume":
+            metrics.resumes += 1
+            gen = resume_func("".join(emitted), *args, **kwargs)
+        else:
+            if emitted:
+                if policy != "restart":
+                    metrics.aborts += 1
+                    raise RuntimeError("送信済みのテキストがあるため再試行できません")
+                discarded = "".join(emitted)
+                metrics.restarts += 1
+                metrics.wasted_tokens += emitted_chunks
+                metrics.wasted_chars += len(discarded)
+                emitted.clear()
+                emitted_chunks = 0
+                yield StreamRestart(discarded)
             # 非同期ジェネレータ関数を呼び出し
             gen = generator_func(*args, **kwargs)
+        try:
             async for item in gen:
+                if isinstance(item, str):
+                    emitted.append(item)
+                    emitted_chunks += 1
                 yield item
             return  # 成功したら終了
+        except abort_on_exceptions:
+            raise
         except retry_on_exceptions as e:
             retry_count += 1
-            
-            # エラーメッセージの選択
-            error_msg = error_messages.get(type(e), str(e))
-            for key in error_messages:
-                if isinstance(key, str) and key.lower() in str(e).lower():
-                    error_msg = error_messages[key]
-                    break
-            
+            error_msg = _error_message(e, error_messages)
+
+            if emitted and policy == "raise":
+                metrics.aborts += 1
+                raise
             if retry_count < max_retries:
-                print(f"\n{Fore.YELLOW}{error_msg}。{backoff_time}秒後に再試行します...({retry_count}/{max_retries}){Style.RESET_ALL}")
-                await asyncio.sleep(backoff_time)
-                backoff_time *= backoff_factor
+                metrics.retries += 1
+                delay = backoff_delay(retry_count, initial_backoff, backoff_factor, e, metrics=metrics)
+                metrics.backoff_seconds += delay
+                print(f"\n{Fore.YELLOW}{error_msg}。{delay:.2f}秒後に再試行します...({retry_count}/{max_retries}){Style.RESET_ALL}")
+                await asyncio.sleep(delay)
             else:
+                metrics.exhausted += 1
                 print(f"\n{Fore.RED}最大リトライ回数に達しました。{error_msg}{Style.RESET_ALL}\n")
                 print(f"詳細なエラー: {traceback.format_exc()}")
                 raise  # 最大リトライ回数に達した場合は例外を再送出
+        finally:
+            # クライアントの切断などで途中で閉じられた場合も上流のストリームを閉じる
+            await gen.aclose()
 
 async def with_retry(
     func: Callable[..., T],
@@ -79,7 +245,7 @@ async def with_retry(
 ) -> T:
     """
     通常の非同期関数に対する汎用的なリトライロジック
-    
+
     Parameters:
     - func: リトライする非同期関数
     - args: 関数への位置引数
@@ -89,7 +255,7 @@ async def with_retry(
     - retry_on_exceptions: リトライする例外のタプル
     - error_messages: 例外タイプごとのエラーメッセージ辞書
     - kwargs: 関数へのキーワード引数
-    
+
     Returns:
     - 関数の戻り値
     """
@@ -99,32 +265,28 @@ async def with_retry(
             "429": "APIが混雑しています。時間をおいて再度お試しください。",
             "overloaded": "APIが混雑しています。時間をおいて再度お試しください。"
         }
-    
+
     retry_count = 0
-    backoff_time = initial_backoff
     last_exception = None
-    
+
     while retry_count < max_retries:
         try:
             return await func(*args, **kwargs)
         except retry_on_exceptions as e:
             retry_count += 1
             last_exception = e
-            
-            # エラーメッセージの選択
-            error_msg = error_messages.get(type(e), str(e))
-            for key in error_messages:
-                if isinstance(key, str) and key.lower() in str(e).lower():
-                    error_msg = error_messages[key]
-                    break
-            
+            error_msg = _error_message(e, error_messages)
+
             if retry_count < max_retries:
-                print(f"\n{Fore.YELLOW}{error_msg}。{backoff_time}秒後に再試行します...({retry_count}/{max_retries}){Style.RESET_ALL}")
-                await asyncio.sleep(backoff_time)
-                backoff_time *= backoff_factor
+                retry_metrics.retries += 1
+                delay = backoff_delay(retry_count, initial_backoff, backoff_factor, e)
+                retry_metrics.backoff_seconds += delay
+                print(f"\n{Fore.YELLOW}{error_msg}。{delay:.2f}秒後に再試行します...({retry_count}/{max_retries}){Style.RESET_ALL}")
+                await asyncio.sleep(delay)
             else:
+                retry_metrics.exhausted += 1
                 print(f"\n{Fore.RED}最大リトライ回数に達しました。{error_msg}{Style.RESET_ALL}\n")
                 print(f"詳細なエラー: {traceback.format_exc()}")
-    
+
     # 最大リトライ回数に達した場合
-    raise last_exception
\ No newline at end of file
+    raise last_exception
@@ -0,0 +1,274 @@
+# utils/semantic_cache.py
+"""
+言い換えた質問のためのローカルなセマンティックキャッシュ
+
+/financial/financial-chat は、同じ顧客が同じ戦略・ライフプランについて言い換えただけの質問
+（「老後資金は足りますか」「老後の資金って足りる？」）をするたびに openai/gpt-4o を呼び出していた。
+質問を文字n-gramのハッシュベクトル（ネットワークの埋め込みは使わない）にして、
+ユーザーと文脈のバージョン（戦略・ライフプランから作ったコンテキストのハッシュ）ごとに
+近い質問を探し、コサイン類似度が閾値以上なら前回の回答をすぐに返す。
+
+- 文字n-gramが近くても、内容を表す語（漢字・カタカナ・英数字）や否定の数が違う質問
+  （「増やす」「減らす」、「いる？」「いらない？」など）には回答を返さない
+- 索引は (スコープ, 内容を表す語の集合) -> エントリで、同じ集合の質問とだけ類似度を計算する
+  （SEMANTIC_CACHE_MATCH_TERMS=false の場合は (スコープ, 特徴) の転置索引で、質問の特徴のうち
+  出現の少ないものから候補を集める。どちらもエントリが多くても全件とは比べない）
+- エントリ数は SEMANTIC_CACHE_MAX_ENTRIES までで、超えたら最も長く使われていないものから削除する
+- 文脈が変わるとスコープが変わるため、古い戦略・ライフプランに対する回答は返さない
+"""
+import hashlib
+import math
+import os
+import re
+import time
+import unicodedata
+import zlib
+from collections import OrderedDict
+from typing import Any, Dict, FrozenSet, List, Optional, Set, Tuple
+
+SEMANTIC_CACHE = os.getenv("SEMANTIC_CACHE", "true").lower() == "true"
+# これ以上のコサイン類似度の質問を同じ質問とみなす
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.8))
+# 内容を表す語（漢字・カタカナ・英数字）と否定の語尾の数が同じ質問だけを同じ質問とみなすか
+SEMANTIC_CACHE_MATCH_TERMS = os.getenv("SEMANTIC_CACHE_MATCH_TERMS", "true").lower() == "true"
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", 10000))
+SEMANTIC_CACHE_TTL = float(os.getenv("SEMANTIC_CACHE_TTL", 86400))  # 回答を使う期間（秒）
+# 候補を集めるのに使う、出現の少ない特徴の数
+SEMANTIC_CACHE_PROBE_FEATURES = int(os.getenv("SEMANTIC_CACHE_PROBE_FEATURES", 12))
+
+# 漢字・カタカナ・英数字の部分は文字の1〜3-gramにし、ひらがなの部分（助詞・語尾）は
+# 「って」「ですか」のような言い換えで変わりやすいため、1つの特徴として小さい重みで数える
+NGRAM_SIZES = (1, 2, 3)
+HIRAGANA_WEIGHT = 0.3
+HASH_DIMENSIONS = 1 << 20
+
+# 質問の意味に関係しない記号・空白
+_IGNORED = re.compile(r"[\s、。，．,.!?！？「」『』（）()・~〜ー-]+")
+_HIRAGANA_RUNS = re.compile(r"([ぁ-ゟ]+)")
+# 内容を表す語（英数字の語・カタカナの語・漢字1文字ずつ）
+_TERMS = re.compile(r"[a-z0-9]+|[ァ-ヿ]+|[一-鿿々]")
+# 否定の語尾（ひらがなの部分は小さい重みの1つの特徴なので、文字n-gramの類似度には表れにくい）
+_NEGATIONS = re.compile(r"ない|なく|なかっ|なけれ|ません")
+
+
+def normalize(text: str) -> str:
+    """全角・半角と大文字・小文字をそろえ、記号と空白を除く"""
+    return _IGNORED.sub("", unicodedata.normalize("NFKC", text).lower())
+
+
+def content_terms(text: str) -> FrozenSet[str]:
+    """
+    質問の内容を表す語の集合
+
+    文字n-gramの類似度だけでは「NISAを始めるべき？」と「NISAをやめるべき？」、
+    「増やす」と「減らす」が近くなってしまうため、この集合が同じ質問だけを同じ質問とみなす。
+    「保険はいる？」と「保険はいらない？」のように語尾だけが違う質問も分けるため、
+    否定の語尾の数（「しなくてもいい」は1、「しないといけない」は2）も集合に含める。
+    """
+    text = normalize(text)
+    terms = set(_TERMS.findall(text))
+    negations = len(_NEGATIONS.findall(text))
+    if negations:
+        terms.add(f"ない×{negations}")
+    return frozenset(terms)
+
+
+def _feature(gram: str) -> int:
+    # 組み込みの hash() はプロセスごとに変わる（PYTHONHASHSEED）ため、ワーカー間・再起動後でも同じ値になるCRC32を使う
+    return zlib.crc32(gram.encode("utf-8")) & (HASH_DIMENSIONS - 1)
+
+
+def vectorize(text: str) -> Dict[int, float]:
+    """文字n-gramのハッシュベクトル（対数をとった出現数をL2正規化したもの、疎なdict）"""
+    text = normalize(text)
+    counts: Dict[int, float] = {}
+    for segment in _HIRAGANA_RUNS.split(text):
+        if not segment:
+            continue
+        if _HIRAGANA_RUNS.fullmatch(segment):
+            feature = _feature(segment)
+            counts[feature] = counts.get(feature, 0) + HIRAGANA_WEIGHT
+            continue
+        for n in NGRAM_SIZES:
+            for i in range(len(segment) - n + 1):
+                feature = _feature(segment[i:i + n])
+                counts[feature] = counts.get(feature, 0) + 1
+    weights = {feature: 1.0 + math.log(count) if count >= 1 else count for feature, count in counts.items()}
+    norm = math.sqrt(sum(w * w for w in weights.values()))
+    return {feature: w / norm for feature, w in weights.items()} if norm else {}
+
+
+def cosine(a: Dict[int, float], b: Dict[int, float]) -> float:
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(w * b.get(feature, 0.0) for feature, w in a.items())
+
+
+def context_scope(user_id: Any, context: str) -> str:
+    """ユーザーと文脈のバージョンから決まるスコープ（文脈が変わると別のスコープになる）"""
+    version = hashlib.sha256(context.encode("utf-8")).hexdigest()[:16]
+    return f"{user_id}:{version}"
+
+
+class SemanticHit:
+    __slots__ = ("answer", "question", "similarity")
+
+    def __init__(self, answer: str, question: str, similarity: float):
+        self.answer = answer
+        self.question = question
+        self.similarity = similarity
+
+
+class _Entry:
+    __slots__ = ("scope", "question", "answer", "vector", "terms", "expires_at")
+
+    def __init__(self, scope: str, question: str, answer: str, vector: Dict[int, float],
+                 terms: FrozenSet[str], expires_at: float):
+        self.scope = scope
+        self.question = question
+        self.answer = answer
+        self.vector = vector
+        self.terms = terms
+        self.expires_at = expires_at
+
+
+class SemanticCacheMetrics:
+    def __init__(self):
+        self.lookups = 0
+        self.hits = 0
+        self.stores = 0
+        self.evictions = 0
+        self.expired = 0
+        self.candidates = 0  # 類似度を計算したエントリの合計
+        self.lookup_seconds = 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_ratio": round(self.hits / self.lookups, 4) if self.lookups else 0.0,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "expired": self.expired,
+            "avg_candidates": round(self.candidates / self.lookups, 2) if self.lookups else 0.0,
+            "avg_lookup_ms": round(self.lookup_seconds / self.lookups * 1000, 3) if self.lookups else 0.0
+        }
+
+
+class SemanticCache:
+    """スコープごとに近い質問の回答を返すキャッシュ（ワーカー内のメモリ）"""
+
+    def __init__(
+        self,
+        enabled: bool = SEMANTIC_CACHE,
+        threshold: float = SEMANTIC_CACHE_THRESHOLD,
+        max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES,
+        ttl: float = SEMANTIC_CACHE_TTL,
+        probe_features: int = SEMANTIC_CACHE_PROBE_FEATURES,
+        match_terms: bool = SEMANTIC_CACHE_MATCH_TERMS
+    ):
+        self.enabled = enabled
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.probe_features = probe_features
+        self.match_terms = match_terms
+        self.metrics = SemanticCacheMetrics()
+        self._entries: "OrderedDict[int, _Entry]" = OrderedDict()  # 古い（最近使われていない）順
+        self._postings: Dict[Tuple[str, Any], Set[int]] = {}
+        self._next_id = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _index_keys(self, scope: str, vector: Dict[int, float], terms: FrozenSet[str]) -> List[Tuple[str, Any]]:
+        # 内容を表す語が同じ質問だけを比べる場合は、その集合ごとに分けておけば十分
+        if self.match_terms:
+            return [(scope, terms)]
+        return [(scope, feature) for feature in vector]
+
+    def _remove(self, entry_id: int) -> None:
+        entry = self._entries.pop(entry_id)
+        for key in self._index_keys(entry.scope, entry.vector, entry.terms):
+            postings = self._postings.get(key)
+            if postings is not None:
+                postings.discard(entry_id)
+                if not postings:
+                    del self._postings[key]
+
+    def _candidates(self, scope: str, vector: Dict[int, float], terms: FrozenSet[str]) -> Set[int]:
+        if self.match_terms:
+            return set(self._postings.get((scope, terms), ()))
+        postings = [p for p in (self._postings.get((scope, feature)) for feature in vector) if p]
+        # 出現の少ない特徴から候補を集める（よくある「ますか」などの特徴の長いリストは読まない）
+        postings.sort(key=len)
+        candidates: Set[int] = set()
+        for p in postings[:self.probe_features]:
+            candidates.update(p)
+        return candidates
+
+    def lookup(self, scope: str, question: str) -> Optional[SemanticHit]:
+        """スコープ内で最も近い質問の回答を返す（類似度が閾値未満ならNone）"""
+        if not self.enabled:
+            return None
+        start = time.perf_counter()
+        self.metrics.lookups += 1
+        vector = vectorize(question)
+        terms = content_terms(question)
+        best_id, best = None, 0.0
+        now = time.time()
+        candidates = self._candidates(scope, vector, terms)
+        self.metrics.candidates += len(candidates)
+        for entry_id in candidates:
+            entry = self._entries[entry_id]
+            if entry.expires_at <= now:
+                self.metrics.expired += 1
+                self._remove(entry_id)
+                continue
+            similarity = cosine(vector, entry.vector)
+            if similarity > best:
+                best_id, best = entry_id, similarity
+        self.metrics.lookup_seconds += time.perf_counter() - start
+        if best_id is None or best < self.threshold:
+            return None
+        self.metrics.hits += 1
+        self._entries.move_to_end(best_id)
+        entry = self._entries[best_id]
+        return SemanticHit(entry.answer, entry.question, best)
+
+    def store(self, scope: str, question: str, answer: str) -> None:
+        if not self.enabled:
+            return
+        vector = vectorize(question)
+        if not vector:
+            return
+        terms = content_terms(question)
+        entry_id = self._next_id
+        self._next_id += 1
+        self._entries[entry_id] = _Entry(scope, question, answer, vector, terms, time.time() + self.ttl)
+        for key in self._index_keys(scope, vector, terms):
+            postings = self._postings.get(key)
+            if postings is None:
+                postings = self._postings[key] = set()
+            postings.add(entry_id)
+        self.metrics.stores += 1
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+            self.metrics.evictions += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._postings.clear()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "threshold": self.threshold,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            **self.metrics.to_dict()
+        }
+
+
+# プロセス内で共有するインスタンス（財務チャット用）
+financial_chat_cache = SemanticCache()
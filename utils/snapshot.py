@@ -0,0 +1,37 @@
+# utils/snapshot.py
+"""
+読み取り専用のスナップショット
+
+キャッシュしたJSONデータを呼び出し側に変更されないよう、dictは MappingProxyType、
+listは tuple に変換して保持する。変換はキャッシュに格納するときの1回だけで、
+読み取りのたびにディープコピーする必要がなくなる。
+"""
+from types import MappingProxyType
+from typing import Any
+
+
+def freeze(obj: Any) -> Any:
+    """JSON互換のデータを読み取り専用の構造に変換"""
+    if isinstance(obj, MappingProxyType):
+        return obj
+    if isinstance(obj, dict):
+        return MappingProxyType({key: freeze(value) for key, value in obj.items()})
+    if isinstance(obj, (list, tuple)):
+        return tuple(freeze(value) for value in obj)
+    return obj
+
+
+def thaw(obj: Any) -> Any:
+    """読み取り専用の構造を変更可能なdict / listに戻す"""
+    if isinstance(obj, (MappingProxyType, dict)):
+        return {key: thaw(value) for key, value in obj.items()}
+    if isinstance(obj, (tuple, list)):
+        return [thaw(value) for value in obj]
+    return obj
+
+
+def json_default(obj: Any) -> Any:
+    """json.dumpsのdefault引数用（スナップショットをそのままシリアライズできるようにする）"""
+    if isinstance(obj, MappingProxyType):
+        return dict(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
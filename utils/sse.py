@@ -0,0 +1,85 @@
+# utils/sse.py
+"""
+Server-Sent Events のフレームエンコーダー
+
+- 日本語を \\uXXXX にエスケープせず、UTF-8のまま送る（1文字6バイト → 3バイト）
+- フレームの固定部分（"id: " や "event: error\\ndata: " など）は事前にバイト列として用意し、
+  トークンごとにdictを組み立て直さない
+- イベントID（再接続時の Last-Event-ID 用）と名前付きイベント（text / error / done）に対応
+
+フロントエンドは "data: " 行のJSONだけを読むため、data の形式（{"text": ...} /
+{"error": ...} / {"complete": true}）は従来のまま変えない。回答を最初から生成し直す場合は
+{"restart": true} を送り、フロントエンドは表示中の回答を消す。
+"""
+import os
+from typing import Optional
+
+from . import json_codec
+
+# フレームにイベントIDを付けるか（1〜3文字の差分ごとに送る場合は "id: N" 行の方が大きくなるため既定では付けない）
+SSE_EVENT_IDS = os.getenv("SSE_EVENT_IDS", "false").lower() == "true"
+# テキストのフレームにも "event: text" を付けるか
+# （付けない場合はSSEの既定のmessageイベントになり、トークンごとに12バイト節約できる）
+SSE_NAMED_TEXT_EVENTS = os.getenv("SSE_NAMED_TEXT_EVENTS", "false").lower() == "true"
+
+EVENT_TEXT = "text"
+EVENT_ERROR = "error"
+EVENT_DONE = "done"
+EVENT_RESTART = "restart"
+
+_DATA_PREFIX = b"data: "
+_FRAME_END = b"\n\n"
+_TEXT_OPEN = b'{"text":'
+_ERROR_OPEN = b'{"error":'
+_JSON_CLOSE = b"}"
+_DONE_PAYLOAD = b'{"complete":true}'
+_RESTART_PAYLOAD = b'{"restart":true}'
+
+
+def _event_prefix(event: Optional[str]) -> bytes:
+    if event is None:
+        return _DATA_PREFIX
+    return b"event: " + event.encode("utf-8") + b"\n" + _DATA_PREFIX
+
+
+class SSEEncoder:
+    """1本のストリーム用のSSEフレームエンコーダー（イベントIDはストリームごとに連番）"""
+
+    def __init__(
+        self,
+        event_ids: bool = SSE_EVENT_IDS,
+        named_text_events: bool = SSE_NAMED_TEXT_EVENTS,
+        start_id: int = 0
+    ):
+        self.event_ids = event_ids
+        self.last_id = start_id
+        self._text_prefix = _event_prefix(EVENT_TEXT if named_text_events else None)
+        self._error_prefix = _event_prefix(EVENT_ERROR)
+        self._done_prefix = _event_prefix(EVENT_DONE)
+        self._restart_prefix = _event_prefix(EVENT_RESTART)
+
+    def _frame(self, prefix: bytes, payload: bytes) -> bytes:
+        if not self.event_ids:
+            return b"".join((prefix, payload, _FRAME_END))
+        self.last_id += 1
+        return b"".join((b"id: %d\n" % self.last_id, prefix, payload, _FRAME_END))
+
+    def text(self, text: str) -> bytes:
+        """テキストの差分を送るフレーム"""
+        return self._frame(self._text_prefix, _TEXT_OPEN + json_codec.dumps_bytes(text) + _JSON_CLOSE)
+
+    def error(self, message: str) -> bytes:
+        """エラーを通知するフレーム"""
+        return self._frame(self._error_prefix, _ERROR_OPEN + json_codec.dumps_bytes(str(message)) + _JSON_CLOSE)
+
+    def done(self) -> bytes:
+        """ストリームの完了を通知するフレーム"""
+        return self._frame(self._done_prefix, _DONE_PAYLOAD)
+
+    def restart(self) -> bytes:
+        """送信済みのテキストを破棄させるフレーム（回答を最初から生成し直す場合）"""
+        return self._frame(self._restart_prefix, _RESTART_PAYLOAD)
+
+    def event(self, event: str, data: object) -> bytes:
+        """任意の名前付きイベントのフレーム（dataはJSONにシリアライズする）"""
+        return self._frame(_event_prefix(event), json_codec.dumps_bytes(data))
@@ -0,0 +1,70 @@
+# utils/stream_coalescer.py
+"""
+ストリーミングのテキスト差分をまとめて送るためのステージ
+
+OpenRouterの差分は1文字ずつのことが多く、そのままSSEにすると1回答あたり数千回の
+小さな書き込みになる。最初のトークンはすぐに送り（TTFTは変わらない）、以降は
+一定時間（N ms）または一定バイト数（M バイト）ごとにまとめて1フレームにする。
+
+送信の判定は差分が届いたときに行い、タイマーや読み込み用のタスクは作らない
+（差分ごとのコストを増やさないため）。上流が止まっている間は、直前のinterval_ms分の
+テキストだけが次の差分か終了まで保留される。
+"""
+import os
+import time
+from contextlib import aclosing
+from typing import Any, AsyncIterator
+
+# まとめる時間の上限（ミリ秒、0ならまとめない）
+COALESCE_INTERVAL_MS = float(os.getenv("SSE_COALESCE_INTERVAL_MS", 40))
+# まとめるバイト数の上限（UTF-8換算）
+COALESCE_MAX_BYTES = int(os.getenv("SSE_COALESCE_MAX_BYTES", 2048))
+
+
+async def coalesce_text(
+    stream: AsyncIterator[Any],
+    interval_ms: float = COALESCE_INTERVAL_MS,
+    max_bytes: int = COALESCE_MAX_BYTES
+) -> AsyncIterator[Any]:
+    """
+    テキストの差分をまとめて返す非同期ジェネレータ
+
+    文字列以外の要素（エラーのdictなど）は、それまでのテキストを送ってからそのまま返す。
+    """
+    # 途中で閉じられた場合も上流のストリームを閉じる
+    async with aclosing(stream):
+        if interval_ms <= 0:
+            async for item in stream:
+                yield item
+            return
+
+        interval = interval_ms / 1000
+        buffer = []
+        buffered_bytes = 0
+        window_start = 0.0
+        first = True
+        async for item in stream:
+            if not isinstance(item, str):
+                if buffer:
+                    yield "".join(buffer)
+                    buffer.clear()
+                    buffered_bytes = 0
+                yield item
+                continue
+            if first:
+                # 最初のトークンはすぐに送る
+                first = False
+                yield item
+                continue
+
+            now = time.monotonic()
+            if not buffer:
+                window_start = now
+            buffer.append(item)
+            buffered_bytes += len(item.encode("utf-8"))
+            if buffered_bytes >= max_bytes or now - window_start >= interval:
+                yield "".join(buffer)
+                buffer.clear()
+                buffered_bytes = 0
+        if buffer:
+            yield "".join(buffer)
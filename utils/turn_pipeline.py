@@ -0,0 +1,246 @@
+# utils/turn_pipeline.py
+"""
+ターンの分類・要約とスレッドへの記録をレスポンスの外で実行する
+
+以前はユーザー発話の分類と要約を別々のLLM呼び出しで順番に待ってから
+回答のストリーミングを始め、回答の後にも同じ2回のLLM呼び出しとファイル書き込みを待っていた。
+パイプラインモード（ANNOTATION_PIPELINE=true）では待たずにストリーミングを始め、
+回答が揃ったらユーザー発話と回答をまとめて分類・要約するジョブ（finish_turn）を
+turn_queueに入れて、すぐに完了をクライアントに返す。
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Set
+
+from .intent_classifier import get_intent_classifier
+from .openrouter_stream import ANNOTATION_CONTEXT_TURNS
+from .turn_queue import JobQueue, turn_queue
+
+# 分類・要約の完了を待たずにストリーミングを始めるか
+ANNOTATION_PIPELINE = os.getenv("ANNOTATION_PIPELINE", "true").lower() == "true"
+
+FINISH_TURN_JOB = "finish_turn"
+
+# リクエストから切り離して実行中のタスク（参照を保持してGCされないようにする）
+_pending_turns: Set[asyncio.Task] = set()
+
+
+def _on_spawned_done(task: asyncio.Task) -> None:
+    _pending_turns.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logging.error(f"Failed to submit turn job: {task.exception()}")
+
+
+def _spawn(coro) -> None:
+    task = asyncio.ensure_future(coro)
+    _pending_turns.add(task)
+    task.add_done_callback(_on_spawned_done)
+
+
+def _fallback(utterance: Dict[str, str], label: Optional[str] = None) -> Dict[str, Any]:
+    """分類・要約に失敗した場合の値（要約の代わりに発話そのものを使う）"""
+    return {"type": label, "summary": utterance["content"]}
+
+
+def local_labels(utterances: List[Dict[str, str]]) -> List[Optional[str]]:
+    """ローカルの分類器でラベルを判定する（確信度が低い発話はNoneにしてLLMで分類する）"""
+    classifier = get_intent_classifier()
+    if classifier is None:
+        return [None] * len(utterances)
+    return [classifier.classify(utterance["content"])[0] for utterance in utterances]
+
+
+async def submit_finish_turn(
+    user_id: Any,
+    threads: List[Dict[str, str]],
+    assistant_message: Optional[Dict[str, Any]] = None,
+    user_thread: Optional[Dict[str, Any]] = None,
+    user_input: Optional[str] = None,
+    user_timestamp: Optional[str] = None,
+    queue: JobQueue = turn_queue
+) -> str:
+    """
+    ターンの残りの処理（分類・要約、スレッドへの記録、update_user_messages）をキューに入れる
+
+    user_threadが記録済みならアシスタントの回答だけを、そうでなければuser_inputも分類する。
+    assistant_messageがない場合（回答が揃わなかった場合）はユーザー発話だけを記録する。
+
+    同じユーザーのジョブは投入順に実行される（スレッドの順番を保つため）。
+    """
+    return await queue.submit(FINISH_TURN_JOB, {
+        "user_id": user_id,
+        "threads": threads[-ANNOTATION_CONTEXT_TURNS:] if ANNOTATION_CONTEXT_TURNS > 0 else [],
+        "user_thread": user_thread,
+        "user_input": user_input,
+        "user_timestamp": user_timestamp or datetime.now().isoformat(),
+        "assistant_message": assistant_message
+    }, key=str(user_id))
+
+
+class TurnFinisher:
+    """finish_turnジョブの処理（turn_queueのワーカーで実行される）"""
+
+    def __init__(self, chatroom_manager: Any, client: Any):
+        self.chatroom_manager = chatroom_manager
+        self.client = client
+
+    async def __call__(self, payload: Dict[str, Any], last_attempt: bool) -> None:
+        user_id = payload["user_id"]
+        assistant_message = payload["assistant_message"]
+        utterances = []
+        if payload["user_thread"] is None:
+            utterances.append({"role": "user", "content": payload["user_input"]})
+        if assistant_message is not None:
+            utterances.append({"role": "assistant", "content": assistant_message["content"]})
+
+        # 終わった処理は payload に記録し、リトライ時には繰り返さない
+        if payload.get("annotations") is None:
+            labels = payload.setdefault("labels", local_labels(utterances))
+            try:
+                annotations = await self.client.annotate_turns(utterances, payload["threads"], labels=labels) if utterances else []
+            except Exception as e:
+                if not last_attempt:
+                    raise
+                logging.warning(f"Turn annotation failed for {user_id}: {e}")
+                annotations = [_fallback(utterance, label) for utterance, label in zip(utterances, labels)]
+            payload["annotations"] = annotations
+        annotations = payload["annotations"]
+
+        if payload["user_thread"] is None:
+            print("Type response:", annotations[0]["type"])
+            print("Content response:", annotations[0]["summary"])
+            user_thread = {
+                "role": "user",
+                "type": annotations[0]["type"],
+                "content": annotations[0]["summary"],
+                "user_id": user_id,
+                "timestamp": payload["user_timestamp"]
+            }
+            await self.chatroom_manager.add_thread(user_id, user_thread)
+            payload["user_thread"] = user_thread
+
+        if assistant_message is not None:
+            if payload.get("assistant_thread") is None:
+                assistant_thread = {
+                    "role": "assistant",
+                    "type": annotations[-1]["type"],
+                    "content": annotations[-1]["summary"],
+                    "user_id": user_id,
+                    "id": assistant_message["id"],
+                    "timestamp": assistant_message["timestamp"]
+                }
+                await self.chatroom_manager.add_thread(user_id, assistant_thread)
+                payload["assistant_thread"] = assistant_thread
+
+            message_pair = {
+                "user": payload["user_thread"],
+                "assistant": payload["assistant_thread"],
+                "timestamp": datetime.now().isoformat()
+            }
+            await self.chatroom_manager.update_user_messages(user_id, message_pair)
+        # このターンの書き込みをまとめてフラッシュ
+        self.chatroom_manager.end_turn(user_id)
+
+
+def register_turn_finisher(chatroom_manager: Any, client: Any, queue: JobQueue = turn_queue) -> None:
+    """finish_turnジョブの処理を登録（アプリケーションで1回呼び出す）"""
+    queue.register(FINISH_TURN_JOB, TurnFinisher(chatroom_manager, client))
+
+
+class UserTurn:
+    """
+    1ターンのユーザー発話の分類・要約と、ターンの残りの処理の投入を管理する
+
+    - strict=False（パイプラインモード）: ストリーミング前には何もしない。回答が揃ったら
+      finish() でユーザー発話と回答をまとめて分類するジョブをキューに入れる。
+    - strict=True: すぐにユーザー発話を分類してスレッドに記録する（失敗した場合は例外を送出する）。
+      finish() では回答だけを分類するジョブをキューに入れる。
+
+    使用例:
+        user_turn = UserTurn(chatroom_manager, user_id, user_input, client, threads)
+        try:
+            ...  # ストリーミング
+            await user_turn.finish(assistant_message)
+            yield sse.done()
+        finally:
+            user_turn.release()  # 切断・エラー時もユーザー発話は記録する
+    """
+
+    def __init__(
+        self,
+        chatroom_manager: Any,
+        user_id: Any,
+        user_input: str,
+        client: Any,
+        threads: List[Dict[str, str]],
+        strict: bool = not ANNOTATION_PIPELINE,
+        queue: JobQueue = turn_queue
+    ):
+        self.chatroom_manager = chatroom_manager
+        self.user_id = user_id
+        self.user_input = user_input
+        self.client = client
+        self.threads = threads
+        self.strict = strict
+        self.queue = queue
+        self.timestamp = datetime.now().isoformat()
+        self.thread: Optional[Dict[str, Any]] = None
+        self._submitted = False
+        self.task: Optional[asyncio.Task] = None
+        if strict:
+            # クライアントが切断してもスレッドへの記録は続ける
+            self.task = asyncio.ensure_future(self._annotate())
+            _pending_turns.add(self.task)
+            self.task.add_done_callback(_pending_turns.discard)
+
+    async def _annotate(self) -> Dict[str, Any]:
+        utterance = {"role": "user", "content": self.user_input}
+        annotation = await self.client.annotate_turn(utterance, self.threads, label=local_labels([utterance])[0])
+        print("Type response:", annotation["type"])
+        print("Content response:", annotation["summary"])
+        self.thread = {
+            "role": "user",
+            "type": annotation["type"],
+            "content": annotation["summary"],
+            "user_id": self.user_id,
+            "timestamp": self.timestamp
+        }
+        await self.chatroom_manager.add_thread(self.user_id, self.thread)
+        return self.thread
+
+    async def _submit(self, assistant_message: Optional[Dict[str, Any]]) -> str:
+        self._submitted = True
+        return await submit_finish_turn(
+            self.user_id,
+            self.threads,
+            assistant_message=assistant_message,
+            user_thread=self.thread,
+            user_input=None if self.thread is not None else self.user_input,
+            user_timestamp=self.timestamp,
+            queue=self.queue
+        )
+
+    async def finish(self, assistant_message: Dict[str, Any]) -> str:
+        """回答が揃ったターンの残りの処理をキューに入れる（ジャーナルへの記録まで待つ）"""
+        if self.strict:
+            await self
+        return await self._submit(assistant_message)
+
+    def release(self) -> None:
+        """
+        finish() されなかった場合にユーザー発話だけを記録するジョブを投入する
+        （strictモードではすでに記録済み）。2回目以降の呼び出しは無視する
+        """
+        if self._submitted or self.strict:
+            return
+        self._submitted = True
+        # キャンセル中のリクエストから呼ばれることがあるため、別タスクで投入する
+        _spawn(self._submit(None))
+
+    def __await__(self):
+        if self.task is None:
+            raise RuntimeError("パイプラインモードのユーザー発話はfinish()で記録されます")
+        # 待っている側がキャンセルされても記録のタスクは止めない
+        return asyncio.shield(self.task).__await__()
@@ -0,0 +1,356 @@
+# utils/turn_queue.py
+"""
+レスポンスを閉じた後に実行するジョブのキュー（プロセス内・ジャーナル付き）
+
+回答のストリーミングが終わった後の分類・要約やスレッドへの書き込みをレスポンスの中で待つと、
+その間ブラウザの接続とワーカーのリクエストが解放されない。ジョブをキューに入れて
+すぐに完了を返し、一定数のワーカーがリトライ付きで順に実行する。
+
+ジョブはキューに入れる前にディスクのジャーナル（JSONL）に追記し、完了したら ack を追記する。
+プロセスが途中で終了しても、次の起動時に ack のないジョブを再実行する（at-least-once）。
+gunicornのマルチワーカーでは、各プロセスがファイルロックでジャーナルのスロットを1つ確保する。
+"""
+import asyncio
+import logging
+import os
+import time
+import uuid
+from collections import deque
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from .file_operations import atomic_write_text
+from .jsonl_log import _encode_line, append_jsonl, read_jsonl
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+TURN_QUEUE_WORKERS = int(os.getenv("TURN_QUEUE_WORKERS", 4))  # 同時に実行するジョブ数
+TURN_QUEUE_MAX_SIZE = int(os.getenv("TURN_QUEUE_MAX_SIZE", 1000))  # 未実行のジョブの上限（超えると投入側が待つ）
+TURN_JOB_MAX_ATTEMPTS = int(os.getenv("TURN_JOB_MAX_ATTEMPTS", 4))  # 1ジョブあたりの最大実行回数
+TURN_JOB_RETRY_BASE = float(os.getenv("TURN_JOB_RETRY_BASE", 0.5))  # リトライ間隔の初期値（秒、毎回2倍）
+TURN_QUEUE_DIR = os.getenv("TURN_QUEUE_DIR", os.path.join("data", ".turn_queue"))
+TURN_QUEUE_SLOTS = int(os.getenv("TURN_QUEUE_SLOTS", 64))  # ジャーナルのスロット数（ワーカープロセス数以上）
+TURN_QUEUE_SHUTDOWN_TIMEOUT = float(os.getenv("TURN_QUEUE_SHUTDOWN_TIMEOUT", 10))
+# キューが空になったときにジャーナルを空にする行数の目安
+JOURNAL_COMPACT_LINES = 1000
+
+# ジョブの処理関数: handler(payload, last_attempt)
+# payloadは実行中に書き換えてよい（途中まで終わった処理をリトライ時に飛ばすため）
+JobHandler = Callable[[Dict[str, Any], bool], Awaitable[Any]]
+
+
+class JobQueue:
+    """ジャーナル付きのジョブキューとワーカープール"""
+
+    def __init__(
+        self,
+        journal_dir: str = TURN_QUEUE_DIR,
+        workers: int = TURN_QUEUE_WORKERS,
+        max_size: int = TURN_QUEUE_MAX_SIZE,
+        max_attempts: int = TURN_JOB_MAX_ATTEMPTS,
+        retry_base: float = TURN_JOB_RETRY_BASE,
+        slots: int = TURN_QUEUE_SLOTS
+    ):
+        self.journal_dir = journal_dir
+        self.workers = max(1, workers)
+        self.max_size = max_size
+        self.max_attempts = max(1, max_attempts)
+        self.retry_base = retry_base
+        self.slots = max(1, slots)
+        self._handlers: Dict[str, JobHandler] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker_tasks: List[asyncio.Task] = []
+        self._inflight: Set[str] = set()
+        # 同じkeyのジョブは投入順に1つずつ実行する（key -> 順番待ちのジョブ）
+        self._key_waiting: Dict[str, deque] = {}
+        self._slot_fd: Optional[int] = None
+        self.journal_path: Optional[str] = None
+        self._journal_lines = 0
+        # ジャーナルへの書き込みはまとめて1回の追記にする（記録の順番も保たれる）
+        self._journal_buffer: List[Tuple[Dict[str, Any], asyncio.Future]] = []
+        self._journal_writer: Optional[asyncio.Task] = None
+
+        # メトリクス
+        self.submitted = 0
+        self.completed = 0
+        self.retried = 0
+        self.failed = 0
+        self.recovered = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def register(self, kind: str, handler: JobHandler) -> None:
+        """ジョブの種類ごとの処理関数を登録"""
+        self._handlers[kind] = handler
+
+    @property
+    def running(self) -> bool:
+        return self._queue is not None
+
+    # ---- ジャーナル ----
+
+    def _slot_path(self, slot: int, suffix: str) -> str:
+        return os.path.join(self.journal_dir, f"journal-{slot}.{suffix}")
+
+    def _try_lock_slot(self, slot: int) -> Optional[int]:
+        """スロットのロックを取得する（他のプロセスが使っていればNone）"""
+        fd = os.open(self._slot_path(slot, "lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        if fcntl is None:
+            return fd
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        return fd
+
+    @staticmethod
+    def _unlock(fd: int) -> None:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    @staticmethod
+    def _pending_jobs(records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """ack のないジョブを投入順に返す"""
+        jobs: Dict[str, Dict[str, Any]] = {}
+        for record in records:
+            if record.get("op") == "put":
+                jobs[record["id"]] = record
+            elif record.get("op") == "ack":
+                jobs.pop(record.get("id"), None)
+        return list(jobs.values())
+
+    async def _recover(self) -> List[Dict[str, Any]]:
+        """
+        自分のスロットと、どのプロセスも使っていないスロットの未完了ジョブを読み込む
+
+        ジャーナルは未完了のジョブだけを残して書き直す。
+        """
+        os.makedirs(self.journal_dir, exist_ok=True)
+        own_slot = None
+        for slot in range(self.slots if fcntl is not None else 1):
+            fd = self._try_lock_slot(slot)
+            if fd is not None:
+                own_slot, self._slot_fd = slot, fd
+                break
+        if own_slot is None:
+            raise RuntimeError(f"ジョブキューの空きスロットがありません（TURN_QUEUE_SLOTS={self.slots}）")
+        self.journal_path = self._slot_path(own_slot, "jsonl")
+
+        pending = self._pending_jobs(await read_jsonl(self.journal_path))
+        adopted: List[str] = []
+        # 終了したプロセスのスロットに残ったジョブも引き継ぐ
+        for slot in range(self.slots if fcntl is not None else 0):
+            path = self._slot_path(slot, "jsonl")
+            if slot == own_slot or not os.path.exists(path) or os.path.getsize(path) == 0:
+                continue
+            fd = self._try_lock_slot(slot)
+            if fd is None:
+                continue
+            try:
+                pending.extend(self._pending_jobs(await read_jsonl(path)))
+                adopted.append(path)
+            except Exception:
+                self._unlock(fd)
+                raise
+            # 引き継いだジョブを自分のジャーナルに書いてから元のジャーナルを空にする
+            try:
+                await self._rewrite_journal(pending)
+                await asyncio.to_thread(atomic_write_text, path, b"", False)
+            finally:
+                self._unlock(fd)
+
+        await self._rewrite_journal(pending)
+        if adopted:
+            logging.info(f"Adopted turn jobs from {adopted}")
+        return pending
+
+    async def _rewrite_journal(self, jobs: List[Dict[str, Any]]) -> None:
+        payload = b"".join(_encode_line(job) for job in jobs)
+        await asyncio.to_thread(atomic_write_text, self.journal_path, payload, False)
+        self._journal_lines = len(jobs)
+
+    def _journal(self, record: Dict[str, Any]) -> asyncio.Future:
+        """ジャーナルに記録を追加する（書き込みが終わると完了するFutureを返す）"""
+        future = asyncio.get_running_loop().create_future()
+        self._journal_buffer.append((record, future))
+        if self._journal_writer is None or self._journal_writer.done():
+            self._journal_writer = asyncio.ensure_future(self._write_journal())
+        return future
+
+    async def _write_journal(self) -> None:
+        while self._journal_buffer:
+            batch, self._journal_buffer = self._journal_buffer, []
+            try:
+                await append_jsonl(self.journal_path, [record for record, _ in batch])
+                self._journal_lines += len(batch)
+            except Exception as e:
+                logging.error(f"Failed to write turn queue journal: {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for _, future in batch:
+                if not future.done():
+                    future.set_result(None)
+            # 実行中のジョブがなければジャーナルを空にする（書き直し中に届いた記録はその後に追記する）
+            if not self._inflight and not self._journal_buffer and self._journal_lines >= JOURNAL_COMPACT_LINES:
+                await self._rewrite_journal([])
+
+    # ---- キュー ----
+
+    async def start(self) -> None:
+        """ワーカーを起動し、前回の未完了ジョブを再投入する（アプリケーション起動時に呼び出す）"""
+        if self.running:
+            return
+        pending = await self._recover()
+        self._queue = asyncio.Queue(maxsize=max(self.max_size, len(pending)))
+        for job in pending:
+            self._inflight.add(job["id"])
+            self._queue.put_nowait(job)
+        self.recovered += len(pending)
+        if pending:
+            logging.info(f"Recovered {len(pending)} turn jobs from {self.journal_path}")
+        self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def submit(self, kind: str, payload: Dict[str, Any], key: Optional[str] = None) -> str:
+        """
+        ジョブをジャーナルに記録してキューに入れる（実行の完了は待たない）
+
+        keyが同じジョブはリトライ中も含めて投入順に実行する（ユーザーごとのターンなど）。
+        キューが上限に達している場合は空きが出るまで待つ。
+        """
+        if kind not in self._handlers:
+            raise ValueError(f"未登録のジョブです: {kind}")
+        if not self.running:
+            raise RuntimeError("ジョブキューが起動していません")
+        job = {
+            "op": "put",
+            "id": str(uuid.uuid4()),
+            "kind": kind,
+            "key": key,
+            "payload": payload,
+            "submitted_at": datetime.now().isoformat()
+        }
+        self._inflight.add(job["id"])
+        try:
+            await self._journal(job)
+        except BaseException:
+            self._inflight.discard(job["id"])
+            raise
+        await self._queue.put(job)
+        self.submitted += 1
+        return job["id"]
+
+    async def _worker(self) -> None:
+        while True:
+            job = await self._queue.get()
+            key = job.get("key")
+            if key is None:
+                try:
+                    await self._run(job)
+                finally:
+                    self._queue.task_done()
+                continue
+            if key in self._key_waiting:
+                # 同じkeyのジョブを実行中のワーカーが続けて実行する
+                self._key_waiting[key].append(job)
+                continue
+            waiting = self._key_waiting[key] = deque([job])
+            try:
+                while waiting:
+                    await self._run(waiting[0])
+                    waiting.popleft()
+                    self._queue.task_done()
+            finally:
+                del self._key_waiting[key]
+
+    async def _run(self, job: Dict[str, Any]) -> None:
+        handler = self._handlers.get(job["kind"])
+        start = time.perf_counter()
+        if handler is None:
+            logging.error(f"No handler for turn job {job['id']} ({job['kind']})")
+            self.failed += 1
+        for attempt in range(1, self.max_attempts + 1 if handler is not None else 1):
+            try:
+                await handler(job["payload"], attempt == self.max_attempts)
+                self.completed += 1
+                break
+            except asyncio.CancelledError:
+                # シャットダウン中: ackせずに次の起動時に再実行する
+                raise
+            except Exception as e:
+                if attempt == self.max_attempts:
+                    logging.error(f"Turn job {job['id']} ({job['kind']}) failed after {attempt} attempts: {e}")
+                    self.failed += 1
+                    break
+                self.retried += 1
+                delay = self.retry_base * (2 ** (attempt - 1))
+                logging.warning(f"Turn job {job['id']} ({job['kind']}) failed, retrying in {delay:.1f}s: {e}")
+                await asyncio.sleep(delay)
+
+        elapsed = time.perf_counter() - start
+        self.total_latency += elapsed
+        self.max_latency = max(self.max_latency, elapsed)
+        # 失敗したジョブも ack する（再起動のたびに同じ失敗を繰り返さないため）
+        self._inflight.discard(job["id"])
+        try:
+            await self._journal({"op": "ack", "id": job["id"]})
+        except Exception:
+            pass
+
+    async def join(self) -> None:
+        """キューに入っているジョブがすべて終わるまで待つ"""
+        if self._queue is not None:
+            await self._queue.join()
+
+    async def shutdown(self, timeout: float = TURN_QUEUE_SHUTDOWN_TIMEOUT) -> None:
+        """
+        残りのジョブを一定時間まで実行してからワーカーを停止する（アプリケーション終了時に呼び出す）
+
+        終わらなかったジョブはジャーナルに残り、次の起動時に再実行される。
+        """
+        if not self.running:
+            return
+        try:
+            await asyncio.wait_for(self.join(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"{self._queue.qsize() + len(self._inflight)} turn jobs left in the journal")
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+        if self._journal_writer is not None:
+            await asyncio.gather(self._journal_writer, return_exceptions=True)
+        self._queue = None
+        self._inflight.clear()
+        if self._slot_fd is not None:
+            self._unlock(self._slot_fd)
+            self._slot_fd = None
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """キューの長さや失敗数などのメトリクスを取得"""
+        finished = self.completed + self.failed
+        return {
+            "running": self.running,
+            "queued": (self._queue.qsize() if self._queue is not None else 0)
+                + sum(len(waiting) for waiting in self._key_waiting.values()),
+            "inflight": len(self._inflight),
+            "workers": self.workers,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "retried": self.retried,
+            "failed": self.failed,
+            "recovered": self.recovered,
+            "latency_seconds_avg": round(self.total_latency / finished, 6) if finished else 0.0,
+            "latency_seconds_max": round(self.max_latency, 6),
+            "journal": self.journal_path
+        }
+
+
+# プロセス内で共有するジョブキュー
+turn_queue = JobQueue()
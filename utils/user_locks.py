@@ -0,0 +1,168 @@
+# utils/user_locks.py
+"""
+ユーザー単位のロック管理
+
+同じユーザーの load → 変更 → save を直列化する。グローバルなロックは使わず、
+ユーザーごとの asyncio.Lock をシャードに分けて保持し、使われていないロックは破棄する。
+マルチワーカー（gunicorn）ではファイルロックを併用してプロセス間でも直列化できる。
+"""
+import asyncio
+import os
+import time
+import zlib
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+LOCK_SHARDS = int(os.getenv("USER_LOCK_SHARDS", 16))
+LOCK_IDLE_TTL = float(os.getenv("USER_LOCK_IDLE_TTL", 300))  # 未使用のロックを破棄するまでの秒数
+CROSS_PROCESS_LOCKS = os.getenv("USER_LOCK_CROSS_PROCESS", "false").lower() == "true"
+LOCK_DIR = os.getenv("USER_LOCK_DIR", os.path.join("data", ".locks"))
+
+
+class _LockEntry:
+    __slots__ = ("lock", "refs", "last_used")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.refs = 0
+        self.last_used = time.monotonic()
+
+
+class _FileLock:
+    """fcntl.flockによるプロセス間ロック"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fd: Optional[int] = None
+
+    def acquire(self) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        except BaseException:
+            os.close(fd)
+            raise
+        self._fd = fd
+
+    def release(self) -> None:
+        if self._fd is None:
+            return
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        finally:
+            os.close(self._fd)
+            self._fd = None
+
+
+class UserLockManager:
+    """ユーザーごとのロックをシャード単位で管理するクラス"""
+
+    def __init__(
+        self,
+        shards: int = LOCK_SHARDS,
+        idle_ttl: float = LOCK_IDLE_TTL,
+        cross_process: bool = CROSS_PROCESS_LOCKS,
+        lock_dir: str = LOCK_DIR
+    ):
+        self.idle_ttl = idle_ttl
+        self.cross_process = cross_process and fcntl is not None
+        self.lock_dir = lock_dir
+        self._shards = [dict() for _ in range(max(1, shards))]
+        self._releases = [0] * len(self._shards)
+
+        # メトリクス
+        self.acquisitions = 0
+        self.contended = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.evicted = 0
+
+    def _shard_index(self, user_id: str) -> int:
+        return zlib.crc32(str(user_id).encode("utf-8")) % len(self._shards)
+
+    @asynccontextmanager
+    async def acquire(self, user_id: str) -> AsyncIterator[None]:
+        """
+        ユーザーのロックを取得する
+
+        使用例:
+            async with user_locks.acquire(user_id):
+                ...  # load → 変更 → save
+        """
+        index = self._shard_index(user_id)
+        shard: Dict[str, _LockEntry] = self._shards[index]
+        entry = shard.get(user_id)
+        if entry is None:
+            entry = shard[user_id] = _LockEntry()
+        entry.refs += 1
+
+        start = time.perf_counter()
+        file_lock = None
+        try:
+            if entry.lock.locked():
+                self.contended += 1
+            await entry.lock.acquire()
+            try:
+                if self.cross_process:
+                    file_lock = _FileLock(os.path.join(self.lock_dir, f"{user_id}.lock"))
+                    await asyncio.to_thread(file_lock.acquire)
+            except BaseException:
+                entry.lock.release()
+                raise
+        except BaseException:
+            entry.refs -= 1
+            raise
+
+        self._record_wait(time.perf_counter() - start)
+        try:
+            yield
+        finally:
+            if file_lock is not None:
+                file_lock.release()
+            entry.lock.release()
+            entry.refs -= 1
+            entry.last_used = time.monotonic()
+            self._releases[index] += 1
+            # 解放64回ごとにシャード内の未使用ロックを掃除する
+            if self._releases[index] % 64 == 0:
+                self._evict_idle(shard)
+
+    def _record_wait(self, wait: float) -> None:
+        self.acquisitions += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def _evict_idle(self, shard: Dict[str, _LockEntry]) -> None:
+        now = time.monotonic()
+        for user_id, entry in list(shard.items()):
+            if entry.refs == 0 and not entry.lock.locked() and now - entry.last_used >= self.idle_ttl:
+                del shard[user_id]
+                self.evicted += 1
+
+    def evict_idle(self) -> None:
+        """すべてのシャードから未使用のロックを破棄する"""
+        for shard in self._shards:
+            self._evict_idle(shard)
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """ロック待ち時間などのメトリクスを取得"""
+        return {
+            "acquisitions": self.acquisitions,
+            "contended": self.contended,
+            "wait_seconds_total": round(self.total_wait, 6),
+            "wait_seconds_avg": round(self.total_wait / self.acquisitions, 6) if self.acquisitions else 0.0,
+            "wait_seconds_max": round(self.max_wait, 6),
+            "active_locks": sum(len(shard) for shard in self._shards),
+            "evicted": self.evicted,
+            "cross_process": self.cross_process
+        }
+
+
+# プロセス内で共有するロックマネージャー
+user_locks = UserLockManager()
@@ -1,6 +1,6 @@
 # wsgi.py
 from fastapi import FastAPI, Request, HTTPException, Depends, Response, BackgroundTasks, status, Form 
-from fastapi.responses import JSONResponse, HTMLResponse, StreamingResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, StreamingResponse, RedirectResponse
 from fastapi.staticfiles import StaticFiles 
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.middleware.sessions import SessionMiddleware
@@ -9,10 +9,9 @@ from sqlalchemy.orm import sessionmaker
 from sqlalchemy.future import select
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
-import json, uuid, traceback, os, anthropic, asyncio
+import uuid, traceback, os, asyncio
 from colorama import Fore, Style
 from contextlib import asynccontextmanager
-from openai import AsyncOpenAI
 from typing import Dict, List, Any, Optional
 
 # モジュールとクラスのインポート
@@ -28,15 +27,27 @@ from auth.auth_router import router as auth_router
 
 # 新しいモジュールのインポート
 from utils.file_operations import to_pretty_json
+from api.responses import CodecJSONResponse
+from utils.sse import SSEEncoder
+from utils.retry_logic import StreamRestart
+from utils.stream_coalescer import coalesce_text
+from utils.disconnect import DisconnectWatcher, partial_answer_saver
+from utils.turn_pipeline import ANNOTATION_PIPELINE, UserTurn, register_turn_finisher, submit_finish_turn
+from utils.turn_queue import turn_queue
+from utils.llm_clients import open_llm_clients, close_llm_clients
+from utils.model_router import model_scoreboard
+from utils.admission import set_admission_user
+from utils.response_cache import response_cache
 from utils.ai_stream_client import AIStreamClient
-from utils.chatroom_manager import ChatroomManager
+from utils.chatroom_manager import get_chatroom_manager
 from utils.openrouter_stream import AIOpenRouterStreamClient as OpenRouterStreamClient
-from tasks import generate_summary_task
+from tasks import summarize_after_flush
 
 from api.financial_routes import router as financial_router
 from html_rotuers import html_auth, html_mobility, html_financial, html_main
 from api.chat_router import router as chat_router
 from api.prompt_routes import router as prompt_router
+from api.admin_routes import router as admin_router
 
 # 環境変数の読み込み
 load_dotenv()
@@ -58,22 +69,14 @@ CORS_ALLOW_HEADERS = os.getenv("CORS_ALLOW_HEADERS", "Authorization,Content-Type
 # ディレクトリの作成
 os.makedirs(DATA_DIR, exist_ok=True)
 
-# APIクライアントの初期化
-anthropic_api_key = os.getenv("ANTHROPIC_API_KEY")
-openrouter_api_key = os.getenv("OPENROUTER_API_KEY")
-
-anthropic_client = anthropic.Anthropic(api_key=anthropic_api_key)
-openrouter_client = AsyncOpenAI(
-    base_url="https://openrouter.ai/api/v1",
-    api_key=openrouter_api_key
-)
-
-# AIストリーミングクライアントの初期化
-ai_stream_client = AIStreamClient(anthropic_client, openrouter_client)
+# AIストリーミングクライアントの初期化（Anthropic・OpenRouterへの接続はlifespanで作成する共有のプールを使う）
+ai_stream_client = AIStreamClient()
 openrouter_stream_client = OpenRouterStreamClient()
 
 # チャットルームマネージャーの初期化
-chatroom_manager = ChatroomManager(data_dir=DATA_DIR, max_rallies=MAX_RALLIES)
+chatroom_manager = get_chatroom_manager(data_dir=DATA_DIR, max_rallies=MAX_RALLIES)
+# ターンの分類・要約とスレッドへの記録（レスポンスを閉じた後に実行）
+register_turn_finisher(chatroom_manager, openrouter_stream_client)
 
 # データベース設定
 DATABASE_URL = os.getenv("DATABASE_URL").replace("postgresql://", "postgresql+asyncpg://")
@@ -89,11 +92,23 @@ async def lifespan(app: FastAPI):
             print("データベース接続成功")
     except Exception as e:
         print(f"データベース接続エラー: {e}")
+    await chatroom_manager.load_registry()
+    chatroom_manager.start()
+    # LLMへの接続はアプリケーション全体で1つのコネクションプールを共有する
+    app.state.llm_clients = await open_llm_clients()
+    await turn_queue.start()
     yield 
+    # 残りのターンのジョブを実行し、未フラッシュのチャットデータを書き込んでから終了
+    await turn_queue.shutdown()
+    await chatroom_manager.shutdown()
+    await close_llm_clients()
+    # 間隔をあけて保存しているスコアボードの最後の更新を書き出す
+    model_scoreboard.save(force=True)
+    response_cache.close()
     print("アプリケーションシャットダウン")
 
 # FastAPIアプリケーションの初期化
-app = FastAPI(lifespan=lifespan)
+app = FastAPI(lifespan=lifespan, default_response_class=CodecJSONResponse)
 app.add_middleware(
     SessionMiddleware, 
     secret_key=os.getenv("FLASK_SECRET_KEY")
@@ -115,6 +130,7 @@ app.include_router(html_financial.router)
 app.include_router(html_main.router)
 app.include_router(chat_router)
 app.include_router(prompt_router)
+app.include_router(admin_router)
 # データベース依存関数
 async def get_db():
     async with async_session() as session:
@@ -129,13 +145,13 @@ async def select_project(request: Request, db: AsyncSession = Depends(get_db)):
     print(f"Selected project ID: {project_id}")
 
     if not prompt_id or not project_id:
-        return JSONResponse(
+        return CodecJSONResponse(
             content={"success": False, "message": "プロンプトIDとプロジェクトIDが指定されていません"},
             status_code=400
         )
     request.session["selected_prompt_id"] = prompt_id
     redirect_url = f"/{project_id}"
-    return JSONResponse(
+    return CodecJSONResponse(
         content={
             "success": True, 
             "redirect_url": redirect_url,
@@ -155,6 +171,7 @@ async def chat(
 ):
     try:
         user_id = current_user.id
+        set_admission_user(user_id)
         data = await request.json()
         user_input = data.get("message", "")
         
@@ -584,16 +601,27 @@ async def chat(
             print(system_prompt)
             async def generate():
                 """ストリーミングレスポンスを生成する非同期ジェネレータ"""
+                sse = SSEEncoder()
+                disconnect = DisconnectWatcher(request, partial_answer_saver(chatroom_manager, user_id))
                 resp = ""
                 try:
-                    # AIからのストリーミングレスポンスを取得
-                    async for text in openrouter_stream_client.stream_response(user_input, system_prompt):
+                    # AIからのストリーミングレスポンスを取得（クライアントが切断したら上流のストリームも閉じる）
+                    async for text in disconnect.watch(coalesce_text(openrouter_stream_client.stream_response(user_input, system_prompt))):
                         if isinstance(text, dict) and "error" in text:
-                            yield f"data: {json.dumps(text)}\n\n"
+                            yield sse.error(text["error"])
                             return
+                        if isinstance(text, StreamRestart):
+                            # 途中で失敗して最初から生成し直す場合は、送信済みの回答を破棄させる
+                            resp = ""
+                            yield sse.restart()
+                            continue
                         resp += text
-                        yield f"data: {json.dumps({'text': text})}\n\n"
+                        yield sse.text(text)
                     
+                    if disconnect.disconnected:
+                        # 切断後は分類・保存のためのLLM呼び出しを行わない
+                        return
+
                     # アシスタントの応答を保存
                     assistant_text = resp
                     assistant_message = {
@@ -603,56 +631,21 @@ async def chat(
                         "id": str(uuid.uuid4()),
                         "timestamp": datetime.now().isoformat()
                     }
-                    try:
-                        assistant_type_response = await openrouter_client.chat.completions.create(
-                            model="openai/gpt-4.1",
-                            messages=[
-                                {"role": "system", "content": "Classify the intention of the next utterance using a one-word label."},
-                                {"role": "user", "content": assistant_text} 
-                            ],
-                            max_tokens=4000,
-                        )
-                    except Exception as e:
-                        print(f"Error: {e}")
-                        yield f"data: {json.dumps({'error': str(e)})}\n\n"
-                    try:
-                        assistant_content_response = await openrouter_client.chat.completions.create(
-                            model="openai/gpt-4.1",
-                            messages=[
-                                {"role": "system", "content": "Summarize the main point of the following utterance in one sentence, clearly identifying the subject and purpose."},
-                                {"role": "user", "content": assistant_text} 
-                            ],
-                            max_tokens=4000,
-                        )
-                    except Exception as e:
-                        print(f"Error: {e}")
-                        yield f"data: {json.dumps({'error': str(e)})}\n\n"
-                    assistant_thread = {
-                        "role": "assistant", 
-                        "type": assistant_type_response.choices[0].message.content,
-                        "content": assistant_content_response.choices[0].message.content, 
-                        "user_id": user_id,
-                        "id": str(uuid.uuid4()),
-                        "timestamp": datetime.now().isoformat()
-                    }
                     await chatroom_manager.add_message(user_id, assistant_message)
-                    await chatroom_manager.add_thread(user_id, assistant_thread)
-                    
-                    message_pair = {
-                        "user": user_thread,
-                        "assistant": assistant_thread,
-                        "timestamp": datetime.now().isoformat()
-                    }
-                    await chatroom_manager.update_user_messages(user_id, message_pair)
+                    chatroom_manager.end_turn(user_id)
+                    # 分類・要約とスレッドへの記録はレスポンスを閉じた後にキューで実行する
+                    await submit_finish_turn(user_id, [], assistant_message=assistant_message, user_thread=user_thread)
+                    yield sse.done()
                     
                     # 定期的にバックグラウンドでサマリーを更新
                     background_tasks.add_task(
-                        generate_summary_task, 
+                        summarize_after_flush,
+                        chatroom_manager,
                         await to_pretty_json(history),
                         user_id
                     )
                 except Exception as e:
-                    yield f"data: {json.dumps({'error': str(e)})}\n\n"
+                    yield sse.error(str(e))
                     error_details = traceback.format_exc()
                     print(f"Error in chat: {str(e)}\n{error_details}")
         else:
@@ -664,33 +657,17 @@ async def chat(
                 summary_content = "" 
             last_conversation = [{"role": msg["role"], "content": msg["content"]} for msg in thread_history[-2:]]
             print(f"User input: {user_input[:50]}...")
-            try:
-                user_type_response = await openrouter_client.chat.completions.create(
-                    model="openai/gpt-4.1",
-                    messages=[
-                        {"role": "system", "content": f"""Classify the intention of the next utterance using a one-word label. Based on the recent conversation with users {threads}"""},
-                        {"role": "user", "content": user_input} 
-                    ],
-                    max_tokens=4000,
-                )
-            except Exception as e:
-                print(f"Error: {e}")
-                return JSONResponse(content={"error": str(e)}, status_code=500)
-            try:
-                user_content_response = await openrouter_client.chat.completions.create(
-                    model="openai/gpt-4.1",
-                    messages=[
-                        {"role": "system", "content": f"""Summarize the main point of the following utterance in one sentence, clearly identifying the subject and purpose. Based on the recent conversation with users {threads}"""},
-                        {"role": "user", "content": user_input} 
-                    ],
-                    max_tokens=4000,
-                )
-            except Exception as e:
-                print(f"Error: {e}")
-                return JSONResponse(content={"error": str(e)}, status_code=500)
-            
-            print("Type response:", user_type_response.choices[0].message.content)
-            print("Content response:", user_content_response.choices[0].message.content)
+            # ユーザー発話の分類・要約（パイプラインモードではストリーミングと並行して実行）
+            user_turn = UserTurn(
+                chatroom_manager, user_id, user_input,
+                openrouter_stream_client, threads
+            )
+            if not ANNOTATION_PIPELINE:
+                try:
+                    await user_turn
+                except Exception as e:
+                    print(f"Error: {e}")
+                    return CodecJSONResponse(content={"error": str(e)}, status_code=500)
             # ユーザーメッセージの追加
             user_message = {
                 "role": "user", 
@@ -698,16 +675,8 @@ async def chat(
                 "user_id": user_id,
                 "timestamp": datetime.now().isoformat()
             }
-            user_thread = {
-                "role": "user", 
-                "type": user_type_response.choices[0].message.content,
-                "content": user_content_response.choices[0].message.content, 
-                "user_id": user_id,
-                "timestamp": datetime.now().isoformat()
-            }
 
             await chatroom_manager.add_message(user_id, user_message)
-            await chatroom_manager.add_thread(user_id, user_thread)
 
             threads = [{"role": msg["role"], "content": msg["content"]} for msg in thread_history]
             if summary and len(summary) > 0:
@@ -1134,16 +1103,29 @@ async def chat(
             print(system_prompt)
             async def generate():
                 """ストリーミングレスポンスを生成する非同期ジェネレータ"""
+                sse = SSEEncoder()
+                disconnect = DisconnectWatcher(request, partial_answer_saver(chatroom_manager, user_id))
                 resp = ""
                 try:
-                    # AIからのストリーミングレスポンスを取得
-                    async for text in openrouter_stream_client.stream_response(user_content_response.choices[0].message.content, system_prompt):
+                    # パイプラインモードでは要約を待たずに発話そのものを送る（システムプロンプトにも含まれている）
+                    stream_input = user_input if ANNOTATION_PIPELINE else user_turn.thread["content"]
+                    # AIからのストリーミングレスポンスを取得（クライアントが切断したら上流のストリームも閉じる）
+                    async for text in disconnect.watch(coalesce_text(openrouter_stream_client.stream_response(stream_input, system_prompt))):
                         if isinstance(text, dict) and "error" in text:
-                            yield f"data: {json.dumps(text)}\n\n"
+                            yield sse.error(text["error"])
                             return
+                        if isinstance(text, StreamRestart):
+                            # 途中で失敗して最初から生成し直す場合は、送信済みの回答を破棄させる
+                            resp = ""
+                            yield sse.restart()
+                            continue
                         resp += text
-                        yield f"data: {json.dumps({'text': text})}\n\n"
+                        yield sse.text(text)
                     
+                    if disconnect.disconnected:
+                        # 切断後は分類・保存のためのLLM呼び出しを行わない
+                        return
+
                     # アシスタントの応答を保存
                     assistant_text = resp
                     assistant_message = {
@@ -1153,65 +1135,33 @@ async def chat(
                         "id": str(uuid.uuid4()),
                         "timestamp": datetime.now().isoformat()
                     }
-                    try:
-                        assistant_type_response = await openrouter_client.chat.completions.create(
-                            model="openai/gpt-4.1",
-                            messages=[
-                                {"role": "system", "content": "Classify the intention of the next utterance using a one-word label."},
-                                {"role": "user", "content": assistant_text} 
-                            ],
-                            max_tokens=4000,
-                        )
-                    except Exception as e:
-                        print(f"Error: {e}")
-                        yield f"data: {json.dumps({'error': str(e)})}\n\n"
-                    try:
-                        assistant_content_response = await openrouter_client.chat.completions.create(
-                            model="openai/gpt-4.1",
-                            messages=[
-                                {"role": "system", "content": "Summarize the main point of the following utterance in one sentence, clearly identifying the subject and purpose."},
-                                {"role": "user", "content": assistant_text} 
-                            ],
-                            max_tokens=4000,
-                        )
-                    except Exception as e:
-                        print(f"Error: {e}")
-                        yield f"data: {json.dumps({'error': str(e)})}\n\n"
-                    assistant_thread = {
-                        "role": "assistant", 
-                        "type": assistant_type_response.choices[0].message.content,
-                        "content": assistant_content_response.choices[0].message.content, 
-                        "user_id": user_id,
-                        "id": str(uuid.uuid4()),
-                        "timestamp": datetime.now().isoformat()
-                    }
                     await chatroom_manager.add_message(user_id, assistant_message)
-                    await chatroom_manager.add_thread(user_id, assistant_thread)
-                    
-                    message_pair = {
-                        "user": user_thread,
-                        "assistant": assistant_thread,
-                        "timestamp": datetime.now().isoformat()
-                    }
-                    await chatroom_manager.update_user_messages(user_id, message_pair)
+                    chatroom_manager.end_turn(user_id)
+                    # 分類・要約とスレッドへの記録はレスポンスを閉じた後にキューで実行する
+                    await user_turn.finish(assistant_message)
+                    yield sse.done()
                     
                     # 定期的にバックグラウンドでサマリーを更新
                     if len(history) % 7 == 0:
                         background_tasks.add_task(
-                            generate_summary_task, 
+                            summarize_after_flush,
+                            chatroom_manager,
                             await to_pretty_json(history),
                             user_id
                         )
                 except Exception as e:
-                    yield f"data: {json.dumps({'error': str(e)})}\n\n"
+                    yield sse.error(str(e))
                     error_details = traceback.format_exc()
                     print(f"Error in chat: {str(e)}\n{error_details}")
+                finally:
+                    # 切断・エラーで回答が揃わなかった場合もユーザー発話は分類して記録する
+                    user_turn.release()
         
         return StreamingResponse(generate(), media_type="text/event-stream")
     except Exception as e:
         error_details = traceback.format_exc()
         print(f"Error in chat: {str(e)}\n{error_details}")
-        return JSONResponse(
+        return CodecJSONResponse(
             content={"error": str(e), "details": error_details},
             status_code=500
         )
@@ -1226,6 +1176,7 @@ async def mobility_chat(
 ):
     try:
         user_id = current_user.id
+        set_admission_user(user_id)
         
         # チャットデータの取得
         history, summary, user_history, thread_history = await chatroom_manager.get_chat_data(user_id)
@@ -1241,35 +1192,17 @@ async def mobility_chat(
         data = await request.json()
         user_input = data.get("message", "")
         print(f"User input: {user_input[:50]}...")
-        try:
-            user_type_response = await openrouter_client.chat.completions.create(
-                model="openai/gpt-4.1",
-                messages=[
-                    {"role": "system", "content": f"""Classify the intention of the next utterance using a one-word label. Based on the recent conversation with users
-        {threads}"""},
-                    {"role": "user", "content": user_input} 
-                ],
-                max_tokens=4000,
-            )
-        except Exception as e:
-            print(f"Error: {e}")
-            return JSONResponse(content={"error": str(e)}, status_code=500)
-        try:
-            user_content_response = await openrouter_client.chat.completions.create(
-                model="openai/gpt-4.1",
-                messages=[
-                    {"role": "system", "content": f"""Summarize the main point of the following utterance in one sentence, clearly identifying the subject and purpose. Based on the recent conversation with users
-        {threads}"""},
-                    {"role": "user", "content": user_input} 
-                ],
-                max_tokens=4000,
-            )
-        except Exception as e:
-            print(f"Error: {e}")
-            return JSONResponse(content={"error": str(e)}, status_code=500)
-        
-        print("Type response:", user_type_response.choices[0].message.content)
-        print("Content response:", user_content_response.choices[0].message.content)
+        # ユーザー発話の分類・要約（パイプラインモードではストリーミングと並行して実行）
+        user_turn = UserTurn(
+            chatroom_manager, user_id, user_input,
+            openrouter_stream_client, threads
+        )
+        if not ANNOTATION_PIPELINE:
+            try:
+                await user_turn
+            except Exception as e:
+                print(f"Error: {e}")
+                return CodecJSONResponse(content={"error": str(e)}, status_code=500)
         # ユーザーメッセージの追加
         user_message = {
             "role": "user", 
@@ -1277,16 +1210,8 @@ async def mobility_chat(
             "user_id": user_id,
             "timestamp": datetime.now().isoformat()
         }
-        user_thread = {
-            "role": "user", 
-            "type": user_type_response.choices[0].message.content,
-            "content": user_content_response.choices[0].message.content, 
-            "user_id": user_id,
-            "timestamp": datetime.now().isoformat()
-        }
 
         await chatroom_manager.add_message(user_id, user_message)
-        await chatroom_manager.add_thread(user_id, user_thread)
         
         # 選択されたプロンプトの取得
         selected_prompt_id = request.session.get("selected_prompt_id")
@@ -1324,16 +1249,27 @@ async def mobility_chat(
         print(system_prompt)
         async def generate():
             """ストリーミングレスポンスを生成する非同期ジェネレータ"""
+            sse = SSEEncoder()
+            disconnect = DisconnectWatcher(request, partial_answer_saver(chatroom_manager, user_id))
             resp = ""
             try:
-                # AIからのストリーミングレスポンスを取得
-                async for text in openrouter_stream_client.stream_response(user_input, system_prompt):
+                # AIからのストリーミングレスポンスを取得（クライアントが切断したら上流のストリームも閉じる）
+                async for text in disconnect.watch(coalesce_text(openrouter_stream_client.stream_response(user_input, system_prompt))):
                     if isinstance(text, dict) and "error" in text:
-                        yield f"data: {json.dumps(text)}\n\n"
+                        yield sse.error(text["error"])
                         return
+                    if isinstance(text, StreamRestart):
+                        # 途中で失敗して最初から生成し直す場合は、送信済みの回答を破棄させる
+                        resp = ""
+                        yield sse.restart()
+                        continue
                     resp += text
-                    yield f"data: {json.dumps({'text': text})}\n\n"
+                    yield sse.text(text)
                 
+                if disconnect.disconnected:
+                    # 切断後は分類・保存のためのLLM呼び出しを行わない
+                    return
+
                 # アシスタントの応答を保存
                 assistant_text = resp
                 assistant_message = {
@@ -1343,65 +1279,33 @@ async def mobility_chat(
                     "id": str(uuid.uuid4()),
                     "timestamp": datetime.now().isoformat()
                 }
-                try:
-                    assistant_type_response = await openrouter_client.chat.completions.create(
-                        model="openai/gpt-4.1",
-                        messages=[
-                            {"role": "system", "content": "Classify the intention of the next utterance using a one-word label."},
-                            {"role": "user", "content": assistant_text} 
-                        ],
-                        max_tokens=4000,
-                    )
-                except Exception as e:
-                    print(f"Error: {e}")
-                    yield f"data: {json.dumps({'error': str(e)})}\n\n"
-                try:
-                    assistant_content_response = await openrouter_client.chat.completions.create(
-                        model="openai/gpt-4.1",
-                        messages=[
-                            {"role": "system", "content": "Summarize the main point of the following utterance in one sentence, clearly identifying the subject and purpose."},
-                            {"role": "user", "content": assistant_text} 
-                        ],
-                        max_tokens=4000,
-                    )
-                except Exception as e:
-                    print(f"Error: {e}")
-                    yield f"data: {json.dumps({'error': str(e)})}\n\n"
-                assistant_thread = {
-                    "role": "assistant", 
-                    "type": assistant_type_response.choices[0].message.content,
-                    "content": assistant_content_response.choices[0].message.content, 
-                    "user_id": user_id,
-                    "id": str(uuid.uuid4()),
-                    "timestamp": datetime.now().isoformat()
-                }
                 await chatroom_manager.add_message(user_id, assistant_message)
-                await chatroom_manager.add_thread(user_id, assistant_thread)
-                
-                message_pair = {
-                    "user": user_thread,
-                    "assistant": assistant_thread,
-                    "timestamp": datetime.now().isoformat()
-                }
-                await chatroom_manager.update_user_messages(user_id, message_pair)
+                chatroom_manager.end_turn(user_id)
+                # 分類・要約とスレッドへの記録はレスポンスを閉じた後にキューで実行する
+                await user_turn.finish(assistant_message)
+                yield sse.done()
                 
                 # 定期的にバックグラウンドでサマリーを更新
                 if len(history) % 7 == 0:
                     background_tasks.add_task(
-                        generate_summary_task, 
+                        summarize_after_flush,
+                        chatroom_manager,
                         await to_pretty_json(history),
                         user_id
                     )
             except Exception as e:
-                yield f"data: {json.dumps({'error': str(e)})}\n\n"
+                yield sse.error(str(e))
                 error_details = traceback.format_exc()
                 print(f"Error in chat: {str(e)}\n{error_details}")
+            finally:
+                # 切断・エラーで回答が揃わなかった場合もユーザー発話は分類して記録する
+                user_turn.release()
         
         return StreamingResponse(generate(), media_type="text/event-stream")
     except Exception as e:
         error_details = traceback.format_exc()
         print(f"Error in chat: {str(e)}\n{error_details}")
-        return JSONResponse(
+        return CodecJSONResponse(
             content={"error": str(e), "details": error_details},
             status_code=500
         )